@@ -1,16 +1,37 @@
-"""Provides the app package for the Social Insecurity application. The package contains the Flask app and all of the extensions and routes."""
+"""Provides the app package for the Social Insecurity application. The package contains the application factory
+and all of the extensions and routes.
 
+create_app() does the one-time setup: it configures the app, applies the pending migrations, compiles the templates
+and loads the friendship graph. Run by the gunicorn master with --preload, the workers are forked with all of that
+done, and share its memory copy-on-write. The resources of a worker, i.e. its database connections and background
+threads, are only created in the worker, see init_worker() and gunicorn.conf.py.
+
+Example:
+    from app import create_app
+
+    app = create_app()
+"""
+
+from __future__ import annotations
+
+import logging
+from collections.abc import Mapping
 from pathlib import Path
-from typing import cast
+from typing import Any, Optional, cast
 
 #import sentry_sdk
 
 from flask import Flask
+from flask_bcrypt import Bcrypt
+from flask_wtf.csrf import CSRFProtect
+from jinja2 import select_autoescape
 
 from app.config import Config
 from app.database import SQLite3
+from app.graph import FriendGraph
+from app.storage import UploadRequest
 
-from flask_bcrypt import Bcrypt
+logger = logging.getLogger(__name__)
 
 """
 sentry_sdk.init(
@@ -25,37 +46,94 @@ sentry_sdk.init(
 )
 """
 
-# Instantiate and configure the app
-app = Flask(__name__)
-app.config.from_object(Config)
-
-# Instantiate the sqlite database extension
-sqlite = SQLite3(app, schema="schema.sql")
+# The extensions are bound to the app by create_app(), they keep the state of each app in app.extensions
+sqlite = SQLite3()
+friend_graph = FriendGraph()
+flask_bcrypt = Bcrypt()
+# CSRF protection using WTForms
+csrf = CSRFProtect()
 
-# Initialize Flask-Bcrypt
-flask_bcrypt = Bcrypt(app)
 
-from flask_wtf.csrf import CSRFProtect
+def create_app(test_config: Optional[Mapping[str, Any]] = None) -> Flask:
+    """Creates and configures the app.
 
-from jinja2 import select_autoescape
+    params:
+        test_config (optional): Settings that override the ones of Config, applied before the database is opened.
 
-app.jinja_env.autoescape = select_autoescape(
-    enabled_extensions=('html', 'j2'),
-    default_for_string=True,
-    default=True
-)
+    returns: The app, with its pending migrations applied and its templates compiled.
 
-# CSRF protection using WTForms
-csrf = CSRFProtect(app)
+    """
+    # Instantiate and configure the app
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if test_config is not None:
+        app.config.update(test_config)
+    # Stream uploaded files into the upload folder while hashing them, see app/storage.py
+    app.request_class = UploadRequest
+    app.jinja_env.autoescape = select_autoescape(
+        enabled_extensions=('html', 'j2'),
+        default_for_string=True,
+        default=True
+    )
 
-# Create the instance and upload folder if they do not exist
-with app.app_context():
+    # Create the instance and upload folder if they do not exist
     instance_path = Path(app.instance_path)
-    if not instance_path.exists():
-        instance_path.mkdir(parents=True, exist_ok=True)
-    upload_path = instance_path / cast(str, app.config["UPLOADS_FOLDER_PATH"])
-    if not upload_path.exists():
-        upload_path.mkdir(parents=True, exist_ok=True)
-
-# Import the routes after the app is configured
-from app import routes  # noqa: E402,F401
+    instance_path.mkdir(parents=True, exist_ok=True)
+    (instance_path / cast(str, app.config["UPLOADS_FOLDER_PATH"])).mkdir(parents=True, exist_ok=True)
+
+    # Applies the pending migrations
+    sqlite.init_app(app, migrations="migrations")
+    friend_graph.init_app(app)
+    flask_bcrypt.init_app(app)
+    csrf.init_app(app)
+
+    from app import commands, fragments, images, passwords, routes, search, shards, suggestions, timeline, user
+
+    shards.init_app(app)
+    fragments.init_app(app)
+    images.init_app(app)
+    passwords.init_app(app)
+    user.init_app(app)
+    routes.init_app(app)
+    app.register_blueprint(routes.bp)
+    for group in (
+        commands.db_cli,
+        images.images_cli,
+        search.search_cli,
+        suggestions.suggestions_cli,
+        timeline.timeline_cli,
+    ):
+        app.cli.add_command(group)
+
+    with app.app_context():
+        # Compiled once here instead of on the first request of every worker
+        for name in app.jinja_env.list_templates(extensions=["j2"]):
+            app.jinja_env.get_template(name)
+        friend_graph.load()
+    with app.app_context():
+        # No database connection may be shared with the forked workers, the context above has released its own
+        sqlite.close()
+    return app
+
+
+def init_worker(app: Flask, concurrency: int) -> None:
+    """Creates the per-worker resources of a forked worker ahead of its first request.
+
+    The background executors and the event polling thread start on first use in each process.
+    Live updates are turned off in a worker that cannot hold EVENTS_MAX_SUBSCRIBERS event streams
+    and still serve other requests, as each open stream occupies one of its threads.
+
+    params:
+        app: The app created by create_app().
+        concurrency: The number of requests the worker serves at once, e.g. its number of threads.
+
+    """
+    with app.app_context():
+        sqlite.open()
+    if app.config["EVENTS_ENABLED"] and concurrency <= app.config["EVENTS_MAX_SUBSCRIBERS"]:
+        logger.warning(
+            "Live updates are disabled, a worker serving %d concurrent requests cannot hold EVENTS_MAX_SUBSCRIBERS=%d",
+            concurrency,
+            app.config["EVENTS_MAX_SUBSCRIBERS"],
+        )
+        app.config["EVENTS_ENABLED"] = False
@@ -0,0 +1,236 @@
+"""Provides the archive of old posts of the Social Insecurity application.
+
+'flask db archive' moves the posts older than ARCHIVE_AFTER_DAYS and their comments from the main database to
+one archive file per ARCHIVE_PERIOD, e.g. instance/archive/posts-2023.db, so the tables, indexes and page cache
+of the main database only hold recent posts. The archive files have the schema of the shard files,
+see app/migrations/shards/, and the Archives and ArchivedPosts tables of the main database record them.
+
+An archive file is only attached, read-only, when a request reaches past the recent posts: the last pages of
+the stream continue with the archived posts of the user and their mutual friends, and the comments page of an
+archived post reads it from its archive. Archived posts can no longer be commented on, and are not searched.
+
+Example:
+    $ flask db archive --older-than 365
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+from collections.abc import Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from flask import current_app
+
+from app import friend_graph, sqlite
+
+logger = logging.getLogger(__name__)
+
+
+def archive_path(period: str) -> Path:
+    """Returns the path of the archive file of a period."""
+    return Path(current_app.instance_path) / current_app.config["ARCHIVE_PATH"].format(period=period)
+
+
+def periods() -> list[str]:
+    """Returns the periods that have an archive file, newest first."""
+    return [row["period"] for row in sqlite.read("SELECT period FROM Archives ORDER BY period DESC;")]
+
+
+def period_of(post_id: int) -> Optional[str]:
+    """Returns the period of the archive file holding a post, or None if the post is not archived."""
+    row = sqlite.read("SELECT period FROM ArchivedPosts WHERE id = ?;", post_id, one=True)
+    return row["period"] if row is not None else None
+
+
+@contextmanager
+def attached(period: str) -> Iterator[None]:
+    """Attaches the archive file of a period read-only as the schema 'archive' of the current connection."""
+    conn = sqlite.connection
+    if any(row["name"] == "archive" for row in conn.execute("PRAGMA database_list;")):
+        conn.execute("DETACH DATABASE archive;")
+    # mode=ro also keeps a missing archive file from being created empty
+    conn.execute("ATTACH DATABASE ? AS archive;", (f"{archive_path(period).as_uri()}?mode=ro",))
+    try:
+        yield
+    finally:
+        conn.execute("DETACH DATABASE archive;")
+
+
+def with_archived(
+    rows: Iterable[Mapping[str, Any]], user_id: int, before: str, before_id: int, limit: int
+) -> Iterator[Mapping[str, Any]]:
+    """Yields the posts of a page of the stream, continued with archived posts when the recent ones run out.
+
+    Archived posts are older than the recent ones, so the page continues after the last recent post.
+
+    params:
+        rows: The recent posts of the page, newest first.
+        user_id: The id of the user whose stream is read.
+        before: The creation time of the cursor of the page.
+        before_id: The post id of the cursor of the page.
+        limit: The number of posts of the page.
+
+    """
+    count = 0
+    for row in rows:
+        count += 1
+        before, before_id = row["creation_time"], row["id"]
+        yield row
+    if count < limit:
+        yield from archived_posts(user_id, before, before_id, limit - count)
+
+
+def archived_posts(user_id: int, before: str, before_id: int, limit: int) -> Iterator[Mapping[str, Any]]:
+    """Yields the archived posts of a user and their mutual friends older than a cursor, newest first."""
+    get_posts = """
+        SELECT p.*, u.*
+        FROM archive.Posts AS p JOIN main.Users AS u ON u.id = p.u_id
+        WHERE p.u_id IN (SELECT value FROM json_each(?)) AND (p.creation_time, p.id) < (?, ?)
+        ORDER BY p.creation_time DESC, p.id DESC
+        LIMIT ?;
+        """
+    archived = periods()
+    if not archived:
+        return
+    authors = json.dumps(sorted({user_id, *friend_graph.mutual_friends(user_id)}))
+    # The periods do not overlap, so the archives are read newest first until the page is full
+    for period in archived:
+        if not archive_path(period).exists():
+            logger.warning("The archive file %s is missing, its posts are left out of the stream", archive_path(period))
+            continue
+        with attached(period):
+            posts = sqlite.read(get_posts, authors, before, before_id, limit)
+        yield from posts
+        limit -= len(posts)
+        if limit <= 0:
+            return
+
+
+def get_post(post_id: int) -> Optional[Mapping[str, Any]]:
+    """Returns an archived post joined with the row of its author, or None if it is not archived."""
+    get_post = """
+        SELECT p.*, u.*
+        FROM archive.Posts AS p JOIN main.Users AS u ON u.id = p.u_id
+        WHERE p.id = ?;
+        """
+    period = period_of(post_id)
+    if period is None:
+        return None
+    with attached(period):
+        return sqlite.read(get_post, post_id, one=True)
+
+
+def get_comments(post_id: int) -> list[Mapping[str, Any]]:
+    """Returns the comments of an archived post joined with the rows of their authors, newest first."""
+    get_comments = """
+        SELECT c.*, u.*
+        FROM archive.Comments AS c JOIN main.Users AS u ON u.id = c.u_id
+        WHERE c.p_id = ?
+        ORDER BY c.creation_time DESC;
+        """
+    period = period_of(post_id)
+    if period is None:
+        return []
+    with attached(period):
+        return sqlite.read(get_comments, post_id)
+
+
+def archive(days: int, batch_size: int = 1000, echo: Callable[[str], Any] = print) -> int:
+    """Moves the posts older than a number of days and their comments to the archive file of their period.
+
+    The posts are moved batch by batch. A transaction over several attached files is not atomic in WAL mode,
+    so each batch is first copied into the archive file and committed, checked to be complete there, and only
+    then recorded in ArchivedPosts and deleted from the main database in a second transaction. The app can keep
+    running, and an interrupted run leaves at most copies in the archive file, which the next run skips.
+
+    params:
+        days: The age in days of the oldest posts that are kept in the main database.
+        batch_size (optional): The number of posts moved per transaction.
+        echo (optional): Called with a line of progress for every archive file.
+
+    returns: The number of posts archived.
+
+    """
+    get_periods = """
+        SELECT DISTINCT strftime(:format, creation_time) AS period
+        FROM Posts
+        WHERE creation_time < datetime('now', :age)
+        ORDER BY period;
+        """
+    get_post_ids = """
+        SELECT id
+        FROM Posts
+        WHERE creation_time < datetime('now', :age) AND strftime(:format, creation_time) = :period
+        ORDER BY id;
+        """
+    # The comment counts are recounted by the triggers of the archive as the comments are inserted
+    copy_rows = [
+        """
+        INSERT OR IGNORE INTO archive.Posts (id, u_id, content, image, creation_time, comment_count)
+        SELECT id, u_id, content, image, creation_time, 0
+        FROM main.Posts WHERE id IN (SELECT value FROM json_each(:ids));
+        """,
+        """
+        INSERT OR IGNORE INTO archive.Comments (id, p_id, u_id, comment, creation_time)
+        SELECT id, p_id, u_id, comment, creation_time
+        FROM main.Comments WHERE p_id IN (SELECT value FROM json_each(:ids));
+        """,
+    ]
+    count_missing = """
+        SELECT
+            (SELECT COUNT(*) FROM main.Posts AS p WHERE p.id IN (SELECT value FROM json_each(:ids))
+             AND NOT EXISTS (SELECT 1 FROM archive.Posts AS a WHERE a.id = p.id))
+          + (SELECT COUNT(*) FROM main.Comments AS c WHERE c.p_id IN (SELECT value FROM json_each(:ids))
+             AND NOT EXISTS (SELECT 1 FROM archive.Comments AS a WHERE a.id = c.id));
+        """
+    # The posts of the period are counted from ArchivedPosts, so a batch that is recorded twice is not counted twice
+    record_and_delete_rows = [
+        """
+        INSERT OR REPLACE INTO main.ArchivedPosts (id, u_id, image, period)
+        SELECT id, u_id, image, :period FROM main.Posts WHERE id IN (SELECT value FROM json_each(:ids));
+        """,
+        """
+        INSERT INTO main.Archives (period, posts)
+        VALUES (:period, (SELECT COUNT(*) FROM main.ArchivedPosts WHERE period = :period))
+        ON CONFLICT (period) DO UPDATE SET posts = excluded.posts, archived_time = CURRENT_TIMESTAMP;
+        """,
+        "DELETE FROM main.Comments WHERE p_id IN (SELECT value FROM json_each(:ids));",
+        "DELETE FROM main.Posts WHERE id IN (SELECT value FROM json_each(:ids));",
+    ]
+    params = {"format": current_app.config["ARCHIVE_PERIOD"], "age": f"-{days} days"}
+    archived = 0
+
+    def run_transaction(conn: sqlite3.Connection, statements: list[str], batch: dict[str, Any]) -> None:
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            for statement in statements:
+                conn.execute(statement, batch)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    with sqlite.writer() as conn:
+        for row in conn.execute(get_periods, params).fetchall():
+            period = row["period"]
+            path = archive_path(period)
+            sqlite.migrate_shard(path)
+            post_ids = [post["id"] for post in conn.execute(get_post_ids, {**params, "period": period})]
+            conn.execute("ATTACH DATABASE ? AS archive;", (str(path),))
+            try:
+                for start in range(0, len(post_ids), batch_size):
+                    batch = {"period": period, "ids": json.dumps(post_ids[start : start + batch_size])}
+                    run_transaction(conn, copy_rows, batch)
+                    missing = conn.execute(count_missing, batch).fetchone()[0]
+                    if missing:
+                        raise RuntimeError(f"{missing} rows were not copied to {path.name}")
+                    run_transaction(conn, record_and_delete_rows, batch)
+            finally:
+                conn.execute("DETACH DATABASE archive;")
+            archived += len(post_ids)
+            echo(f"Archived {len(post_ids)} posts to {path.name}.")
+    return archived
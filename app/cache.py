@@ -0,0 +1,90 @@
+"""Provides a small in-memory cache for the Social Insecurity application.
+
+The cache is local to each worker process, bounded in size and optionally expires entries after a time to live.
+Data that other workers can change should be validated against the counters in app.versions before use.
+
+Example:
+    from app.cache import LRUCache
+
+    cache = LRUCache(maxsize=1024, ttl=60.0)
+    cache.set("key", "value")
+    cache.get("key")  # "value"
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any, Optional
+
+
+class LRUCache:
+    """Provides a thread-safe least-recently-used cache with an optional time to live.
+
+    When the cache is full, the entry that was used the longest time ago is evicted.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None) -> None:
+        """Initializes the cache.
+
+        params:
+            maxsize (optional): The maximum number of entries kept in the cache.
+            ttl (optional): Seconds after which an entry expires, or None to keep entries until they are evicted.
+
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the value cached for the key, or the default if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Caches the value for the key, evicting the least recently used entries if the cache is full."""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: Hashable) -> None:
+        """Removes the key from the cache if it is present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Removes all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Returns the size of the cache and its hit, miss and eviction counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,293 @@
+"""Provides database maintenance commands for the Social Insecurity application.
+
+The commands are registered with the flask command line interface under 'flask db'.
+
+Example:
+    $ flask db migrate
+    $ flask db backfill-comment-counts
+    $ flask db check-comment-counts
+    $ flask db import --users users.csv --friends friends.csv --posts posts.jsonl --comments comments.jsonl
+    $ flask db reshard
+    $ flask db archive --older-than 365
+"""
+
+from __future__ import annotations
+
+import csv
+import itertools
+import json
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import archive, search, shards, sqlite, suggestions, timeline
+
+db_cli = AppGroup("db", help="Maintain the SQLite3 database.")
+
+
+def backfill_comment_counts() -> int:
+    """Recomputes Posts.comment_count from the Comments table.
+
+    returns: The number of posts whose count was changed.
+
+    """
+    update_counts = """
+        UPDATE Posts
+        SET comment_count = (SELECT COUNT(*) FROM Comments WHERE p_id = Posts.id)
+        WHERE comment_count != (SELECT COUNT(*) FROM Comments WHERE p_id = Posts.id);
+        """
+    with sqlite.transaction() as conn:
+        return conn.execute(update_counts).rowcount
+
+
+def find_wrong_comment_counts() -> list:
+    """Returns the posts whose comment_count does not match the Comments table."""
+    get_wrong_counts = """
+        SELECT p.id, p.comment_count, COUNT(c.id) AS actual
+        FROM Posts AS p LEFT JOIN Comments AS c ON c.p_id = p.id
+        GROUP BY p.id
+        HAVING p.comment_count != COUNT(c.id);
+        """
+    return sqlite.read(get_wrong_counts)
+
+
+# The columns that can be imported into each table, in the order the tables are loaded
+IMPORT_COLUMNS = {
+    "Users": (
+        "id",
+        "username",
+        "first_name",
+        "last_name",
+        "password",
+        "hash_salt",
+        "education",
+        "employment",
+        "music",
+        "movie",
+        "nationality",
+        "birthday",
+    ),
+    "Friends": ("u_id", "f_id"),
+    "Posts": ("id", "u_id", "content", "image", "creation_time"),
+    "Comments": ("id", "p_id", "u_id", "comment", "creation_time"),
+}
+
+
+def read_rows(path: Path, table: str) -> tuple[tuple[str, ...], Iterator[tuple]]:
+    """Streams the rows of a CSV file with a header line, or of a JSONL file with one object per line.
+
+    Empty CSV fields and missing JSON keys are imported as NULL.
+
+    params:
+        path: The path of the file, its format is chosen by the extension (.csv, .jsonl or .ndjson).
+        table: The table the rows are imported into.
+
+    raises: click.BadParameter if the format is unknown or the file has columns the table cannot import.
+
+    returns: The imported columns and an iterator over the rows.
+
+    """
+    if path.suffix == ".csv":
+        file = path.open(newline="", encoding="utf-8")
+        reader = csv.DictReader(file)
+        columns = _import_columns(table, reader.fieldnames or [], path)
+        rows = (tuple(record[column] or None for column in columns) for record in reader)
+    elif path.suffix in (".jsonl", ".ndjson"):
+        file = path.open(encoding="utf-8")
+        records = (json.loads(line) for line in file if line.strip())
+        first = next(records, None)
+        columns = _import_columns(table, first or {}, path)
+        records = itertools.chain([first], records) if first is not None else records
+        rows = (tuple(record.get(column) for column in columns) for record in records)
+    else:
+        raise click.BadParameter(f"{path} is not a .csv, .jsonl or .ndjson file")
+    return columns, _closing(rows, file)
+
+
+def import_rows(table: str, columns: tuple[str, ...], rows: Iterator[tuple], batch_size: int) -> int:
+    """Inserts rows into a table in batches, committing each batch in its own transaction.
+
+    returns: The number of rows inserted.
+
+    """
+    insert_rows = f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        VALUES ({", ".join("?" for _ in columns)});
+        """
+    count = 0
+    start = time.perf_counter()
+    while batch := list(itertools.islice(rows, batch_size)):
+        with sqlite.transaction() as conn:
+            conn.executemany(insert_rows, batch)
+        count += len(batch)
+        click.echo(f"{table}: imported {count} rows ({count / (time.perf_counter() - start):.0f} rows/s)")
+    return count
+
+
+def drop_indexes_and_triggers(tables: list[str]) -> list[str]:
+    """Drops the indexes and triggers of the tables, so rows can be inserted without maintaining them.
+
+    Indexes created by PRIMARY KEY and UNIQUE constraints cannot be dropped and are kept.
+
+    returns: The statements that create the dropped indexes and triggers again, indexes first.
+
+    """
+    get_schema_objects = f"""
+        SELECT type, name, sql
+        FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND sql IS NOT NULL AND tbl_name IN ({", ".join("?" for _ in tables)})
+        ORDER BY type, name;
+        """
+    schema_objects = sqlite.read(get_schema_objects, *tables)
+    with sqlite.transaction() as conn:
+        for schema_object in schema_objects:
+            conn.execute(f"DROP {schema_object['type'].upper()} [{schema_object['name']}];")
+    return [schema_object["sql"] for schema_object in schema_objects]
+
+
+def create_schema_objects(statements: list[str]) -> None:
+    """Runs the statements returned by drop_indexes_and_triggers() in one transaction."""
+    with sqlite.transaction() as conn:
+        for statement in statements:
+            conn.execute(statement)
+
+
+def relax_pragmas() -> dict[str, object]:
+    """Applies SQLITE3_IMPORT_PRAGMAS to the connection of the app context.
+
+    returns: The previous values of the changed PRAGMAs, to restore them with restore_pragmas().
+
+    """
+    previous = {}
+    with sqlite.writer() as conn:
+        for name, value in current_app.config["SQLITE3_IMPORT_PRAGMAS"].items():
+            previous[name] = conn.execute(f"PRAGMA {name};").fetchone()[0]
+            conn.execute(f"PRAGMA {name} = {value};")
+    return previous
+
+
+def restore_pragmas(previous: dict[str, object]) -> None:
+    """Restores the PRAGMAs changed by relax_pragmas()."""
+    with sqlite.writer() as conn:
+        for name, value in previous.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+
+
+def _import_columns(table: str, names, path: Path) -> tuple[str, ...]:
+    """Returns the columns of the table that are present in the file, in the order of IMPORT_COLUMNS."""
+    unknown = set(names) - set(IMPORT_COLUMNS[table])
+    if unknown:
+        raise click.BadParameter(f"{path} has columns that cannot be imported into {table}: {', '.join(sorted(unknown))}")
+    return tuple(column for column in IMPORT_COLUMNS[table] if column in names)
+
+
+def _closing(rows: Iterator[tuple], file) -> Iterator[tuple]:
+    """Yields the rows and closes the file they are read from when they are exhausted or abandoned."""
+    with file:
+        yield from rows
+
+
+@db_cli.command("migrate")
+def migrate_command() -> None:
+    """Apply the migrations that have not been applied to the database yet."""
+    for name in sqlite.migrate():
+        click.echo(f"Applied {name}")
+    click.echo(f"The database is at version {sqlite.schema_version()}.")
+
+
+@db_cli.command("backfill-comment-counts")
+def backfill_comment_counts_command() -> None:
+    """Recompute the comment count of every post."""
+    shards.require_unsharded()
+    count = backfill_comment_counts()
+    click.echo(f"Updated the comment count of {count} posts.")
+
+
+@db_cli.command("check-comment-counts")
+@click.option("--fix", is_flag=True, help="Recompute the counts that are wrong.")
+def check_comment_counts_command(fix: bool) -> None:
+    """Report posts whose comment count does not match their comments."""
+    shards.require_unsharded()
+    wrong_counts = find_wrong_comment_counts()
+    for post in wrong_counts:
+        click.echo(f"Post {post['id']}: comment_count is {post['comment_count']}, actual count is {post['actual']}")
+    if not wrong_counts:
+        click.echo("All comment counts are consistent.")
+    elif fix:
+        click.echo(f"Fixed the comment count of {backfill_comment_counts()} posts.")
+    else:
+        raise click.exceptions.Exit(1)
+
+
+@db_cli.command("import")
+@click.option("--users", type=click.Path(exists=True, dir_okay=False, path_type=Path), help="Users file.")
+@click.option("--friends", type=click.Path(exists=True, dir_okay=False, path_type=Path), help="Friends file.")
+@click.option("--posts", type=click.Path(exists=True, dir_okay=False, path_type=Path), help="Posts file.")
+@click.option("--comments", type=click.Path(exists=True, dir_okay=False, path_type=Path), help="Comments file.")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows inserted per transaction.")
+def import_command(
+    users: Optional[Path],
+    friends: Optional[Path],
+    posts: Optional[Path],
+    comments: Optional[Path],
+    batch_size: int,
+) -> None:
+    """Bulk import users, friendships, posts and comments from CSV or JSONL files.
+
+    The column names are taken from the CSV header or the JSON keys. Passwords and hash salts are imported as-is,
+    so they must be hashes made by this app. Indexes and triggers are dropped during the import and created again
+    afterwards, followed by a rebuild of the comment counts, timelines, search indexes and suggestions.
+    Stop the app while importing, since writes made by the app during the import do not update them.
+    """
+    shards.require_unsharded()
+    files = {"Users": users, "Friends": friends, "Posts": posts, "Comments": comments}
+    sources = {table: read_rows(path, table) for table, path in files.items() if path is not None}
+    if not sources:
+        raise click.UsageError("Give at least one file to import.")
+
+    start = time.perf_counter()
+    previous_pragmas = relax_pragmas()
+    statements = drop_indexes_and_triggers([*IMPORT_COLUMNS, "Timelines"])
+    try:
+        for table, (columns, rows) in sources.items():
+            import_rows(table, columns, rows, batch_size)
+    finally:
+        click.echo("Creating indexes and triggers...")
+        create_schema_objects(statements)
+        click.echo(f"Updated the comment count of {backfill_comment_counts()} posts.")
+        click.echo(f"Rebuilt timelines with {timeline.rebuild()} entries.")
+        search.rebuild()
+        click.echo("Rebuilt the search indexes.")
+        click.echo(f"Refreshed the friend suggestions of {suggestions.refresh(all_users=True)} users.")
+        # The version triggers were dropped, so invalidate the caches of all workers at once
+        sqlite.write("UPDATE Versions SET value = value + 1;")
+        restore_pragmas(previous_pragmas)
+    click.echo(f"Imported {', '.join(str(path) for path in files.values() if path)} in {time.perf_counter() - start:.1f}s.")
+
+
+@db_cli.command("reshard")
+@click.option("--batch-size", default=1000, show_default=True, help="Posts moved per transaction.")
+def reshard_command(batch_size: int) -> None:
+    """Move the posts and comments to the shard files of SQLITE3_SHARDS.
+
+    Run it after changing SQLITE3_SHARDS, with the app stopped, since posts written while they are moved
+    may end up in the wrong file. SQLITE3_SHARDS = 1 moves every post back into the main database.
+    """
+    count = current_app.config["SQLITE3_SHARDS"]
+    moved = shards.reshard(count, batch_size, echo=click.echo)
+    click.echo(f"Moved {moved} posts for {count} shards.")
+
+
+@db_cli.command("archive")
+@click.option("--older-than", type=int, help="Age in days of the posts archived, defaults to ARCHIVE_AFTER_DAYS.")
+@click.option("--batch-size", default=1000, show_default=True, help="Posts moved per transaction.")
+def archive_command(older_than: Optional[int], batch_size: int) -> None:
+    """Move old posts and their comments to the archive files, e.g. nightly from cron."""
+    shards.require_unsharded()
+    days = current_app.config["ARCHIVE_AFTER_DAYS"] if older_than is None else older_than
+    archived = archive.archive(days, batch_size, echo=click.echo)
+    click.echo(f"Archived {archived} posts older than {days} days.")
@@ -0,0 +1,68 @@
+"""Provides conditional GET handling for the pages of the Social Insecurity application.
+
+A page is identified by a cheap version stamp, built from the URL, the logged-in user and the version counters
+of the data the page shows. The stamp is sent as the ETag of the page, and when the browser asks for the page again
+with a matching If-None-Match header, a 304 Not Modified is returned without running the page's queries or templates.
+
+Example:
+    cached = not_modified(versions.get("posts"), versions.get("comments"))
+    if cached is not None:
+        return cached
+    return render_template(...)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import time
+from typing import Any, Optional
+
+import flask_login
+from flask import Response, after_this_request, current_app, request, session
+
+
+def not_modified(*parts: Any) -> Optional[Response]:
+    """Returns a 304 response if the browser's copy of the page is current, otherwise None.
+
+    When None is returned the page should be rendered as usual, the ETag is added to its response.
+    Only GET and HEAD requests without pending flash messages are handled.
+
+    params:
+        parts: The values the page depends on besides its URL and the logged-in user, e.g. version counters.
+
+    returns: A 304 response or None.
+
+    """
+    if request.method not in ("GET", "HEAD") or session.get("_flashes"):
+        return None
+
+    etag = _page_etag(parts)
+
+    @after_this_request
+    def add_etag(response: Response) -> Response:
+        if response.status_code == 200:
+            _set_validator_headers(response, etag)
+        return response
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        _set_validator_headers(response, etag)
+        return response
+    return None
+
+
+def _page_etag(parts: tuple[Any, ...]) -> str:
+    """Returns the ETag of the requested page."""
+    stamp = [request.full_path, flask_login.current_user.get_id(), session.get("csrf_token"), *parts]
+    # The CSRF tokens in a page expire, so a page must not be reused for longer than half their lifetime
+    csrf_time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    if csrf_time_limit:
+        stamp.append(int(time.time() // (csrf_time_limit / 2)))
+    return hashlib.sha256(repr(stamp).encode()).hexdigest()
+
+
+def _set_validator_headers(response: Response, etag: str) -> None:
+    """Adds the ETag and asks the browser to revalidate its copy before every use."""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
@@ -18,7 +18,76 @@ import os
 
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY") or "4a63fa17bc96f499045b9826eab190788305905802ceb5df4439d327963e00ab"
-    SQLITE3_DATABASE_PATH = "sqlite3.db"  # Path relative to the Flask instance folder
-    UPLOADS_FOLDER_PATH = "uploads"  # Path relative to the Flask instance folder
+    SQLITE3_DATABASE_PATH = os.environ.get("SQLITE3_DATABASE_PATH") or "sqlite3.db"  # Path relative to the Flask instance folder
+    SQLITE3_MIGRATE_ON_START = True  # Apply pending migrations when the app starts, otherwise run 'flask db migrate'
+    SQLITE3_MIGRATE_TIMEOUT = 60.0  # Seconds to wait for a migration that another process is applying
+    SQLITE3_POOL_SIZE = 8  # Maximum number of open read-only database connections in each worker
+    SQLITE3_POOL_TIMEOUT = 5.0  # Seconds to wait for a free read-only database connection
+    SQLITE3_WRITE_TIMEOUT = 10.0  # Seconds to wait for the single writer connection of the worker
+    SQLITE3_GROUP_COMMIT = True  # Commit small inserts of concurrent requests together, see SQLite3.write_batched()
+    SQLITE3_GROUP_COMMIT_WINDOW = 0.002  # Seconds to wait for more statements before committing a batch
+    SQLITE3_GROUP_COMMIT_MAX_BATCH = 64  # Maximum number of statements committed together
+    SQLITE3_GROUP_COMMIT_MAX_PENDING = 256  # Statements queued before new ones are written directly instead
+    SQLITE3_CACHED_STATEMENTS = 256  # Prepared statements kept for reuse by each database connection
+    SQLITE3_FETCH_SIZE = 100  # Rows fetched at a time by SQLite3.iterate()
+    # Number of files the posts and comments are spread over by author, see app/shards.py. Search and live updates
+    # only cover the main database, so above 1 the app refuses to start unless SEARCH_ENABLED and EVENTS_ENABLED
+    # are set to False as well
+    SQLITE3_SHARDS = 1
+    SQLITE3_SHARD_PATH = "shards/shard-{index}.db"  # Path of each shard file relative to the Flask instance folder
+    SQLITE3_SHARD_WORKERS = 4  # Threads of each worker reading the shards of a stream in parallel
+    # Applied once to every new database connection, in this order
+    SQLITE3_PRAGMAS = {
+        "busy_timeout": 5000,  # Wait up to 5 seconds for the write lock instead of failing with 'database is locked'
+        "journal_mode": "WAL",  # Readers do not block the writer and the writer does not block readers
+        "synchronous": "NORMAL",  # Safe with WAL, only the last transactions can be lost on power failure
+        "cache_size": -16000,  # 16 MB page cache per connection
+        "mmap_size": 134217728,  # Memory-map the first 128 MB of the database file
+        "temp_store": "MEMORY",  # Keep temporary tables and indexes for sorting in memory
+    }
+    # Applied by 'flask db import' for the duration of the import, the previous values are restored afterwards
+    SQLITE3_IMPORT_PRAGMAS = {
+        "synchronous": "OFF",  # Do not wait for the disk after each batch, a crash during an import means starting over
+        "cache_size": -262144,  # 256 MB page cache, so the indexes can be built in memory
+    }
+    SQLITE3_INSTRUMENTATION = True  # Time the statements of each request, see the Server-Timing header and /debug/sql
+    SQLITE3_SLOW_REQUEST_MS = 100.0  # Log requests whose statements take longer than this in total
+    SQLITE3_SLOW_STATEMENT_MS = 20.0  # Capture the query plan of statements that take longer than this
+    SQLITE3_STATS_TOKEN = os.environ.get("SQLITE3_STATS_TOKEN")  # Bearer token for /debug/sql, disabled without one
+    UPLOADS_FOLDER_PATH = os.environ.get("UPLOADS_FOLDER_PATH") or "uploads"  # Path relative to the Flask instance folder
     ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "gif"}  # Only files with these extentions can be uploaded
+    UPLOADS_SENDFILE = None  # Let a front proxy send uploaded files, either "x-accel-redirect" (nginx) or "x-sendfile"
+    UPLOADS_ACCEL_PREFIX = "/protected-uploads/"  # Internal nginx location that maps to the uploads folder
+    UPLOADS_AUTH_CACHE_SIZE = 10000  # Number of (user, file) authorization results kept in each worker
+    UPLOADS_AUTH_CACHE_TTL = 30.0  # Seconds an authorization result is reused
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # Requests larger than 16 MB are rejected while they are being received
+    IMAGE_VARIANTS = {"feed": (640, 640), "medium": (1280, 1280)}  # Maximum width and height of each image variant
+    IMAGE_WORKERS = 2  # Threads creating image variants in each worker
+    IMAGE_MAX_PENDING = 64  # Images waiting for variants before new ones are skipped until 'flask images backfill'
     WTF_CSRF_ENABLED = True  # We are using WTForms for protection against CSRF
+    BCRYPT_LOG_ROUNDS = 12  # Cost of new password hashes, older hashes are upgraded on the next login
+    PASSWORD_HASH_WORKERS = 2  # Threads hashing passwords in each worker
+    PASSWORD_HASH_MAX_PENDING = 8  # Logins and registrations hashing or waiting to hash before new ones are rejected
+    PASSWORD_HASH_TIMEOUT = 10.0  # Seconds to wait for a password hash
+    USER_CACHE_SIZE = 1024  # Number of users kept in the in-memory cache of each worker
+    USER_CACHE_TTL = 300.0  # Seconds before a cached user is loaded from the database again
+    USER_CACHE_SHARED = True  # Validate cached users against the database, so updates by other workers are seen
+    STREAM_PAGE_SIZE = 20  # Number of posts shown per page on the stream
+    STREAMED_RENDERING = True  # Send the stream and comments pages while their rows are rendered, see app/rendering.py
+    ARCHIVE_AFTER_DAYS = 365  # Posts older than this are moved to the archive files by 'flask db archive'
+    ARCHIVE_PERIOD = "%Y"  # strftime format of the period each archive file holds, must sort in time order
+    ARCHIVE_PATH = "archive/posts-{period}.db"  # Path of each archive file relative to the Flask instance folder
+    SUGGESTIONS_PER_USER = 10  # Number of people you may know stored and shown for each user
+    SUGGESTIONS_REFRESH_ON_CHANGE = True  # Recompute suggestions in the background after a friend is added
+    EVENTS_ENABLED = True  # Push new posts and comments to open stream and comments pages, see app/events.py
+    EVENTS_MAX_SUBSCRIBERS = 50  # Open event streams per worker, each one occupies a thread of the worker
+    EVENTS_MAX_QUEUED = 100  # Events waiting to be sent to a subscriber before it is disconnected
+    EVENTS_HEARTBEAT = 15.0  # Seconds between heartbeats on an idle event stream
+    EVENTS_MAX_AGE = 300.0  # Seconds before an event stream is ended, the browser reconnects without losing events
+    EVENTS_RETRY = 5.0  # Seconds the browser waits before reconnecting to an event stream
+    EVENTS_POLL_INTERVAL = 0.5  # Seconds between polls for the events published by other workers
+    EVENTS_KEPT = 10000  # Number of newest events kept for reconnecting browsers
+    SEARCH_ENABLED = True  # Full-text search of the posts and comments, see app/search.py
+    SEARCH_PAGE_SIZE = 20  # Number of posts shown per page of search results
+    SEARCH_MAX_MATCHES = 1000  # Newest matching posts and comments that are ranked, which bounds the cost of a search
+    FRAGMENT_CACHE_SIZE = 5000  # Number of posts whose rendered cards are kept in each worker
@@ -2,6 +2,16 @@
 
 This extension provides a simple interface to the SQLite3 database.
 
+The schema is created and changed by the numbered migration files in app/migrations/, see SQLite3.migrate().
+Reads run on a pool of read-only connections, while every write of a worker goes through its single writer
+connection, so the threads of a worker take turns writing instead of competing for the database write lock.
+Small inserts can be grouped into a shared transaction with SQLite3.write_batched().
+With SQLITE3_SHARDS above 1, the extension also manages that many shard files, see SQLite3.shard_of() and
+SQLite3.scatter(), which app/shards.py uses to spread the posts and comments over them by author.
+When SQLITE3_INSTRUMENTATION is enabled, the statements run by each request are timed. Their total time is sent in
+a Server-Timing header, the query plan of slow statements is captured, requests with slow statements are logged
+and the timings are aggregated per route in SQLite3.stats.
+
 Example:
     from flask import Flask
     from app.database import SQLite3
@@ -12,12 +22,512 @@ Example:
 
 from __future__ import annotations
 
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from os import PathLike
 from pathlib import Path
-from typing import Any, Optional, cast
+from typing import Any, Optional
+
+from flask import Flask, Response, current_app, g, request
+
+from app.workers import BoundedExecutor, ExecutorSaturated
+
+logger = logging.getLogger(__name__)
+
+
+def split_statements(script: str) -> Iterator[str]:
+    """Splits a SQL script into its statements, keeping the statements inside a trigger together.
+
+    Unlike sqlite3.Connection.executescript(), running the statements one by one does not commit
+    the transaction they run in.
+    """
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+    if statement.strip() and not all(line.strip().startswith("--") for line in statement.splitlines() if line.strip()):
+        raise ValueError(f"Incomplete SQL statement at the end of the script: {statement.strip()}")
+
+
+class ConnectionPool:
+    """Provides a bounded pool of persistent connections to a SQLite3 database.
+
+    Connections are opened lazily, configured once with the supplied PRAGMAs and then reused,
+    which keeps their page cache warm between requests.
+    The pool is tied to the process that created it, a forked worker starts with an empty pool
+    since SQLite3 connections must not be shared across a fork.
+
+    Example:
+        pool = ConnectionPool("sqlite3.db", size=4, pragmas={"journal_mode": "wal"})
+        conn = pool.acquire()
+        try:
+            conn.execute("SELECT 1;")
+        finally:
+            pool.release(conn)
+    """
+
+    def __init__(
+        self,
+        path: PathLike | str,
+        *,
+        size: int = 8,
+        timeout: float = 5.0,
+        pragmas: Optional[Mapping[str, Any]] = None,
+        cached_statements: int = 128,
+    ) -> None:
+        """Initializes the pool.
+
+        params:
+            path: The path to the database file.
+            size (optional): The maximum number of connections handed out at the same time.
+            timeout (optional): Seconds to wait for a free connection before giving up.
+            pragmas (optional): The PRAGMAs applied to every new connection, in order.
+            cached_statements (optional): The number of prepared statements each connection keeps for reuse.
+
+        """
+        self._path = path
+        self._size = size
+        self._timeout = timeout
+        self._pragmas = dict(pragmas or {})
+        self._cached_statements = cached_statements
+        self._reset()
+
+    def acquire(self) -> sqlite3.Connection:
+        """Returns a healthy connection from the pool, opening a new one if none are idle.
+
+        raises: RuntimeError if all connections are in use for longer than the timeout.
+
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        if not self._slots.acquire(timeout=self._timeout):
+            raise RuntimeError(f"No free SQLite3 connection after {self._timeout} seconds")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._is_healthy(conn):
+                    return conn
+                conn.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """Returns a connection to the pool, rolling back any transaction left open."""
+        if self._pid != os.getpid():
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Closes all idle connections of the pool."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
 
-from flask import Flask, current_app, g
+    def _reset(self) -> None:
+        """Starts over with an empty pool owned by the current process."""
+        self._pid = os.getpid()
+        # Last in, first out keeps reusing the connections with the warmest page cache
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self._size)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens a new connection and applies the PRAGMA profile to it.
+
+        The connection is in autocommit mode, transactions are only opened explicitly with BEGIN.
+        """
+        conn = sqlite3.connect(
+            self._path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=self._cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in self._pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        """Checks that a pooled connection is still usable."""
+        try:
+            conn.execute("SELECT 1;").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+
+class QueryStats:
+    """Provides the statement timings of requests, aggregated per route.
+
+    The statistics are kept in memory and only cover the requests handled by this process.
+    """
+
+    def __init__(self, max_queries: int = 200) -> None:
+        """Initializes the statistics.
+
+        params:
+            max_queries (optional): The number of distinct statements tracked per route, later ones are not tracked.
+
+        """
+        self._max_queries = max_queries
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def add(self, route: str, statements: list[dict[str, Any]]) -> None:
+        """Adds the statements run by a request to the statistics of its route."""
+        sql_time = sum(statement["duration"] for statement in statements)
+        with self._lock:
+            stats = self._routes.setdefault(
+                route, {"requests": 0, "statements": 0, "sql_time": 0.0, "max_sql_time": 0.0, "queries": {}}
+            )
+            stats["requests"] += 1
+            stats["statements"] += len(statements)
+            stats["sql_time"] += sql_time
+            stats["max_sql_time"] = max(stats["max_sql_time"], sql_time)
+            for statement in statements:
+                query = stats["queries"].get(statement["query"])
+                if query is None:
+                    if len(stats["queries"]) >= self._max_queries:
+                        continue
+                    query = stats["queries"][statement["query"]] = {"count": 0, "time": 0.0, "max_time": 0.0, "rows": 0}
+                query["count"] += 1
+                query["time"] += statement["duration"]
+                query["max_time"] = max(query["max_time"], statement["duration"])
+                query["rows"] += statement["rows"]
+                if statement["plan"] is not None:
+                    query["plan"] = statement["plan"]
+
+    def snapshot(self) -> dict[str, Any]:
+        """Returns the statistics of each route, times in milliseconds, with the slowest statements in total first."""
+        with self._lock:
+            routes = {}
+            for route, stats in self._routes.items():
+                queries = [
+                    {
+                        "query": text,
+                        "count": query["count"],
+                        "total_ms": 1000 * query["time"],
+                        "mean_ms": 1000 * query["time"] / query["count"],
+                        "max_ms": 1000 * query["max_time"],
+                        "rows": query["rows"],
+                        "plan": query.get("plan"),
+                    }
+                    for text, query in stats["queries"].items()
+                ]
+                routes[route] = {
+                    "requests": stats["requests"],
+                    "statements_per_request": stats["statements"] / stats["requests"],
+                    "sql_ms_per_request": 1000 * stats["sql_time"] / stats["requests"],
+                    "max_sql_ms": 1000 * stats["max_sql_time"],
+                    "queries": sorted(queries, key=lambda query: query["total_ms"], reverse=True),
+                }
+            return routes
+
+    def clear(self) -> None:
+        """Removes all statistics."""
+        with self._lock:
+            self._routes.clear()
+
+
+class WriterStats:
+    """Provides the waits for the writer connection and the commit latencies of a worker process.
+
+    Like QueryStats, the statistics are kept in memory and only cover this process.
+    """
+
+    def __init__(self) -> None:
+        """Initializes the statistics."""
+        self._lock = threading.Lock()
+        self.clear()
+
+    def add_lock_wait(self, seconds: float) -> None:
+        """Adds the time a thread waited for the writer connection."""
+        with self._lock:
+            self._add("lock_wait", seconds)
+
+    def add_commit(self, seconds: float) -> None:
+        """Adds the time from the start of a transaction, or of an autocommitted statement, to its commit."""
+        with self._lock:
+            self._add("commit", seconds)
+
+    def add_batch(self, statements: int, waits: Iterable[float]) -> None:
+        """Adds a group commit, and the time each of its statements waited from being queued to being committed."""
+        with self._lock:
+            self._batches += 1
+            self._batched_statements += statements
+            for seconds in waits:
+                self._add("batched_write", seconds)
+
+    def add_queued(self, depth: int) -> None:
+        """Records the depth of the group commit queue after a statement was queued."""
+        with self._lock:
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+
+    def add_overflow(self) -> None:
+        """Counts a statement written directly because the group commit queue was full."""
+        with self._lock:
+            self._overflows += 1
+
+    def snapshot(self, queue_depth: int) -> dict[str, Any]:
+        """Returns the statistics, times in milliseconds.
+
+        params:
+            queue_depth: The number of statements waiting in the group commit queue right now.
+
+        """
+        with self._lock:
+            timings = {
+                name: {
+                    "count": count,
+                    "mean_ms": 1000 * total / count if count else 0.0,
+                    "max_ms": 1000 * maximum,
+                }
+                for name, (count, total, maximum) in self._timings.items()
+            }
+            return {
+                "queue_depth": queue_depth,
+                "max_queue_depth": self._max_queue_depth,
+                "batches": self._batches,
+                "statements_per_batch": self._batched_statements / self._batches if self._batches else 0.0,
+                "overflows": self._overflows,
+                **timings,
+            }
+
+    def clear(self) -> None:
+        """Removes all statistics."""
+        with self._lock:
+            self._timings = {name: (0, 0.0, 0.0) for name in ("lock_wait", "commit", "batched_write")}
+            self._batches = 0
+            self._batched_statements = 0
+            self._max_queue_depth = 0
+            self._overflows = 0
+
+    def _add(self, name: str, seconds: float) -> None:
+        count, total, maximum = self._timings[name]
+        self._timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+class GroupCommitter:
+    """Provides group commit of small writes from the threads of a worker process.
+
+    Statements are queued and a background thread runs them in batches on the writer connection,
+    each batch in a single transaction, so concurrent requests share one commit instead of taking the write lock
+    one after the other. A batch is committed when it holds max_batch statements, or window seconds after
+    its first statement was taken from the queue. Like the connection pool, the thread belongs to the process
+    that started it, a forked worker starts its own.
+    """
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        stats: WriterStats,
+        *,
+        window: float = 0.002,
+        max_batch: int = 64,
+        max_pending: int = 256,
+    ) -> None:
+        """Initializes the committer.
+
+        params:
+            pool: The pool of the writer connection.
+            stats: The statistics the batches are added to.
+            window (optional): Seconds to wait for more statements after the first one of a batch.
+            max_batch (optional): The maximum number of statements committed together.
+            max_pending (optional): The maximum number of statements queued, submit() fails when it is reached.
+
+        """
+        self._pool = pool
+        self._stats = stats
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def depth(self) -> int:
+        """Returns the number of statements waiting to be committed."""
+        return self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+
+    def submit(self, query: str, args: Sequence[Any]) -> Future:
+        """Queues a statement to be committed with the next batch.
+
+        raises: queue.Full if max_pending statements are already queued.
+
+        returns: A future for the rowid of the last row inserted by the statement.
+
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_pending)
+                self._pid = os.getpid()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                # Also replaces a thread that died, the statements it left in the queue are taken by the new one
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), name="group-commit", daemon=True)
+                self._thread.start()
+            future = Future()
+            self._queue.put_nowait((query, args, future, time.perf_counter()))
+        self._stats.add_queued(self._queue.qsize())
+        return future
+
+    def _run(self, pending: queue.Queue) -> None:
+        """Takes batches of statements from the queue and commits them, for as long as the process lives."""
+        while True:
+            batch = [pending.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(pending.get(timeout=max(deadline - time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+            # Statements whose caller gave up waiting are not run, see SQLite3.write_batched()
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._commit(batch)
+            except Exception as error:
+                logger.exception("Could not commit a batch of %d statements", len(batch))
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _commit(self, batch: list[tuple[str, Sequence[Any], Future, float]]) -> None:
+        """Runs a batch of statements in one transaction and resolves their futures."""
+        try:
+            start = time.perf_counter()
+            conn = self._pool.acquire()
+            self._stats.add_lock_wait(time.perf_counter() - start)
+        except Exception as error:
+            for _, _, future, _ in batch:
+                future.set_exception(error)
+            return
+        try:
+            start = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE;")
+            rowids = [conn.execute(query, args).lastrowid for query, args, _, _ in batch]
+            conn.commit()
+            self._stats.add_commit(time.perf_counter() - start)
+        except Exception:
+            # Any statement may fail, e.g. with an OverflowError for a parameter out of the range of SQLite
+            if conn.in_transaction:
+                conn.rollback()
+            # Run the statements one by one, so a single failing statement does not fail the others
+            for query, args, future, _ in batch:
+                try:
+                    future.set_result(conn.execute(query, args).lastrowid)
+                except Exception as error:
+                    future.set_exception(error)
+        else:
+            for rowid, (_, _, future, _) in zip(rowids, batch):
+                future.set_result(rowid)
+        finally:
+            self._pool.release(conn)
+        done = time.perf_counter()
+        self._stats.add_batch(len(batch), (done - queued for _, _, _, queued in batch))
+
+
+class SQLite3State:
+    """Holds the connection pools, statistics and group committer of the SQLite3 extension for one app.
+
+    SQLite3.init_app() stores it in app.extensions["sqlite3_state"], and the extension looks it up through
+    current_app, so every app has its own.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        *,
+        path: Optional[PathLike | str] = None,
+        migrations: Optional[PathLike | str] = None,
+    ) -> None:
+        """Creates the pools of an app from its configuration.
+
+        params:
+            app: The Flask application the state belongs to.
+            path (optional): The path to the database file. Is relative to the instance folder.
+            migrations (optional): The folder of migration files. Is relative to the application root folder.
+
+        """
+        if path:
+            self.path = Path(app.instance_path) / path
+        elif "SQLITE3_DATABASE_PATH" in app.config:
+            self.path = Path(app.instance_path) / app.config["SQLITE3_DATABASE_PATH"]
+        else:
+            self.path = Path(app.instance_path) / "sqlite3.db"
+
+        if not self.path.exists():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        pragmas = app.config.get("SQLITE3_PRAGMAS") or {}
+        # Readers cannot write by accident, a write outside the writer connection fails instead of taking the lock
+        self.pool = ConnectionPool(
+            self.path,
+            size=app.config.get("SQLITE3_POOL_SIZE", 8),
+            timeout=app.config.get("SQLITE3_POOL_TIMEOUT", 5.0),
+            pragmas={**pragmas, "query_only": "ON"},
+            cached_statements=app.config.get("SQLITE3_CACHED_STATEMENTS", 128),
+        )
+        self.writer_pool = ConnectionPool(
+            self.path,
+            size=1,
+            timeout=app.config.get("SQLITE3_WRITE_TIMEOUT", 10.0),
+            pragmas=pragmas,
+            cached_statements=app.config.get("SQLITE3_CACHED_STATEMENTS", 128),
+        )
+        self.shards = app.config.get("SQLITE3_SHARDS", 1)
+        self.shard_path = Path(app.instance_path) / app.config.get("SQLITE3_SHARD_PATH", "shards/shard-{index}.db")
+        self.shard_pools = []
+        if self.shards > 1:
+            self.shard_path.parent.mkdir(parents=True, exist_ok=True)
+            self.shard_pools = [
+                ConnectionPool(
+                    Path(str(self.shard_path).format(index=index)),
+                    size=app.config.get("SQLITE3_POOL_SIZE", 8),
+                    timeout=app.config.get("SQLITE3_POOL_TIMEOUT", 5.0),
+                    pragmas=pragmas,
+                    cached_statements=app.config.get("SQLITE3_CACHED_STATEMENTS", 128),
+                )
+                for index in range(self.shards)
+            ]
+        self.shard_executor = BoundedExecutor("shards", max_workers=app.config.get("SQLITE3_SHARD_WORKERS", 4))
+        self.writer_stats = WriterStats()
+        self.committer = GroupCommitter(
+            self.writer_pool,
+            self.writer_stats,
+            window=app.config.get("SQLITE3_GROUP_COMMIT_WINDOW", 0.002),
+            max_batch=app.config.get("SQLITE3_GROUP_COMMIT_MAX_BATCH", 64),
+            max_pending=app.config.get("SQLITE3_GROUP_COMMIT_MAX_PENDING", 256),
+        )
+        self.migrations = Path(app.root_path) / migrations if migrations else None
+        self.stats = QueryStats()
 
 
 class SQLite3:
@@ -34,9 +544,12 @@ class SQLite3:
         db = SQLite3(app)
 
         # Use the database
-        # db.query("SELECT * FROM Users;")
-        # db.query("SELECT * FROM Users WHERE id = 1;", one=True)
-        # db.query("INSERT INTO Users (name, email) VALUES ('John', 'test@test.net');")
+        # db.read("SELECT * FROM Users;")
+        # db.read("SELECT * FROM Users WHERE id = ?;", 1, one=True)
+        # db.write("INSERT INTO Users (name, email) VALUES (?, ?);", "John", "test@test.net")
+        # db.write_batched("INSERT INTO Comments (p_id, u_id, comment) VALUES (?, ?, ?);", 1, 1, "Hi")
+        # with db.transaction():
+        #     db.write_many("INSERT INTO Friends (u_id, f_id) VALUES (?, ?);", [(1, 2), (2, 1)])
     """
 
     def __init__(
@@ -44,32 +557,32 @@ class SQLite3:
         app: Optional[Flask] = None,
         *,
         path: Optional[PathLike | str] = None,
-        schema: Optional[PathLike | str] = None,
+        migrations: Optional[PathLike | str] = None,
     ) -> None:
         """Initializes the extension.
 
         params:
             app: The Flask application to initialize the extension with.
             path (optional): The path to the database file. Is relative to the instance folder.
-            schema (optional): The path to the schema file. Is relative to the application root folder.
+            migrations (optional): The folder of migration files. Is relative to the application root folder.
 
         """
         if app is not None:
-            self.init_app(app, path=path, schema=schema)
+            self.init_app(app, path=path, migrations=migrations)
 
     def init_app(
         self,
         app: Flask,
         *,
         path: Optional[PathLike | str] = None,
-        schema: Optional[PathLike | str] = None,
+        migrations: Optional[PathLike | str] = None,
     ) -> None:
         """Initializes the extension.
 
         params:
             app: The Flask application to initialize the extension with.
             path (optional): The path to the database file. Is relative to the instance folder.
-            schema (optional): The path to the schema file. Is relative to the application root folder.
+            migrations (optional): The folder of migration files. Is relative to the application root folder.
 
         """
         if not hasattr(app, "extensions"):
@@ -83,57 +596,608 @@ class SQLite3:
         if path == ":memory:" or app.config.get("SQLITE3_DATABASE_PATH") == ":memory:":
             raise ValueError("Cannot use in-memory database with Flask SQLite3 extension")
 
-        if path:
-            self._path = Path(app.instance_path) / path
-        elif "SQLITE3_DATABASE_PATH" in app.config:
-            self._path = Path(app.instance_path) / app.config["SQLITE3_DATABASE_PATH"]
-        else:
-            self._path = Path(app.instance_path) / "sqlite3.db"
-
-        if not self._path.exists():
-            self._path.parent.mkdir(parents=True, exist_ok=True)
+        # The pools and statistics belong to the app, so several apps in one process do not share them
+        state = app.extensions["sqlite3_state"] = SQLite3State(app, path=path, migrations=migrations)
+        app.teardown_appcontext(self._close_connection)
 
-        if schema:
+        if state.migrations is not None and app.config.get("SQLITE3_MIGRATE_ON_START", True):
             with app.app_context():
-                self._init_database(schema)
-        app.teardown_appcontext(self._close_connection)
+                self.migrate()
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    @property
+    def _state(self) -> SQLite3State:
+        """Returns the pools and statistics of the current app."""
+        return current_app.extensions["sqlite3_state"]
+
+    @property
+    def shards(self) -> int:
+        """Returns the number of shard files of the current app, 1 if the posts are not sharded."""
+        return self._state.shards
+
+    @property
+    def stats(self) -> QueryStats:
+        """Returns the statistics of the statements run by the requests of the current app."""
+        return self._state.stats
+
+    @property
+    def writer_stats(self) -> WriterStats:
+        """Returns the statistics of the writer connection of the current app."""
+        return self._state.writer_stats
 
     @property
     def connection(self) -> sqlite3.Connection:
-        """Returns the connection to the SQLite3 database."""
-        conn = getattr(g, "flask_sqlite3_connection", None)
+        """Returns the connection to the SQLite3 database for reads in the current app context.
+
+        Inside writer() or transaction() this is the writer connection, so reads are consistent with the writes
+        around them. Otherwise it is a read-only connection, checked out from the pool for the current app context.
+        """
+        conn = g.get("flask_sqlite3_writer")
+        if conn is not None:
+            return conn
+        conn = g.get("flask_sqlite3_connection")
         if conn is None:
-            conn = g.flask_sqlite3_connection = sqlite3.connect(self._path)
-            conn.row_factory = sqlite3.Row
+            conn = g.flask_sqlite3_connection = self._state.pool.acquire()
         return conn
 
-    def query(self, query: str, one: bool = False, *args) -> Any:
-        """Queries the database and returns the result.'
+    @property
+    def path(self) -> Path:
+        """Returns the path of the main database file."""
+        return self._state.path
+
+    def shard_path(self, index: int) -> Path:
+        """Returns the path of a shard file."""
+        return Path(str(self._state.shard_path).format(index=index))
+
+    def existing_shards(self) -> dict[int, Path]:
+        """Returns the path of every shard file that exists by index, including the ones beyond SQLITE3_SHARDS."""
+        prefix, _, suffix = self._state.shard_path.name.partition("{index}")
+        shards = {}
+        for path in self._state.shard_path.parent.glob(f"{prefix}*{suffix}"):
+            index = path.name[len(prefix) : len(path.name) - len(suffix)]
+            if index.isdigit() and self.shard_path(int(index)) == path:
+                shards[int(index)] = path
+        return shards
+
+    def open(self) -> None:
+        """Opens a read-only connection and the writer connection of the current app ahead of its first request."""
+        state = self._state
+        state.pool.release(state.pool.acquire())
+        state.writer_pool.release(state.writer_pool.acquire())
+
+    def close(self) -> None:
+        """Closes the idle connections of every pool of the current app, e.g. before the workers are forked."""
+        state = self._state
+        for pool in (state.pool, state.writer_pool, *state.shard_pools):
+            pool.close()
+
+    def close_shards(self) -> None:
+        """Closes the idle connections to the shard files, so none is left open on a file that is removed."""
+        for pool in self._state.shard_pools:
+            pool.close()
+
+    def migrate_shard(self, path: Path) -> list[str]:
+        """Creates a file with the schema of the shard files or applies its pending migrations.
+
+        Used for the shard files this app has no pool for, and for the archive files, see app/archive.py.
+
+        returns: The names of the migrations applied.
+
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            return self._apply_migrations(conn, self.shard_migrations())
+        finally:
+            conn.close()
+
+    def shard_of(self, user_id: int, shards: Optional[int] = None) -> int:
+        """Returns the index of the shard that holds the posts of a user.
+
+        params:
+            user_id: The id of the user.
+            shards (optional): The number of shards, defaults to SQLITE3_SHARDS.
+
+        """
+        # A fixed hash, unlike hash() it is the same in every process
+        return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % (shards or self.shards)
+
+    def read_shard(self, index: int, query: str, *args, one: bool = False) -> Any:
+        """Runs a query on a shard file and returns its rows, like read().
+
+        params:
+            index: The index of the shard.
+            query: The SQL query to execute.
+            args: The parameters of the query.
+            one (optional): Whether to fetch only the first row instead of a list of rows.
+
+        returns: A single row, a list of rows or None.
+
+        """
+        pool = self._state.shard_pools[index]
+        start = time.perf_counter()
+        rows = self._read_pool(pool, query, args, one)
+        self._record(query, args, start, (rows is not None) if one else len(rows), pool)
+        return rows
+
+    @contextmanager
+    def shard_transaction(self, index: int) -> Iterator[sqlite3.Connection]:
+        """Runs the enclosed statements on a shard file in a single transaction.
+
+        Unlike transaction(), shard transactions do not nest, and the connection is returned to the pool afterwards.
+        """
+        pool = self._state.shard_pools[index]
+        conn = pool.acquire()
+        start = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            self.writer_stats.add_commit(time.perf_counter() - start)
+        finally:
+            pool.release(conn)
+
+    def scatter(self, queries: Mapping[int, tuple[str, Sequence[Any]]]) -> dict[int, list[Any]]:
+        """Runs a query on each of several shard files in parallel, and returns the rows of each.
+
+        The queries run on the shards executor, or on the calling thread when the executor is saturated.
+
+        params:
+            queries: The query and parameters to run on each shard, by index of the shard.
+
+        returns: The rows of each query, by index of the shard.
+
+        """
+        state = self._state
+        futures = {}
+        for index, (query, args) in queries.items():
+            try:
+                futures[index] = state.shard_executor.submit(self._timed_read, state.shard_pools[index], query, args)
+            except ExecutorSaturated:
+                futures[index] = None
+        results = {}
+        for index, future in futures.items():
+            query, args = queries[index]
+            if future is None:
+                rows, duration = self._timed_read(state.shard_pools[index], query, args)
+            else:
+                rows, duration = future.result()
+            self._record(query, args, time.perf_counter() - duration, len(rows), state.shard_pools[index])
+            results[index] = rows
+        return results
+
+    def _timed_read(self, pool: ConnectionPool, query: str, args: Sequence[Any]) -> tuple[list[Any], float]:
+        """Returns the rows of a query on a connection of the pool, and how long it took."""
+        start = time.perf_counter()
+        return self._read_pool(pool, query, args, False), time.perf_counter() - start
+
+    @staticmethod
+    def _read_pool(pool: ConnectionPool, query: str, args: Sequence[Any], one: bool) -> Any:
+        """Runs a query on a connection of the pool and returns its rows."""
+        conn = pool.acquire()
+        try:
+            cursor = conn.execute(query, args)
+            try:
+                return cursor.fetchone() if one else cursor.fetchall()
+            finally:
+                cursor.close()
+        finally:
+            pool.release(conn)
+
+    @property
+    def queue_depth(self) -> int:
+        """Returns the number of statements of this worker waiting to be committed by write_batched()."""
+        return self._state.committer.depth
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Checks out the writer connection of this worker process for the enclosed statements.
+
+        A worker has a single writer connection, threads wait for it for up to SQLITE3_WRITE_TIMEOUT seconds.
+        Nested blocks share the connection. Statements on it are committed on their own unless they run inside
+        a transaction().
+
+        raises: RuntimeError if the writer connection is not free within the timeout.
+
+        """
+        conn = g.get("flask_sqlite3_writer")
+        if conn is not None:
+            yield conn
+            return
+        start = time.perf_counter()
+        conn = self._state.writer_pool.acquire()
+        self.writer_stats.add_lock_wait(time.perf_counter() - start)
+        g.flask_sqlite3_writer = conn
+        try:
+            yield conn
+        finally:
+            g.pop("flask_sqlite3_writer", None)
+            self._state.writer_pool.release(conn)
+
+    def read(self, query: str, *args, one: bool = False) -> Any:
+        """Runs a query and returns its rows without committing anything.
 
         params:
             query: The SQL query to execute.
-            one: Whether to return a single row or a list of rows.
-            args: Additional arguments to pass to the query.
+            args: The parameters of the query.
+            one (optional): Whether to fetch only the first row instead of a list of rows.
 
         returns: A single row, a list of rows or None.
 
         """
+        start = time.perf_counter()
         cursor = self.connection.execute(query, args)
-        response = cursor.fetchone() if one else cursor.fetchall()
-        cursor.close()
-        self.connection.commit()
+        try:
+            rows = cursor.fetchone() if one else cursor.fetchall()
+        finally:
+            cursor.close()
+        self._record(query, args, start, (rows is not None) if one else len(rows))
+        return rows
+
+    def iterate(self, query: str, *args, batch_size: Optional[int] = None) -> Iterator[Any]:
+        """Runs a query and yields its rows as they are fetched, instead of fetching them all first.
+
+        The query is run when the first row is requested. Its cursor, and the read snapshot it holds,
+        stay open until all rows have been yielded or the generator is closed, so the rows must be consumed
+        before the app context ends, e.g. while a streamed template is rendered.
+
+        params:
+            query: The SQL query to execute.
+            args: The parameters of the query.
+            batch_size (optional): The number of rows fetched at a time, defaults to SQLITE3_FETCH_SIZE.
+
+        returns: An iterator over the rows.
+
+        """
+        batch_size = batch_size or current_app.config.get("SQLITE3_FETCH_SIZE", 100)
+        # Only the time spent in SQLite3 is recorded, not the time spent rendering the rows in between
+        elapsed = 0.0
+        rows = 0
+        start = time.perf_counter()
+        cursor = self.connection.execute(query, args)
+        try:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                elapsed += time.perf_counter() - start
+                if not batch:
+                    break
+                rows += len(batch)
+                yield from batch
+                start = time.perf_counter()
+        finally:
+            cursor.close()
+            self._record(query, args, time.perf_counter() - elapsed, rows)
+
+    def write(self, query: str, *args) -> int:
+        """Runs a statement that changes the database.
+
+        The statement is committed immediately, unless it runs inside a transaction().
+
+        params:
+            query: The SQL statement to execute.
+            args: The parameters of the statement.
+
+        returns: The rowid of the last inserted row.
+
+        """
+        with self.writer() as conn:
+            start = time.perf_counter()
+            cursor = conn.execute(query, args)
+            try:
+                self._record(query, args, start, cursor.rowcount)
+                if not conn.in_transaction:
+                    self.writer_stats.add_commit(time.perf_counter() - start)
+                return cursor.lastrowid
+            finally:
+                cursor.close()
+
+    def write_batched(self, query: str, *args) -> int:
+        """Runs a small statement that changes the database, committed together with those of other threads.
+
+        The statement is queued for the group commit thread of the worker, which commits the statements queued
+        within SQLITE3_GROUP_COMMIT_WINDOW seconds in one transaction. The call returns once the statement has been
+        committed. Inside a transaction(), when SQLITE3_GROUP_COMMIT is disabled or when the queue is full,
+        the statement is run by write() instead.
+
+        params:
+            query: The SQL statement to execute.
+            args: The parameters of the statement.
+
+        raises: RuntimeError if the statement is not taken into a batch within SQLITE3_WRITE_TIMEOUT seconds.
+
+        returns: The rowid of the last inserted row.
+
+        """
+        if not current_app.config.get("SQLITE3_GROUP_COMMIT", False) or g.get("flask_sqlite3_writer") is not None:
+            return self.write(query, *args)
+        start = time.perf_counter()
+        try:
+            future = self._state.committer.submit(query, args)
+        except queue.Full:
+            self.writer_stats.add_overflow()
+            return self.write(query, *args)
+        timeout = current_app.config.get("SQLITE3_WRITE_TIMEOUT", 10.0)
+        try:
+            rowid = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise RuntimeError(f"The statement was not committed within {timeout} seconds") from None
+            # The batch holding the statement is being committed, its outcome is known shortly
+            rowid = future.result()
+        self._record(query, None, start, 1)
+        return rowid
+
+    def write_many(self, query: str, rows: Iterable[Sequence[Any]]) -> int:
+        """Runs a statement once for every row of parameters, e.g. for bulk inserts.
+
+        The statement is prepared once and all rows are committed together,
+        unless it runs inside a transaction().
+
+        params:
+            query: The SQL statement to execute.
+            rows: The parameters of the statement, one sequence per execution.
+
+        returns: The number of rows changed.
+
+        """
+        start = time.perf_counter()
+        with self.transaction() as conn:
+            cursor = conn.executemany(query, rows)
+            try:
+                self._record(query, None, start, cursor.rowcount)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Runs the enclosed statements in a single transaction.
+
+        The transaction takes the write lock up front (BEGIN IMMEDIATE), so reads inside it are consistent
+        with the writes that follow. It is committed when the block exits and rolled back on an exception.
+        Nested transactions join the outermost one.
+
+        Example:
+            with sqlite.transaction():
+                friend = sqlite.read("SELECT id FROM Users WHERE username = ?;", username, one=True)
+                sqlite.write("INSERT INTO Friends (u_id, f_id) VALUES (?, ?);", user_id, friend["id"])
+
+        """
+        with self.writer() as conn:
+            depth = g.get("flask_sqlite3_transaction_depth", 0)
+            start = time.perf_counter()
+            if depth == 0:
+                conn.execute("BEGIN IMMEDIATE;")
+            g.flask_sqlite3_transaction_depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0:
+                    conn.rollback()
+                raise
+            else:
+                if depth == 0:
+                    conn.commit()
+                    self.writer_stats.add_commit(time.perf_counter() - start)
+            finally:
+                g.flask_sqlite3_transaction_depth = depth
+
+    def migrate(self) -> list[str]:
+        """Applies the migrations that have not been applied to the database yet.
+
+        Migrations are the files named <version>_<description>.sql in the migrations folder, applied in order of
+        their version, each in its own transaction together with its row in the Migrations table.
+        PRAGMA user_version holds the version of the last one applied, so a current database costs a single read.
+        The write lock is taken before a migration is applied, so when several workers start at once
+        a migration is applied by the first one and skipped by the others.
+        When SQLITE3_SHARDS is above 1, the migrations in the shards/ subfolder are applied to every shard file.
+
+        returns: The names of the migrations applied.
+
+        """
+        with self.writer() as conn:
+            applied = self._apply_migrations(conn, self.migrations())
+        for index, pool in enumerate(self._state.shard_pools):
+            conn = pool.acquire()
+            try:
+                applied += [f"shard {index}: {name}" for name in self._apply_migrations(conn, self.shard_migrations())]
+            finally:
+                pool.release(conn)
+        return applied
+
+    def migrations(self) -> list[tuple[int, Path]]:
+        """Returns the version and path of every migration file, in the order they are applied."""
+        return self._migration_files(self._state.migrations)
+
+    def shard_migrations(self) -> list[tuple[int, Path]]:
+        """Returns the version and path of every migration file of the shard files, in the order they are applied."""
+        migrations = self._state.migrations
+        return self._migration_files(migrations / "shards" if migrations is not None else None)
+
+    def schema_version(self) -> int:
+        """Returns the version of the last migration applied to the database, 0 if none has been applied."""
+        return self.connection.execute("PRAGMA user_version;").fetchone()[0]
+
+    @staticmethod
+    def _migration_files(folder: Optional[Path]) -> list[tuple[int, Path]]:
+        """Returns the version and path of every migration file in a folder, ordered by version."""
+        if folder is None:
+            return []
+        migrations = []
+        for path in folder.glob("*.sql"):
+            version, _, _ = path.stem.partition("_")
+            if not version.isdigit():
+                raise ValueError(f"Migration {path.name} does not start with a version number")
+            migrations.append((int(version), path))
+        return sorted(migrations)
+
+    @staticmethod
+    def _apply_migrations(conn: sqlite3.Connection, migrations: list[tuple[int, Path]]) -> list[str]:
+        """Applies the migrations newer than the user_version of the database of a connection, returns their names."""
+        if not migrations or conn.execute("PRAGMA user_version;").fetchone()[0] >= migrations[-1][0]:
+            return []
+
+        create_migrations = """
+            CREATE TABLE IF NOT EXISTS Migrations (
+              version INTEGER PRIMARY KEY,
+              name VARCHAR NOT NULL,
+              applied_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        insert_migration = """
+            INSERT INTO Migrations (version, name)
+            VALUES (?, ?);
+            """
+        applied = []
+        adopted = False
+        busy_timeout = conn.execute("PRAGMA busy_timeout;").fetchone()[0]
+        # Wait for a migration applied by another process instead of failing with 'database is locked'
+        timeout = int(1000 * current_app.config.get("SQLITE3_MIGRATE_TIMEOUT", 60.0))
+        conn.execute(f"PRAGMA busy_timeout = {timeout};")
+        try:
+            for version, path in migrations:
+                conn.execute("BEGIN IMMEDIATE;")
+                try:
+                    if conn.execute("PRAGMA user_version;").fetchone()[0] >= version:
+                        conn.rollback()
+                        continue
+                    if not adopted:
+                        SQLite3._adopt_columns(conn, migrations[0][1])
+                        adopted = True
+                    conn.execute(create_migrations)
+                    for statement in split_statements(path.read_text(encoding="utf-8")):
+                        conn.execute(statement)
+                    conn.execute(insert_migration, (version, path.name))
+                    conn.execute(f"PRAGMA user_version = {version};")
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+                applied.append(path.name)
+        finally:
+            conn.execute(f"PRAGMA busy_timeout = {busy_timeout};")
+        return applied
+
+    @staticmethod
+    def _adopt_columns(conn: sqlite3.Connection, initial: Path) -> None:
+        """Adds the columns the initial migration declares to the existing tables that lack them.
+
+        The initial migration creates its tables IF NOT EXISTS, which leaves the tables of a database made by
+        the former schema.sql as they were, e.g. Posts without comment_count. Its tables are created in memory
+        and compared column by column, so such a database gets the columns the later migrations rely on.
+        """
+        scratch = sqlite3.connect(":memory:")
+        try:
+            for statement in split_statements(initial.read_text(encoding="utf-8")):
+                scratch.execute(statement)
+            tables = [row[0] for row in scratch.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+            declared = {table: scratch.execute(f"PRAGMA table_info([{table}]);").fetchall() for table in tables}
+        finally:
+            scratch.close()
+        for table, columns in declared.items():
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info([{table}]);")}
+            if not existing:
+                continue
+            for _, name, type_, notnull, default, _ in columns:
+                if name in existing:
+                    continue
+                definition = f"[{name}] {type_}"
+                if notnull:
+                    definition += " NOT NULL"
+                if default is not None:
+                    definition += f" DEFAULT {default}"
+                conn.execute(f"ALTER TABLE [{table}] ADD COLUMN {definition};")
+                logger.warning("Added the column %s.%s missing from a database made by schema.sql", table, name)
+
+    def _record(
+        self,
+        query: str,
+        args: Optional[Sequence[Any]],
+        start: float,
+        rows: int,
+        pool: Optional[ConnectionPool] = None,
+    ) -> None:
+        """Records a statement run by the current request, if the request is instrumented.
+
+        params:
+            query: The SQL statement.
+            args: The parameters of the statement, or None if its query plan cannot be captured.
+            start: The time.perf_counter() value from before the statement was run.
+            rows: The number of rows returned or changed.
+            pool (optional): The pool of the shard file the statement ran on, None for the main database.
+
+        """
+        statements = g.get("sqlite3_statements")
+        if statements is None:
+            return
+        duration = time.perf_counter() - start
+        plan = None
+        if args is not None and duration * 1000 >= current_app.config.get("SQLITE3_SLOW_STATEMENT_MS", 20.0):
+            plan = self._query_plan(query, args, pool)
+        statements.append({"query": " ".join(query.split()), "duration": duration, "rows": max(rows, 0), "plan": plan})
+
+    def _query_plan(
+        self, query: str, args: Sequence[Any], pool: Optional[ConnectionPool] = None
+    ) -> Optional[list[str]]:
+        """Returns the steps of the query plan of a statement, or None if it has none.
+
+        The plan is made on the database the statement ran on, a shard file if a pool is given.
+        """
+        conn = self.connection if pool is None else pool.acquire()
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {query.strip()}", args).fetchall()
+        except sqlite3.Error:
+            return None
+        finally:
+            if pool is not None:
+                pool.release(conn)
+        return [row["detail"] for row in rows]
+
+    def _start_request(self) -> None:
+        """Starts recording the statements of the request."""
+        if current_app.config.get("SQLITE3_INSTRUMENTATION", False):
+            g.sqlite3_statements = []
+
+    def _finish_request(self, response: Response) -> Response:
+        """Adds the Server-Timing header, logs slow requests and adds the statements to the route statistics."""
+        statements = g.pop("sqlite3_statements", None)
+        if statements is None:
+            return response
+        sql_time = 1000 * sum(statement["duration"] for statement in statements)
+        response.headers.add("Server-Timing", f'sql;dur={sql_time:.2f};desc="{len(statements)} statements"')
+        self.stats.add(f"{request.method} {request.endpoint}", statements)
+        if sql_time >= current_app.config.get("SQLITE3_SLOW_REQUEST_MS", 100.0):
+            details = "".join(
+                f"\n  {1000 * statement['duration']:8.2f} ms {statement['rows']:6} rows  {statement['query']}"
+                + "".join(f"\n    {step}" for step in statement["plan"] or ())
+                for statement in statements
+            )
+            logger.warning(
+                "Slow request %s %s: %d statements took %.2f ms%s",
+                request.method,
+                request.path,
+                len(statements),
+                sql_time,
+                details,
+            )
         return response
 
-    # TODO: Add more specific query methods to simplify code
+    def release(self) -> None:
+        """Returns the read-only connection of the app context to the pool before the context ends.
 
-    def _init_database(self, schema: PathLike | str) -> None:
-        """Initializes the database with the supplied schema if it does not exist yet."""
-        with current_app.open_resource(str(schema), mode="r") as file:
-            self.connection.executescript(file.read())
-            self.connection.commit()
+        Used before a long-lived streamed response, which would otherwise hold a connection until it ends.
+        A later statement in the same context checks out a connection again.
+        """
+        conn = g.pop("flask_sqlite3_connection", None)
+        if conn is not None:
+            self._state.pool.release(conn)
 
     def _close_connection(self, exception: Optional[BaseException] = None) -> None:
-        """Closes the connection to the database."""
-        conn = cast(sqlite3.Connection, getattr(g, "flask_sqlite3_connection", None))
-        if conn is not None:
-            conn.close()
+        """Returns the connection of the app context to the pool."""
+        self.release()
@@ -0,0 +1,327 @@
+"""Provides Server-Sent Events for the new posts and comments of the Social Insecurity application.
+
+The stream and comments pages subscribe to /events/<username>, and new post or comment cards are pushed to them
+instead of the user reloading the whole page. A worker that inserts a post or comment publishes it by adding a row
+to the Events table, see app/migrations/0005_events.sql. Every worker with subscribers polls that table on a
+background thread and hands each new event to the subscribers that may see its post, so events reach the
+subscribers of all workers.
+
+Each subscriber has a bounded queue. A subscriber that does not keep up is sent an 'overflow' event and
+disconnected, instead of the queue growing without bound. The number of subscribers of a worker is capped
+by EVENTS_MAX_SUBSCRIBERS, since every open event stream occupies a thread of the worker until it ends.
+
+Example:
+    post_id = sqlite.write("INSERT INTO Posts (u_id, content) VALUES (?, ?);", user_id, content)
+    hub.publish("post", post_id)
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, Optional
+
+from flask import Flask, current_app
+from markupsafe import Markup
+
+from app import sqlite
+from app.fragments import render_post_cards
+
+logger = logging.getLogger(__name__)
+
+# Events are pruned by the worker publishing every PRUNE_EVERY-th event
+PRUNE_EVERY = 100
+
+
+class TooManySubscribers(RuntimeError):
+    """Raised when a worker already has the maximum number of event subscribers."""
+
+
+class Subscriber:
+    """Provides the queue of events for one event stream.
+
+    An event stream of the stream page (post_id None) receives the new posts the user may see,
+    one of a comments page receives the new comments of its post.
+    """
+
+    def __init__(self, user_id: int, post_id: Optional[int], max_queued: int) -> None:
+        """Initializes the subscriber.
+
+        params:
+            user_id: The id of the subscribed user.
+            post_id: The id of the post whose comments are received, or None to receive new posts.
+            max_queued: The number of events that may wait to be sent before the subscriber overflows.
+
+        """
+        self.user_id = user_id
+        self.post_id = post_id
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.overflowed = False
+
+    def wants(self, kind: str, post_id: int) -> bool:
+        """Returns whether the subscriber receives an event of this kind for this post."""
+        if self.post_id is None:
+            return kind == "post"
+        return kind == "comment" and post_id == self.post_id
+
+    def deliver(self, event: tuple[int, str, Any]) -> None:
+        """Queues an event, or replaces the queued events with the overflow marker None if the queue is full."""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.queue.put_nowait(None)
+
+
+class EventHub:
+    """Provides the publish/subscribe hub of a worker process.
+
+    The polling thread is started by the first subscriber and stops when the last one has left.
+    Like the background executors, the hub belongs to the process that created it, a forked worker starts empty.
+    """
+
+    def __init__(self) -> None:
+        """Initializes the hub."""
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._subscribers: dict[int, set[Subscriber]] = {}
+        self._count = 0
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def subscribers(self) -> int:
+        """Returns the number of subscribers of this worker."""
+        return self._count if self._pid == os.getpid() else 0
+
+    def subscribe(self, user_id: int, post_id: Optional[int] = None) -> Subscriber:
+        """Adds a subscriber, and starts polling for events if it is the first one.
+
+        raises: TooManySubscribers if the worker already has EVENTS_MAX_SUBSCRIBERS subscribers.
+
+        returns: The subscriber, which must be passed to unsubscribe() when its event stream ends.
+
+        """
+        subscriber = Subscriber(user_id, post_id, current_app.config["EVENTS_MAX_QUEUED"])
+        with self._lock:
+            if self._pid != os.getpid():
+                self._subscribers, self._count, self._thread, self._pid = {}, 0, None, os.getpid()
+            if self._count >= current_app.config["EVENTS_MAX_SUBSCRIBERS"]:
+                raise TooManySubscribers(f"The worker already has {self._count} event subscribers")
+            if self._thread is None:
+                # Start after the newest event, anything older is replayed by the event stream itself
+                self._thread = threading.Thread(
+                    target=self._poll,
+                    args=(current_app._get_current_object(), last_event_id()),
+                    name="events",
+                    daemon=True,
+                )
+                self._thread.start()
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            self._count += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        """Removes a subscriber."""
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user_id)
+            if subscribers is None or subscriber not in subscribers:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[subscriber.user_id]
+            self._count -= 1
+
+    def publish(self, kind: str, post_id: int, comment_id: Optional[int] = None) -> int:
+        """Publishes a new post or comment to the subscribers of all workers.
+
+        params:
+            kind: 'post' or 'comment'.
+            post_id: The id of the new post, or of the post that was commented on.
+            comment_id (optional): The id of the new comment.
+
+        returns: The id of the event.
+
+        """
+        insert_event = """
+            INSERT INTO Events (kind, p_id, c_id)
+            VALUES (?, ?, ?);
+            """
+        event_id = sqlite.write_batched(insert_event, kind, post_id, comment_id)
+        if event_id % PRUNE_EVERY == 0:
+            sqlite.write("DELETE FROM Events WHERE id <= ?;", event_id - current_app.config["EVENTS_KEPT"])
+        # The subscribers of this worker get the event right away, the other workers on their next poll
+        self._wake.set()
+        return event_id
+
+    def _poll(self, app: Flask, last_id: int) -> None:
+        """Delivers the new events to the subscribers of this worker until there are none left."""
+        while True:
+            self._wake.wait(app.config["EVENTS_POLL_INTERVAL"])
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                with app.app_context():
+                    last_id = self._dispatch(last_id)
+            except Exception:
+                logger.exception("Could not deliver the events after %d", last_id)
+                time.sleep(app.config["EVENTS_POLL_INTERVAL"])
+
+    def _dispatch(self, last_id: int) -> int:
+        """Delivers the events after last_id to the subscribers that may see them, returns the last event id."""
+        get_events = """
+            SELECT id, kind, p_id, c_id
+            FROM Events
+            WHERE id > ?
+            ORDER BY id
+            LIMIT 100;
+            """
+        get_viewers = """
+            SELECT u_id
+            FROM Timelines
+            WHERE p_id = ?;
+            """
+        for event in sqlite.read(get_events, last_id):
+            last_id = event["id"]
+            with self._lock:
+                local = set(self._subscribers)
+            if not local:
+                continue
+            # The users that may see a post are the ones whose timeline holds it
+            viewers = local.intersection(row["u_id"] for row in sqlite.read(get_viewers, event["p_id"]))
+            with self._lock:
+                targets = [
+                    subscriber
+                    for user_id in viewers
+                    for subscriber in self._subscribers.get(user_id, ())
+                    if subscriber.wants(event["kind"], event["p_id"])
+                ]
+            if not targets:
+                continue
+            row = load_event_row(event)
+            if row is None:
+                continue
+            for subscriber in targets:
+                subscriber.deliver((event["id"], event["kind"], row))
+        return last_id
+
+
+hub = EventHub()
+
+
+def last_event_id() -> int:
+    """Returns the id of the newest event, 0 if there is none."""
+    return sqlite.read("SELECT COALESCE(MAX(id), 0) FROM Events;", one=True)[0]
+
+
+def replay(user_id: int, post_id: Optional[int], after: int, limit: int) -> list[tuple[int, str, Any]]:
+    """Returns the events after an event id that a subscriber would have received, oldest first.
+
+    params:
+        user_id: The id of the subscribed user.
+        post_id: The id of the post whose comments are received, or None for new posts.
+        after: The id of the last event the subscriber has seen.
+        limit: The maximum number of events returned.
+
+    returns: The (event id, kind, row) of each event.
+
+    """
+    get_events = """
+        SELECT e.id, e.kind, e.p_id, e.c_id
+        FROM Events AS e
+        WHERE e.id > ? AND e.kind = ? AND (? IS NULL OR e.p_id = ?)
+          AND EXISTS (SELECT 1 FROM Timelines AS t WHERE t.p_id = e.p_id AND t.u_id = ?)
+        ORDER BY e.id
+        LIMIT ?;
+        """
+    kind = "post" if post_id is None else "comment"
+    events = []
+    for event in sqlite.read(get_events, after, kind, post_id, post_id, user_id, limit):
+        row = load_event_row(event)
+        if row is not None:
+            events.append((event["id"], event["kind"], row))
+    return events
+
+
+def load_event_row(event: Any) -> Any:
+    """Returns the row of the post or comment of an event, joined with the row of its author."""
+    if event["kind"] == "post":
+        get_post = """
+            SELECT p.*, u.*
+            FROM Posts AS p JOIN Users AS u ON u.id = p.u_id
+            WHERE p.id = ?;
+            """
+        return sqlite.read(get_post, event["p_id"], one=True)
+    get_comment = """
+        SELECT c.*, u.*
+        FROM Comments AS c JOIN Users AS u ON u.id = c.u_id
+        WHERE c.id = ?;
+        """
+    return sqlite.read(get_comment, event["c_id"], one=True)
+
+
+def event_stream(subscriber: Subscriber, after: int, events: list[tuple[int, str, Any]]) -> Iterator[str]:
+    """Yields the Server-Sent Events of a subscriber until EVENTS_MAX_AGE has passed.
+
+    The browser reconnects after the stream ends, with the id of the last event it received,
+    so a stream can be ended at any time without losing events.
+
+    params:
+        subscriber: The subscriber, unsubscribed when the stream ends.
+        after: The id of the last event the browser has seen, older events are not sent.
+        events: The replayed events after that one, sent before the new ones.
+
+    """
+    try:
+        yield f"retry: {int(1000 * current_app.config['EVENTS_RETRY'])}\n\n"
+        # Missed more events than a subscriber may have queued, the page has to be reloaded instead
+        if len(events) > current_app.config["EVENTS_MAX_QUEUED"]:
+            yield "event: overflow\ndata:\n\n"
+            return
+        last_id = after
+        for event in events:
+            last_id = event[0]
+            yield _format(event)
+        deadline = time.monotonic() + current_app.config["EVENTS_MAX_AGE"]
+        while time.monotonic() < deadline:
+            timeout = min(current_app.config["EVENTS_HEARTBEAT"], deadline - time.monotonic())
+            try:
+                event = subscriber.queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection, and notices a browser that went away
+                yield ": heartbeat\n\n"
+                continue
+            if event is None:
+                yield "event: overflow\ndata:\n\n"
+                return
+            if event[0] <= last_id:
+                continue
+            last_id = event[0]
+            yield _format(event)
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+def _format(event: tuple[int, str, Any]) -> str:
+    """Returns an event as a Server-Sent Event whose data is the rendered card."""
+    event_id, kind, row = event
+    if kind == "post":
+        card = next(render_post_cards([row]))
+    else:
+        card = Markup(current_app.jinja_env.get_template("comment_card.html.j2").render(comment=row))
+    data = "".join(f"data: {line}\n" for line in card.splitlines())
+    return f"id: {event_id}\nevent: {kind}\n{data}\n"
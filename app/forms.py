@@ -86,6 +86,16 @@ class FriendsForm(FlaskForm):
     submit = SubmitField(label="Add Friend")
 
 
+class SearchForm(FlaskForm):
+    """Provides the search form for the application, it is submitted with GET so results can be linked to."""
+
+    class Meta:
+        csrf = False
+
+    q = StringField(label="Search", render_kw={"placeholder": "Search posts and comments"}, validators=[InputRequired(message='Please type something to search for')])
+    submit = SubmitField(label="Search")
+
+
 class ProfileForm(FlaskForm):
     """Provides the profile form for the application."""
 
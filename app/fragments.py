@@ -0,0 +1,98 @@
+"""Provides a cache of rendered template fragments for the Social Insecurity application.
+
+Rendering the post cards is most of the work of the stream page, and the same cards are rendered again
+on every refresh. The rendered HTML of each card is cached per post, and reused by every viewer as long as the post
+has not changed, so a large feed is mostly a join of cached strings. A card must therefore not depend on its viewer,
+e.g. its comments link goes through /post/<post_id>, which redirects to the comments page of the viewer.
+
+Example:
+    cards = render_post_cards(posts)
+    return render_template("stream.html.j2", cards=cards)
+"""
+
+from __future__ import annotations
+
+import threading
+from collections.abc import Iterable, Iterator, Mapping
+from typing import Any
+
+from flask import Flask, current_app
+from markupsafe import Markup
+
+from app.cache import LRUCache
+
+
+class FragmentCache:
+    """Provides a size-bounded cache of rendered fragments, keyed by the id of what they show.
+
+    Each entry holds a version and the fragment rendered for that version,
+    which is only reused when the version matches.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        """Initializes the cache.
+
+        params:
+            maxsize: The maximum number of fragments kept, the least recently used are evicted first.
+
+        """
+        self._fragments = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, version: Any) -> Markup | None:
+        """Returns the fragment rendered at the given version, or None."""
+        entry = self._fragments.get(key)
+        fragment = entry[1] if entry is not None and entry[0] == version else None
+        with self._lock:
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return fragment
+
+    def set(self, key: Any, version: Any, fragment: Markup) -> None:
+        """Caches the fragment rendered at the given version."""
+        self._fragments.set(key, (version, fragment))
+
+    def invalidate(self, key: Any) -> None:
+        """Removes a fragment."""
+        self._fragments.discard(key)
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit and miss counters and the number of fragments in the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "fragments": len(self._fragments),
+            "maxsize": self._fragments.maxsize,
+        }
+
+
+def init_app(app: Flask) -> None:
+    """Creates the post card cache of the app, sized from its configuration."""
+    app.extensions["post_cards"] = FragmentCache(maxsize=app.config["FRAGMENT_CACHE_SIZE"])
+
+
+def render_post_cards(posts: Iterable[Mapping[str, Any]]) -> Iterator[Markup]:
+    """Yields the rendered card of each post, from the cache when possible.
+
+    params:
+        posts: The rows of the posts, joined with the rows of their authors.
+
+    """
+    template = current_app.jinja_env.get_template("post_card.html.j2")
+    post_cards = current_app.extensions["post_cards"]
+    for post in posts:
+        version = (post["comment_count"], post["image"])
+        card = post_cards.get(post["id"], version)
+        if card is None:
+            card = Markup(template.render(post=post))
+            post_cards.set(post["id"], version, card)
+        yield card
+
+
+def invalidate_post(post_id: int) -> None:
+    """Removes the cached cards of a post after it changed, e.g. when it was commented on."""
+    current_app.extensions["post_cards"].invalidate(post_id)
@@ -0,0 +1,153 @@
+"""Provides an in-memory friendship graph for the Social Insecurity application.
+
+The graph holds the Friends table as adjacency sets, so checking if two users are mutual friends
+does not need a query. It is reloaded when the 'friends' version counter changes,
+which keeps every gunicorn worker consistent with the database.
+
+Example:
+    from flask import Flask
+    from app.graph import FriendGraph
+
+    app = Flask(__name__)
+    friend_graph = FriendGraph(app)
+
+    # Use the graph
+    # friend_graph.are_mutual(1, 2)
+    # friend_graph.mutual_friends(1)
+"""
+
+from __future__ import annotations
+
+import threading
+from collections.abc import Iterable, Iterator
+from typing import Optional
+
+from flask import Flask, current_app
+
+from app import versions
+
+
+class FriendGraphState:
+    """Holds the graph of one app and the version of the Friends table it was loaded at.
+
+    FriendGraph.init_app() stores it in app.extensions["friend_graph_state"], and the extension looks it up
+    through current_app, so every app has its own.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.following: dict[int, frozenset[int]] = {}
+        self.version: Optional[int] = None
+
+
+class FriendGraph:
+    """Provides the friendship graph as an extension for Flask.
+
+    The graph stores, for every user, the frozen set of users they have added as friends.
+    A friendship is mutual when both users have added each other.
+    """
+
+    def __init__(self, app: Optional[Flask] = None) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+
+        """
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Initializes the extension.
+
+        params:
+            app: The Flask application to initialize the extension with.
+
+        """
+        if not hasattr(app, "extensions"):
+            app.extensions = {}
+
+        if "friend_graph" not in app.extensions:
+            app.extensions["friend_graph"] = self
+        else:
+            raise RuntimeError("Flask FriendGraph extension already initialized")
+        app.extensions["friend_graph_state"] = FriendGraphState()
+
+    def follows(self, u_id: int, f_id: int) -> bool:
+        """Returns whether the user u_id has added f_id as a friend."""
+        return f_id in self._graph().get(u_id, ())
+
+    def are_mutual(self, a: int, b: int) -> bool:
+        """Returns whether the users a and b have added each other as friends."""
+        following = self._graph()
+        return b in following.get(a, ()) and a in following.get(b, ())
+
+    def mutual_friends(self, u_id: int) -> set[int]:
+        """Returns the ids of all users that are mutual friends with the user u_id."""
+        following = self._graph()
+        return {f_id for f_id in following.get(u_id, ()) if f_id != u_id and u_id in following.get(f_id, ())}
+
+    def edges(self, user_ids: Optional[Iterable[int]] = None) -> Iterator[tuple[int, int, bool]]:
+        """Yields the (u_id, f_id, mutual) friendships added by the given users, or by all users, ordered by u_id.
+
+        params:
+            user_ids (optional): The ids of the users whose friendships are yielded, all users if None.
+
+        """
+        following = self._graph()
+        for u_id in sorted(following if user_ids is None else set(user_ids)):
+            for f_id in sorted(following.get(u_id, ())):
+                yield u_id, f_id, u_id in following.get(f_id, ())
+
+    def add(self, u_id: int, f_id: int) -> None:
+        """Updates the graph after the row (u_id, f_id) was inserted into the Friends table.
+
+        The edge is applied in place when no other change happened since the graph was loaded,
+        otherwise the whole graph is reloaded on the next lookup.
+        """
+        versions.refresh()
+        version = versions.get("friends")
+        state = self._state
+        with state.lock:
+            if state.version is not None and version == state.version + 1:
+                # Replacing a single entry is atomic, readers see either the old or the new set
+                state.following[u_id] = state.following.get(u_id, frozenset()) | {f_id}
+                state.version = version
+            else:
+                state.version = None
+
+    def load(self) -> None:
+        """Loads the graph now if it is not current, instead of on the next lookup."""
+        self._graph()
+
+    def invalidate(self) -> None:
+        """Forces the graph to be reloaded on the next lookup."""
+        state = self._state
+        with state.lock:
+            state.version = None
+
+    @property
+    def _state(self) -> FriendGraphState:
+        """Returns the graph of the current app."""
+        return current_app.extensions["friend_graph_state"]
+
+    def _graph(self) -> dict[int, frozenset[int]]:
+        """Returns the adjacency sets, reloading them if the Friends table has changed."""
+        version = versions.get("friends")
+        if version != self._state.version:
+            self._load(version)
+        return self._state.following
+
+    def _load(self, version: int) -> None:
+        """Loads the whole Friends table into memory."""
+        get_friends = """
+            SELECT u_id, f_id
+            FROM Friends;
+            """
+        adjacency: dict[int, set[int]] = {}
+        for row in current_app.extensions["sqlite3"].read(get_friends):
+            adjacency.setdefault(row["u_id"], set()).add(row["f_id"])
+        following = {u_id: frozenset(f_ids) for u_id, f_ids in adjacency.items()}
+        state = self._state
+        with state.lock:
+            state.following, state.version = following, version
@@ -0,0 +1,128 @@
+"""Provides downscaled variants of uploaded images for the Social Insecurity application.
+
+After an image is stored, a background executor writes smaller variants of it next to the original,
+e.g. 'feed' for the stream and 'medium' for the comments page, as configured in IMAGE_VARIANTS.
+Until a variant has been written, or if the original is already small enough, the original is served instead.
+
+Example:
+    $ flask images backfill
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+from PIL import Image, ImageOps
+
+from app import sqlite, storage
+from app.workers import BoundedExecutor, ExecutorSaturated
+
+logger = logging.getLogger(__name__)
+
+images_cli = AppGroup("images", help="Manage the downscaled variants of uploaded images.")
+
+
+def init_app(app: Flask) -> None:
+    """Creates the image executor of the app, sized from its configuration."""
+    app.extensions["image_executor"] = BoundedExecutor(
+        "images",
+        max_workers=app.config["IMAGE_WORKERS"],
+        max_pending=app.config["IMAGE_MAX_PENDING"],
+    )
+
+
+def variant_path(filename: str, variant: str) -> Path:
+    """Returns the path of a variant of a stored image, e.g. <hash>.feed.jpg next to <hash>.jpg."""
+    path = storage.resolve(filename)
+    return path.with_name(f"{path.stem}.{variant}{path.suffix}")
+
+
+def resolve_variant(filename: str, variant: Optional[str]) -> Path:
+    """Returns the path of the variant if it exists, otherwise the path of the original image."""
+    if variant in current_app.config["IMAGE_VARIANTS"]:
+        path = variant_path(filename, variant)
+        if path.exists():
+            return path
+    return storage.resolve(filename)
+
+
+def schedule_variants(filename: str) -> None:
+    """Queues the creation of all variants of a stored image on the background executor.
+
+    If the executor is saturated the variants are skipped, 'flask images backfill' creates them later.
+    """
+    original, targets = _targets(filename)
+    try:
+        current_app.extensions["image_executor"].submit(make_variants, original, targets)
+    except ExecutorSaturated:
+        logger.warning("Skipped image variants of %s, the image executor is saturated", filename)
+
+
+def make_variants(original: Path, targets: dict[Path, tuple[int, int]]) -> int:
+    """Writes the variants of an image that do not exist yet.
+
+    Variants are written to a temporary file and renamed, so a half-written variant is never served.
+    Images that already fit within a variant's size get no file for that variant.
+
+    params:
+        original: The path of the original image.
+        targets: The path and maximum (width, height) of each variant.
+
+    returns: The number of variants written.
+
+    """
+    written = 0
+    try:
+        with Image.open(original) as opened:
+            image_format = opened.format
+            # Apply the EXIF orientation, since the variants are saved without the EXIF data
+            image = ImageOps.exif_transpose(opened)
+            if image.mode == "P":
+                image = image.convert("RGBA")
+            for path, size in targets.items():
+                if path.exists() or (image.width <= size[0] and image.height <= size[1]):
+                    continue
+                variant = image.copy()
+                variant.thumbnail(size)
+                if image_format == "JPEG" and variant.mode not in ("RGB", "L"):
+                    variant = variant.convert("RGB")
+                temporary = path.with_name(f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+                variant.save(temporary, format=image_format, quality=85)
+                os.replace(temporary, path)
+                written += 1
+    except (OSError, Image.DecompressionBombError) as error:
+        logger.warning("Could not create the image variants of %s: %s", original, error)
+    return written
+
+
+def _targets(filename: str) -> tuple[Path, dict[Path, tuple[int, int]]]:
+    """Returns the path of an image and the path and size of each of its variants."""
+    variants = current_app.config["IMAGE_VARIANTS"]
+    targets = {variant_path(filename, variant): tuple(size) for variant, size in variants.items()}
+    return storage.resolve(filename), targets
+
+
+@images_cli.command("backfill")
+def backfill_command() -> None:
+    """Create the missing variants of all images that have been posted."""
+    get_images = """
+        SELECT DISTINCT image
+        FROM Posts
+        WHERE image IS NOT NULL AND image != '';
+        """
+    images = sqlite.read(get_images)
+    written = 0
+    for number, row in enumerate(images, start=1):
+        original, targets = _targets(row["image"])
+        if original.exists():
+            written += make_variants(original, targets)
+        if number % 100 == 0:
+            click.echo(f"Processed {number} of {len(images)} images...")
+    click.echo(f"Created {written} variants of {len(images)} images.")
@@ -0,0 +1,206 @@
+-- Initial schema. Every object is created IF NOT EXISTS, so a database made by the former schema.sql,
+-- which dropped and recreated all tables on every start, is adopted as it is.
+
+-- ---
+-- Globals
+-- ---
+-- SET SQL_MODE="NO_AUTO_VALUE_ON_ZERO";
+-- SET FOREIGN_KEY_CHECKS=0;
+-- ---
+-- Table 'Users'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Users] (
+  id INTEGER PRIMARY KEY,
+  username VARCHAR,
+  first_name VARCHAR,
+  last_name VARCHAR,
+  [password] VARCHAR,
+  education VARCHAR DEFAULT 'Unknown',
+  employment VARCHAR DEFAULT 'Unknown',
+  music VARCHAR DEFAULT 'Unknown',
+  movie VARCHAR DEFAULT 'Unknown',
+  nationality VARCHAR DEFAULT 'Unknown',
+  birthday DATE DEFAULT 'Unknown',
+  hash_salt VARCHAR
+);
+
+-- ---
+-- Table 'Posts'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Posts](
+  id INTEGER PRIMARY KEY,
+  u_id INTEGER,
+  content INTEGER,
+  [image] VARCHAR,
+  [creation_time] DATETIME,
+  comment_count INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (u_id) REFERENCES [Users](id)
+);
+
+-- Keyset pagination of the stream walks these in (creation_time, id) order
+CREATE INDEX IF NOT EXISTS [PostsByTime] ON [Posts](creation_time, id);
+CREATE INDEX IF NOT EXISTS [PostsByAuthor] ON [Posts](u_id, creation_time, id);
+-- Owner lookup when serving uploaded images
+CREATE INDEX IF NOT EXISTS [PostsByImage] ON [Posts]([image]);
+
+-- ---
+-- Table 'Friends'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Friends](
+  u_id INTEGER NOT NULL REFERENCES Users,
+  f_id INTEGER NOT NULL REFERENCES Users,
+  PRIMARY KEY(u_id, f_id),
+  FOREIGN KEY (u_id) REFERENCES [Users](id),
+  FOREIGN KEY (f_id) REFERENCES [Users](id)
+);
+
+-- Reverse lookup for the mutual friendship checks (who has added this user)
+CREATE INDEX IF NOT EXISTS [FriendsByFriend] ON [Friends](f_id, u_id);
+
+-- ---
+-- Table 'Comments'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Comments](
+  id INTEGER PRIMARY KEY,
+  p_id INTEGER,
+  u_id INTEGER,
+  comment VARCHAR,
+  [creation_time] DATETIME,
+  FOREIGN KEY (p_id) REFERENCES Posts(id),
+  FOREIGN KEY (u_id) REFERENCES Users(id)
+);
+
+-- Comments of a post, in the order they are shown
+CREATE INDEX IF NOT EXISTS [CommentsByPost] ON [Comments](p_id, creation_time);
+
+-- Keep the denormalized Posts.comment_count up to date
+CREATE TRIGGER IF NOT EXISTS [CommentCountInsert] AFTER INSERT ON [Comments]
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count + 1 WHERE id = NEW.p_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentCountDelete] AFTER DELETE ON [Comments]
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count - 1 WHERE id = OLD.p_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentCountMove] AFTER UPDATE OF p_id ON [Comments]
+WHEN NEW.p_id IS NOT OLD.p_id
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count - 1 WHERE id = OLD.p_id;
+  UPDATE [Posts] SET comment_count = comment_count + 1 WHERE id = NEW.p_id;
+END;
+
+-- ---
+-- Table 'Timelines'
+-- Precomputed stream of each user, holds the posts of the user and their mutual friends
+-- ---
+CREATE TABLE IF NOT EXISTS [Timelines](
+  u_id INTEGER NOT NULL,
+  p_id INTEGER NOT NULL,
+  [creation_time] DATETIME,
+  PRIMARY KEY(u_id, creation_time, p_id),
+  FOREIGN KEY (u_id) REFERENCES [Users](id),
+  FOREIGN KEY (p_id) REFERENCES [Posts](id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS [TimelinesByPost] ON [Timelines](p_id);
+
+-- Push a new post into the timelines of the author and their mutual friends
+CREATE TRIGGER IF NOT EXISTS [TimelinesFanOut] AFTER INSERT ON [Posts]
+BEGIN
+  INSERT OR IGNORE INTO [Timelines] (u_id, p_id, creation_time)
+  SELECT NEW.u_id, NEW.id, NEW.creation_time
+  UNION ALL
+  SELECT f.f_id, NEW.id, NEW.creation_time
+  FROM [Friends] AS f JOIN [Friends] AS r ON r.u_id = f.f_id AND r.f_id = f.u_id
+  WHERE f.u_id = NEW.u_id AND f.f_id != NEW.u_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [TimelinesPostDeleted] AFTER DELETE ON [Posts]
+BEGIN
+  DELETE FROM [Timelines] WHERE p_id = OLD.id;
+END;
+
+-- A friendship becomes mutual when the reverse row already exists, backfill both timelines
+CREATE TRIGGER IF NOT EXISTS [TimelinesBackfill] AFTER INSERT ON [Friends]
+WHEN NEW.u_id != NEW.f_id AND EXISTS (SELECT 1 FROM [Friends] WHERE u_id = NEW.f_id AND f_id = NEW.u_id)
+BEGIN
+  INSERT OR IGNORE INTO [Timelines] (u_id, p_id, creation_time)
+  SELECT NEW.u_id, id, creation_time FROM [Posts] WHERE u_id = NEW.f_id
+  UNION ALL
+  SELECT NEW.f_id, id, creation_time FROM [Posts] WHERE u_id = NEW.u_id;
+END;
+
+-- Removing either direction ends the mutual friendship, prune both timelines
+CREATE TRIGGER IF NOT EXISTS [TimelinesPrune] AFTER DELETE ON [Friends]
+WHEN OLD.u_id != OLD.f_id
+BEGIN
+  DELETE FROM [Timelines] WHERE u_id = OLD.u_id AND p_id IN (SELECT id FROM [Posts] WHERE u_id = OLD.f_id);
+  DELETE FROM [Timelines] WHERE u_id = OLD.f_id AND p_id IN (SELECT id FROM [Posts] WHERE u_id = OLD.u_id);
+END;
+
+-- ---
+-- Table 'Versions'
+-- Counters that are bumped on every change to a table, used to invalidate caches held by the app workers
+-- ---
+CREATE TABLE IF NOT EXISTS [Versions](
+  name VARCHAR PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO [Versions] (name) VALUES ('friends'), ('users'), ('posts'), ('comments');
+
+CREATE TRIGGER IF NOT EXISTS [VersionsFriendsInsert] AFTER INSERT ON [Friends]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'friends';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsFriendsDelete] AFTER DELETE ON [Friends]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'friends';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsUsersUpdate] AFTER UPDATE ON [Users]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsUsersDelete] AFTER DELETE ON [Users]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsInsert] AFTER INSERT ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsUpdate] AFTER UPDATE ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsDelete] AFTER DELETE ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsInsert] AFTER INSERT ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsUpdate] AFTER UPDATE ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsDelete] AFTER DELETE ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
@@ -0,0 +1,2 @@
+-- Logins and registrations look up users by username, which scanned the whole Users table
+CREATE INDEX IF NOT EXISTS [UsersByUsername] ON [Users](username);
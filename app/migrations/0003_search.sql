@@ -0,0 +1,54 @@
+-- ---
+-- Full-text search
+-- FTS5 indexes of the post and comment texts. They are external-content tables, the texts themselves are only
+-- stored in Posts and Comments, and the triggers below keep the indexes in sync with every change
+-- ---
+CREATE VIRTUAL TABLE IF NOT EXISTS [PostsSearch] USING fts5(
+  content,
+  content='Posts',
+  content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS [PostsSearchInsert] AFTER INSERT ON [Posts]
+BEGIN
+  INSERT INTO [PostsSearch] (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [PostsSearchDelete] AFTER DELETE ON [Posts]
+BEGIN
+  INSERT INTO [PostsSearch] ([PostsSearch], rowid, content) VALUES ('delete', OLD.id, OLD.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [PostsSearchUpdate] AFTER UPDATE OF content ON [Posts]
+BEGIN
+  INSERT INTO [PostsSearch] ([PostsSearch], rowid, content) VALUES ('delete', OLD.id, OLD.content);
+  INSERT INTO [PostsSearch] (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS [CommentsSearch] USING fts5(
+  comment,
+  content='Comments',
+  content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS [CommentsSearchInsert] AFTER INSERT ON [Comments]
+BEGIN
+  INSERT INTO [CommentsSearch] (rowid, comment) VALUES (NEW.id, NEW.comment);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentsSearchDelete] AFTER DELETE ON [Comments]
+BEGIN
+  INSERT INTO [CommentsSearch] ([CommentsSearch], rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentsSearchUpdate] AFTER UPDATE OF comment ON [Comments]
+BEGIN
+  INSERT INTO [CommentsSearch] ([CommentsSearch], rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+  INSERT INTO [CommentsSearch] (rowid, comment) VALUES (NEW.id, NEW.comment);
+END;
+
+-- Index the posts and comments that already exist
+INSERT INTO [PostsSearch] ([PostsSearch]) VALUES ('rebuild');
+INSERT INTO [CommentsSearch] ([CommentsSearch]) VALUES ('rebuild');
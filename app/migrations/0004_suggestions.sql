@@ -0,0 +1,38 @@
+-- ---
+-- Table 'Suggestions'
+-- People you may know: users that are mutual friends with some of the user's mutual friends,
+-- ranked by the number of such friends. Computed in batch by app/suggestions.py
+-- ---
+CREATE TABLE IF NOT EXISTS [Suggestions](
+  u_id INTEGER NOT NULL,
+  s_id INTEGER NOT NULL,
+  mutual_count INTEGER NOT NULL,
+  PRIMARY KEY(u_id, s_id),
+  FOREIGN KEY (u_id) REFERENCES [Users](id),
+  FOREIGN KEY (s_id) REFERENCES [Users](id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS [SuggestionsByCount] ON [Suggestions](u_id, mutual_count DESC, s_id);
+
+-- ---
+-- Table 'SuggestionsDirty'
+-- Users whose friendships changed since the suggestions were computed. The refresh expands them to their mutual
+-- friends, whose friends-of-friends changed too, and removes the rows it has processed
+-- ---
+CREATE TABLE IF NOT EXISTS [SuggestionsDirty](
+  id INTEGER PRIMARY KEY,
+  u_id INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS [SuggestionsDirtyInsert] AFTER INSERT ON [Friends]
+BEGIN
+  INSERT INTO [SuggestionsDirty] (u_id) VALUES (NEW.u_id), (NEW.f_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [SuggestionsDirtyDelete] AFTER DELETE ON [Friends]
+BEGIN
+  INSERT INTO [SuggestionsDirty] (u_id) VALUES (OLD.u_id), (OLD.f_id);
+END;
+
+-- Compute the suggestions of the existing users on the first refresh
+INSERT INTO [SuggestionsDirty] (u_id) SELECT id FROM [Users];
@@ -0,0 +1,12 @@
+-- ---
+-- Table 'Events'
+-- New posts and comments, published by the worker that inserted them and polled by every worker to push them
+-- to its Server-Sent Events subscribers, see app/events.py. Only the newest events are kept
+-- ---
+CREATE TABLE IF NOT EXISTS [Events](
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind VARCHAR NOT NULL,
+  p_id INTEGER NOT NULL,
+  c_id INTEGER,
+  creation_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
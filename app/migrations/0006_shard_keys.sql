@@ -0,0 +1,14 @@
+-- ---
+-- Tables 'PostKeys' and 'CommentKeys'
+-- Allocate the ids of the posts and comments stored in shard files when SQLITE3_SHARDS is above 1, and record
+-- the author of each post, whose shard holds the post and its comments. See app/shards.py
+-- ---
+CREATE TABLE IF NOT EXISTS [PostKeys](
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  u_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS [CommentKeys](
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  p_id INTEGER NOT NULL
+);
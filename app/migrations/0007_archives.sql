@@ -0,0 +1,21 @@
+-- ---
+-- Tables 'Archives' and 'ArchivedPosts'
+-- Posts older than ARCHIVE_AFTER_DAYS are moved with their comments to one archive file per period by
+-- 'flask db archive', see app/archive.py. These tables record the archive files and which one holds each post,
+-- so a permalink or an uploaded image of an archived post is found without opening every archive
+-- ---
+CREATE TABLE IF NOT EXISTS [Archives](
+  period VARCHAR PRIMARY KEY,
+  posts INTEGER NOT NULL DEFAULT 0,
+  archived_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS [ArchivedPosts](
+  id INTEGER PRIMARY KEY,
+  u_id INTEGER NOT NULL,
+  [image] VARCHAR,
+  period VARCHAR NOT NULL
+);
+
+-- Owner lookup when serving the uploaded images of archived posts
+CREATE INDEX IF NOT EXISTS [ArchivedPostsByImage] ON [ArchivedPosts]([image]);
@@ -0,0 +1,25 @@
+-- A database made by the former schema.sql had its Posts table adopted without comment_count, which is now added
+-- before the migrations are applied, see SQLite3._adopt_columns(), and its posts were never pushed to the timelines.
+-- Both are backfilled here. On any other database the posts already have their count and timeline rows,
+-- so only the checks are run.
+UPDATE [Posts]
+SET comment_count = (SELECT COUNT(*) FROM [Comments] WHERE p_id = [Posts].id)
+WHERE comment_count != (SELECT COUNT(*) FROM [Comments] WHERE p_id = [Posts].id);
+
+-- Every post is in the timeline of its author, the posts that are not were never fanned out
+INSERT OR IGNORE INTO [Timelines] (u_id, p_id, creation_time)
+WITH missing AS (
+  SELECT p.id, p.u_id, p.creation_time
+  FROM [Posts] AS p
+  WHERE p.u_id IS NOT NULL AND NOT EXISTS (
+    SELECT 1 FROM [Timelines] AS t WHERE t.u_id = p.u_id AND t.creation_time = p.creation_time AND t.p_id = p.id
+  )
+)
+SELECT m.u_id, m.id, m.creation_time
+FROM missing AS m
+UNION ALL
+SELECT f.f_id, m.id, m.creation_time
+FROM missing AS m
+JOIN [Friends] AS f ON f.u_id = m.u_id
+JOIN [Friends] AS r ON r.u_id = f.f_id AND r.f_id = f.u_id
+WHERE f.f_id != m.u_id;
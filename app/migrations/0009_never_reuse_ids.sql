@@ -0,0 +1,166 @@
+-- ---
+-- Posts and Comments ids are never reused
+-- Without AUTOINCREMENT SQLite gives a new row the largest id plus one, so after 'flask db archive' moved the
+-- newest posts out, a new post took the id of an archived one and was mistaken for it, see app/archive.py.
+-- Both tables are rebuilt with AUTOINCREMENT, which drops their indexes and triggers, so those are created again.
+-- The ids keep their values, so the Timelines rows and the search indexes stay valid
+-- ---
+
+-- Rename without checking the triggers of other tables, which refer to the tables while they are dropped
+PRAGMA legacy_alter_table = ON;
+
+CREATE TABLE [PostsAutoincrement](
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  u_id INTEGER,
+  content INTEGER,
+  [image] VARCHAR,
+  [creation_time] DATETIME,
+  comment_count INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (u_id) REFERENCES [Users](id)
+);
+
+INSERT INTO [PostsAutoincrement] (id, u_id, content, [image], creation_time, comment_count)
+SELECT id, u_id, content, [image], creation_time, comment_count FROM [Posts];
+
+DROP TABLE [Posts];
+
+ALTER TABLE [PostsAutoincrement] RENAME TO [Posts];
+
+CREATE TABLE [CommentsAutoincrement](
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  p_id INTEGER,
+  u_id INTEGER,
+  comment VARCHAR,
+  [creation_time] DATETIME,
+  FOREIGN KEY (p_id) REFERENCES Posts(id),
+  FOREIGN KEY (u_id) REFERENCES Users(id)
+);
+
+INSERT INTO [CommentsAutoincrement] (id, p_id, u_id, comment, creation_time)
+SELECT id, p_id, u_id, comment, creation_time FROM [Comments];
+
+DROP TABLE [Comments];
+
+ALTER TABLE [CommentsAutoincrement] RENAME TO [Comments];
+
+PRAGMA legacy_alter_table = OFF;
+
+-- Start after the ids already handed out to archived posts and to the posts and comments of the shard files.
+-- The ids of comments archived before this migration are not recorded in the main database and may be used again,
+-- the comments archived from now on keep theirs
+INSERT INTO sqlite_sequence (name, seq)
+SELECT name, 0 FROM (SELECT 'Posts' AS name UNION ALL SELECT 'Comments')
+WHERE name NOT IN (SELECT name FROM sqlite_sequence);
+
+UPDATE sqlite_sequence
+SET seq = max(
+  seq,
+  coalesce((SELECT MAX(id) FROM [ArchivedPosts]), 0),
+  coalesce((SELECT MAX(id) FROM [PostKeys]), 0)
+)
+WHERE name = 'Posts';
+
+UPDATE sqlite_sequence
+SET seq = max(seq, coalesce((SELECT MAX(id) FROM [CommentKeys]), 0))
+WHERE name = 'Comments';
+
+CREATE INDEX IF NOT EXISTS [PostsByTime] ON [Posts](creation_time, id);
+CREATE INDEX IF NOT EXISTS [PostsByAuthor] ON [Posts](u_id, creation_time, id);
+CREATE INDEX IF NOT EXISTS [PostsByImage] ON [Posts]([image]);
+CREATE INDEX IF NOT EXISTS [CommentsByPost] ON [Comments](p_id, creation_time);
+
+-- The triggers of app/migrations/0001_initial.sql
+CREATE TRIGGER IF NOT EXISTS [CommentCountInsert] AFTER INSERT ON [Comments]
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count + 1 WHERE id = NEW.p_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentCountDelete] AFTER DELETE ON [Comments]
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count - 1 WHERE id = OLD.p_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentCountMove] AFTER UPDATE OF p_id ON [Comments]
+WHEN NEW.p_id IS NOT OLD.p_id
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count - 1 WHERE id = OLD.p_id;
+  UPDATE [Posts] SET comment_count = comment_count + 1 WHERE id = NEW.p_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [TimelinesFanOut] AFTER INSERT ON [Posts]
+BEGIN
+  INSERT OR IGNORE INTO [Timelines] (u_id, p_id, creation_time)
+  SELECT NEW.u_id, NEW.id, NEW.creation_time
+  UNION ALL
+  SELECT f.f_id, NEW.id, NEW.creation_time
+  FROM [Friends] AS f JOIN [Friends] AS r ON r.u_id = f.f_id AND r.f_id = f.u_id
+  WHERE f.u_id = NEW.u_id AND f.f_id != NEW.u_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [TimelinesPostDeleted] AFTER DELETE ON [Posts]
+BEGIN
+  DELETE FROM [Timelines] WHERE p_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsInsert] AFTER INSERT ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsUpdate] AFTER UPDATE ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsDelete] AFTER DELETE ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsInsert] AFTER INSERT ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsUpdate] AFTER UPDATE ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsDelete] AFTER DELETE ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+-- The triggers of app/migrations/0003_search.sql
+CREATE TRIGGER IF NOT EXISTS [PostsSearchInsert] AFTER INSERT ON [Posts]
+BEGIN
+  INSERT INTO [PostsSearch] (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [PostsSearchDelete] AFTER DELETE ON [Posts]
+BEGIN
+  INSERT INTO [PostsSearch] ([PostsSearch], rowid, content) VALUES ('delete', OLD.id, OLD.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [PostsSearchUpdate] AFTER UPDATE OF content ON [Posts]
+BEGIN
+  INSERT INTO [PostsSearch] ([PostsSearch], rowid, content) VALUES ('delete', OLD.id, OLD.content);
+  INSERT INTO [PostsSearch] (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentsSearchInsert] AFTER INSERT ON [Comments]
+BEGIN
+  INSERT INTO [CommentsSearch] (rowid, comment) VALUES (NEW.id, NEW.comment);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentsSearchDelete] AFTER DELETE ON [Comments]
+BEGIN
+  INSERT INTO [CommentsSearch] ([CommentsSearch], rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentsSearchUpdate] AFTER UPDATE OF comment ON [Comments]
+BEGIN
+  INSERT INTO [CommentsSearch] ([CommentsSearch], rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+  INSERT INTO [CommentsSearch] (rowid, comment) VALUES (NEW.id, NEW.comment);
+END;
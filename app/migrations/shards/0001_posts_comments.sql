@@ -0,0 +1,44 @@
+-- Schema of the shard files, which hold the posts of the users hashed to them and the comments on those posts.
+-- Used when SQLITE3_SHARDS is above 1, see app/shards.py. The ids are allocated by PostKeys and CommentKeys
+-- in the main database, so they stay the same when 'flask db reshard' moves rows to another shard.
+
+-- ---
+-- Table 'Posts'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Posts](
+  id INTEGER PRIMARY KEY,
+  u_id INTEGER,
+  content INTEGER,
+  [image] VARCHAR,
+  [creation_time] DATETIME,
+  comment_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS [PostsByAuthor] ON [Posts](u_id, creation_time, id);
+CREATE INDEX IF NOT EXISTS [PostsByImage] ON [Posts]([image]);
+
+-- ---
+-- Table 'Comments'
+--
+-- ---
+CREATE TABLE IF NOT EXISTS [Comments](
+  id INTEGER PRIMARY KEY,
+  p_id INTEGER,
+  u_id INTEGER,
+  comment VARCHAR,
+  [creation_time] DATETIME,
+  FOREIGN KEY (p_id) REFERENCES Posts(id)
+);
+
+CREATE INDEX IF NOT EXISTS [CommentsByPost] ON [Comments](p_id, creation_time);
+
+CREATE TRIGGER IF NOT EXISTS [CommentCountInsert] AFTER INSERT ON [Comments]
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count + 1 WHERE id = NEW.p_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS [CommentCountDelete] AFTER DELETE ON [Comments]
+BEGIN
+  UPDATE [Posts] SET comment_count = comment_count - 1 WHERE id = OLD.p_id;
+END;
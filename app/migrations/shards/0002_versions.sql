@@ -0,0 +1,42 @@
+-- ---
+-- Table 'Versions'
+-- Counters of the posts and comments of the shard file, bumped by the triggers below in the same transaction as
+-- the change, like the Versions table of the main database. The pages read from the shards are stamped with them,
+-- see app/shards.py
+-- ---
+CREATE TABLE IF NOT EXISTS [Versions](
+  name VARCHAR PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO [Versions] (name) VALUES ('posts'), ('comments');
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsInsert] AFTER INSERT ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsUpdate] AFTER UPDATE ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsPostsDelete] AFTER DELETE ON [Posts]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'posts';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsInsert] AFTER INSERT ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsUpdate] AFTER UPDATE ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS [VersionsCommentsDelete] AFTER DELETE ON [Comments]
+BEGIN
+  UPDATE [Versions] SET value = value + 1 WHERE name = 'comments';
+END;
@@ -0,0 +1,71 @@
+"""Provides password hashing for the Social Insecurity application.
+
+Bcrypt is slow by design, so hashing runs on a dedicated executor with a limited queue.
+When too many logins or registrations are hashing at once, new ones are rejected with PasswordHashingBusy
+right away instead of blocking the worker. The cost of new hashes is set with BCRYPT_LOG_ROUNDS,
+hashes made with another cost are upgraded on the next successful login.
+
+Example:
+    from app import passwords
+
+    pw_hash = passwords.hash_password("secret")
+    passwords.check_password(pw_hash, "secret")  # True
+    passwords.needs_rehash(pw_hash)  # False
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from flask import Flask, current_app
+
+from app import flask_bcrypt
+from app.workers import BoundedExecutor, ExecutorSaturated
+
+def init_app(app: Flask) -> None:
+    """Creates the hashing executor of the app, sized from its configuration."""
+    app.extensions["hash_executor"] = BoundedExecutor(
+        "bcrypt",
+        max_workers=app.config["PASSWORD_HASH_WORKERS"],
+        max_pending=app.config["PASSWORD_HASH_MAX_PENDING"],
+    )
+
+
+class PasswordHashingBusy(ExecutorSaturated):
+    """Raised when the password hashing executor cannot take any more work, or does not finish it in time."""
+
+
+def hash_password(password: str) -> bytes:
+    """Returns the bcrypt hash of the password, using the configured cost."""
+    return _run(flask_bcrypt.generate_password_hash, password, current_app.config["BCRYPT_LOG_ROUNDS"])
+
+
+def check_password(pw_hash: bytes | str, password: str) -> bool:
+    """Returns whether the password matches the bcrypt hash."""
+    return _run(flask_bcrypt.check_password_hash, pw_hash, password)
+
+
+def needs_rehash(pw_hash: bytes | str) -> bool:
+    """Returns whether the hash was made with another cost than BCRYPT_LOG_ROUNDS.
+
+    A bcrypt hash has the form $2b$<cost>$<salt and checksum>.
+    """
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode("utf-8", errors="replace")
+    parts = pw_hash.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return True
+    return int(parts[2]) != current_app.config["BCRYPT_LOG_ROUNDS"]
+
+
+def _run(fn, *args):
+    """Runs fn on the hashing executor and waits for the result."""
+    try:
+        future = current_app.extensions["hash_executor"].submit(fn, *args)
+    except ExecutorSaturated as error:
+        raise PasswordHashingBusy(str(error)) from error
+    try:
+        return future.result(timeout=current_app.config["PASSWORD_HASH_TIMEOUT"])
+    except FutureTimeoutError as error:
+        future.cancel()
+        raise PasswordHashingBusy("password hashing timed out") from error
@@ -0,0 +1,78 @@
+"""Provides streamed rendering of the pages of the Social Insecurity application.
+
+When STREAMED_RENDERING is enabled, a page is rendered with flask.stream_template instead of render_template.
+The header of the page is sent to the browser right away, and the rows of a feed are rendered as the database
+cursor yields them, see SQLite3.iterate(), so the memory a worker needs does not grow with the length of the feed.
+
+Everything that changes the session, i.e. the flashed messages and the CSRF token, is done before the first byte
+is sent, since the session cookie is part of the headers.
+The statements run while the page is streamed are not included in the Server-Timing header or the /debug/sql
+statistics, which are collected when the response is started.
+
+Example:
+    comments = sqlite.iterate("SELECT * FROM Comments WHERE p_id = ?;", post_id)
+    return render_page("comments.html.j2", comments=comments)
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from typing import Any, Optional
+
+from flask import current_app, get_flashed_messages, render_template, stream_template
+from flask_wtf.csrf import generate_csrf
+
+
+class PageRows:
+    """Provides the rows of a page from a query that fetched one row more than the page shows.
+
+    The extra row is not yielded, it only tells whether there is a next page. The cursor of the next page
+    is known once the rows have been iterated, so a template can link to it after the rows.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Mapping[str, Any]],
+        page_size: int,
+        cursor: Callable[[Mapping[str, Any]], dict[str, Any]],
+    ) -> None:
+        """Initializes the page.
+
+        params:
+            rows: The rows of the query, at most page_size + 1.
+            page_size: The number of rows shown on the page.
+            cursor: Returns the query arguments of the next page from the last row shown.
+
+        """
+        self._rows = rows
+        self._page_size = page_size
+        self._cursor = cursor
+        self.next: Optional[dict[str, Any]] = None
+
+    def __iter__(self) -> Iterator[Mapping[str, Any]]:
+        last = None
+        for number, row in enumerate(self._rows):
+            # The query is exhausted instead of abandoned, so its cursor is closed right away
+            if number < self._page_size:
+                last = row
+                yield row
+            elif last is not None:
+                self.next = self._cursor(last)
+
+
+def render_page(template_name: str, **context: Any) -> Any:
+    """Renders a page, streamed when STREAMED_RENDERING is enabled.
+
+    params:
+        template_name: The name of the template.
+        context: The variables of the template, iterables of rows are consumed while the page is rendered.
+
+    returns: A response or the rendered page.
+
+    """
+    if not current_app.config.get("STREAMED_RENDERING", False):
+        return render_template(template_name, **context)
+    # Pop the flashed messages and create the CSRF token now, the session cannot change once streaming started
+    get_flashed_messages()
+    generate_csrf()
+    return stream_template(template_name, **context)
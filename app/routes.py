@@ -1,29 +1,65 @@
 """Provides all routes for the Social Insecurity application.
 
-This file contains the routes for the application. It is imported by the app package.
+This file contains the routes for the application, in the blueprint that create_app() registers.
 It also contains the SQL queries used for communicating with the database.
 """
 import sys
 import os
+import json
+import mimetypes
 import secrets
 import string
 
-from pathlib import Path
-
-from flask import flash, redirect, render_template, send_from_directory, url_for, request
-
-from app import app, sqlite, flask_bcrypt
-from app.forms import CommentsForm, FriendsForm, IndexForm, PostForm, ProfileForm
-
-from app.user import User
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    send_file,
+    stream_with_context,
+    url_for,
+    request,
+)
+
+from app import archive, csrf, sqlite, friend_graph, images, passwords, shards, storage, versions
+from app.cache import LRUCache
+from app.conditional import not_modified
+from app.events import TooManySubscribers, event_stream, hub, last_event_id, replay
+from app.fragments import invalidate_post, render_post_cards
+from app.forms import CommentsForm, FriendsForm, IndexForm, PostForm, ProfileForm, SearchForm
+from app.passwords import PasswordHashingBusy
+from app.rendering import PageRows, render_page
+from app.search import match_expression
+from app.suggestions import get_suggestions, schedule_refresh
+from app.storage import UploadTooLarge
+
+from app.user import User, get_user_row, invalidate_user
 import flask_login
 from flask_login import login_required
 
 from werkzeug.utils import secure_filename
 
+# Cursor used for the first page of the stream, sorts after every (creation_time, id) pair in the database
+STREAM_CURSOR_START = ("9999-12-31 23:59:59", sys.maxsize)
+
+bp = Blueprint("social", __name__)
+
+def init_app(app: Flask) -> None:
+    """Creates the upload authorization cache of the app, sized from its configuration.
+
+    The cache tells whether a user may see an uploaded file, keyed by (user id, filename, friends version).
+    """
+    app.extensions["upload_auth_cache"] = LRUCache(
+        maxsize=app.config["UPLOADS_AUTH_CACHE_SIZE"], ttl=app.config["UPLOADS_AUTH_CACHE_TTL"]
+    )
+
 
-@app.route("/", methods=["GET", "POST"])
-@app.route("/index", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
+@bp.route("/index", methods=["GET", "POST"])
 def index():
     """Provides the index page for the application.
 
@@ -42,14 +78,31 @@ def index():
             FROM Users
             WHERE username = ?;
             """
-        user = sqlite.query(get_user, True, (login_form.username.data))
+        user = sqlite.read(get_user, login_form.username.data, one=True)
         
+        pw_ok = False
         if user:
-            pw_ok = flask_bcrypt.check_password_hash(user["password"], user["hash_salt"] + login_form.password.data + login_form.username.data)
+            salted_password = user["hash_salt"] + login_form.password.data + login_form.username.data
+            try:
+                pw_ok = passwords.check_password(user["password"], salted_password)
+            except PasswordHashingBusy:
+                flash("The server is busy, please try to sign in again in a moment.", category="warning")
+                return render_template("index.html.j2", title="Welcome", form=index_form), 503
 
         if user is None or not pw_ok:
             flash("Sorry, invalid login.", category="warning")
         elif pw_ok:
+            # Upgrade hashes made with an outdated cost while we know the password
+            if passwords.needs_rehash(user["password"]):
+                try:
+                    update_password = f"""
+                        UPDATE Users
+                        SET password = ?
+                        WHERE id = ?;
+                        """
+                    sqlite.write(update_password, passwords.hash_password(salted_password), user["id"])
+                except PasswordHashingBusy:
+                    pass  # Try again on the next login
             # Store remember me-cookie
             remember_me = True if request.form.get('login-remember_me') else False
             # Log in the user with flask-login
@@ -57,7 +110,7 @@ def index():
             lm_user.id = str(user["id"])
             flask_login.login_user(lm_user, remember=remember_me)
                 
-            return redirect(url_for("stream", username=user["username"]))
+            return redirect(url_for("social.stream", username=user["username"]))
 
     elif register_form.validate_on_submit() and register_form.submit.data:
         # Check if the password and confirm password fields are equal
@@ -69,48 +122,54 @@ def index():
         if len(register_form.password.data) < 8:
             flash("The password must be at least 8 characters long.", category="warning")
             return render_template("index.html.j2", title="Welcome", form=index_form)
-        # Check if the username is already taken
-        get_existing_user = f"""
-            SELECT id
-            FROM Users
-            WHERE username = ?;
-            """
-        existing_user = sqlite.query(get_existing_user, True, register_form.username.data)
-        if existing_user is not None:
-            flash("Could not register a user with that username.", category="warning")
-            return render_template("index.html.j2", title="Welcome", form=index_form)
-        
         # Generate cryptographically strong salt and password hash
         salt_alphabet = string.ascii_letters + string.digits
         hash_salt = ''.join(secrets.choice(salt_alphabet) for i in range(8))
-        pw_hash = flask_bcrypt.generate_password_hash(hash_salt + register_form.password.data + register_form.username.data)
-        
-        insert_user = f"""
-            INSERT INTO Users (username, first_name, last_name, password, hash_salt)
-            VALUES (?, ?, ?, ?, ?);
-            """
-        sqlite.query(insert_user, False, register_form.username.data, register_form.first_name.data, register_form.last_name.data, pw_hash, hash_salt)
+        try:
+            pw_hash = passwords.hash_password(hash_salt + register_form.password.data + register_form.username.data)
+        except PasswordHashingBusy:
+            flash("The server is busy, please try to register again in a moment.", category="warning")
+            return render_template("index.html.j2", title="Welcome", form=index_form), 503
+
+        # Check if the username is already taken and insert the user in one transaction,
+        # so two registrations of the same username cannot both pass the check
+        with sqlite.transaction():
+            get_existing_user = f"""
+                SELECT id
+                FROM Users
+                WHERE username = ?;
+                """
+            existing_user = sqlite.read(get_existing_user, register_form.username.data, one=True)
+            if existing_user is not None:
+                flash("Could not register a user with that username.", category="warning")
+                return render_template("index.html.j2", title="Welcome", form=index_form)
+
+            insert_user = f"""
+                INSERT INTO Users (username, first_name, last_name, password, hash_salt)
+                VALUES (?, ?, ?, ?, ?);
+                """
+            sqlite.write(insert_user, register_form.username.data, register_form.first_name.data, register_form.last_name.data, pw_hash, hash_salt)
         flash("User successfully created!", category="success")
-        return redirect(url_for("index"))
+        return redirect(url_for("social.index"))
 
     # Send users that already were authenticated to their stream page
     if flask_login.current_user.is_authenticated:
-        return redirect(url_for("stream", username=flask_login.current_user.username))
+        return redirect(url_for("social.stream", username=flask_login.current_user.username))
 
     return render_template("index.html.j2", title="Welcome", form=index_form)
 
 
-@app.route("/logout", methods=["GET", "POST"])
+@bp.route("/logout", methods=["GET", "POST"])
 @login_required
 def logout():
     """ Log a user out from flask-login
     """
     flask_login.logout_user()
     flash("Logged out", category="message")
-    return redirect(url_for("index"))
+    return redirect(url_for("social.index"))
 
 
-@app.route("/stream/<string:username>", methods=["GET", "POST"])
+@bp.route("/stream/<string:username>", methods=["GET", "POST"])
 @login_required
 def stream(username: str):
     """Provides the stream page for the application.
@@ -121,58 +180,92 @@ def stream(username: str):
     """
     # Check if we are logged in as a valid user (authenticaed)
     if not flask_login.current_user.is_authenticated:
-        return redirect(url_for("logout"))
+        return redirect(url_for("social.logout"))
     # Check if we are logged in as the correct user (authorized)
     if flask_login.current_user.username != username:
         return 'Access denied'
 
     post_form = PostForm()
-    get_user = f"""
-        SELECT *
-        FROM Users
-        WHERE username = ?;
-        """
-    user = sqlite.query(get_user, True, username)
+    # The logged-in user's row is already loaded and cached by the user_loader
+    user = flask_login.current_user.row
     
+    # Keyset pagination on (creation_time, id), the cursor is the last post shown on the previous page
+    before = request.args.get("before", STREAM_CURSOR_START[0], type=str)
+    before_id = request.args.get("before_id", STREAM_CURSOR_START[1], type=int)
+    page_size = current_app.config["STREAM_PAGE_SIZE"]
+
+    # Answer a refresh of an unchanged stream with 304 Not Modified, before running the feed query
+    if request.method != "POST":
+        cached = not_modified(*stream_stamp(user["id"], before, before_id, page_size + 1))
+        if cached is not None:
+            return cached
+
     if post_form.validate_on_submit():
-        filename = secure_filename(post_form.image.data.filename)
-        
+        filename = None
+
         if post_form.image.data:
-            folder_path = str(Path(app.instance_path) / app.config["UPLOADS_FOLDER_PATH"])
-            filename_base, filename_ext = os.path.splitext(filename)
-            
-            if filename_ext[1:].lower() not in app.config["ALLOWED_EXTENSIONS"]:
-                flash("Image type must be one of " + ', '.join(app.config["ALLOWED_EXTENSIONS"]), category="warning")
-                return redirect(url_for("stream", username=username))
-            
-            count = ""
-            while os.path.exists(folder_path + "/" + filename_base + str(count) + filename_ext):
-                if count == "":
-                    count = 1
-                else:
-                    count = count + 1
-            filename = filename_base + str(count) + filename_ext
-            post_form.image.data.save(folder_path + "/" + filename)
+            filename_ext = os.path.splitext(secure_filename(post_form.image.data.filename))[1][1:].lower()
+
+            if filename_ext not in current_app.config["ALLOWED_EXTENSIONS"]:
+                flash("Image type must be one of " + ', '.join(current_app.config["ALLOWED_EXTENSIONS"]), category="warning")
+                return redirect(url_for("social.stream", username=username))
+
+            # Store the image under the hash of its content, identical images are only stored once
+            try:
+                filename = storage.store(post_form.image.data, filename_ext)
+            except UploadTooLarge:
+                flash("The image is too large.", category="warning")
+                return redirect(url_for("social.stream", username=username))
+            images.schedule_variants(filename)
 
         insert_post = f"""
             INSERT INTO Posts (u_id, content, image, creation_time)
             VALUES (?, ?, ?, CURRENT_TIMESTAMP);
             """
-        sqlite.query(insert_post, False, user["id"], post_form.content.data, filename)
-        return redirect(url_for("stream", username=username))
+        if shards.enabled():
+            shards.insert_post(user["id"], post_form.content.data, filename)
+        else:
+            post_id = sqlite.write_batched(insert_post, user["id"], post_form.content.data, filename)
+            # Live updates follow the timelines, which only hold the posts of the main database
+            if current_app.config["EVENTS_ENABLED"]:
+                hub.publish("post", post_id)
+        return redirect(url_for("social.stream", username=username))
 
-    # Changed OR to AND between friend subqueries to require two-way friendships for posts to show
+    # The timeline holds the posts of the user and their mutual friends, see the Timelines triggers in app/migrations/
     get_posts = f"""
-         SELECT p.*, u.*, (SELECT COUNT(*) FROM Comments WHERE p_id = p.id) AS cc
-         FROM Posts AS p JOIN Users AS u ON u.id = p.u_id
-         WHERE p.u_id IN (SELECT u_id FROM Friends WHERE f_id = ?) AND p.u_id IN (SELECT f_id FROM Friends WHERE u_id = ?) OR p.u_id = ?
-         ORDER BY p.creation_time DESC;
+         SELECT p.*, u.*
+         FROM Timelines AS t JOIN Posts AS p ON p.id = t.p_id JOIN Users AS u ON u.id = p.u_id
+         WHERE t.u_id = ? AND (t.creation_time, t.p_id) < (?, ?)
+         ORDER BY t.creation_time DESC, t.p_id DESC
+         LIMIT ?;
         """
-    posts = sqlite.query(get_posts, False, user["id"], user["id"], user["id"])
-    return render_template("stream.html.j2", title="Stream", username=username, form=post_form, posts=posts)
+    # Posts published after this page was rendered are pushed to the first page, see app/events.py
+    paginated = "before_id" in request.args
+    events_url = None
+    if current_app.config["EVENTS_ENABLED"] and not paginated:
+        events_url = url_for("social.events", username=username, after=last_event_id())
+    if shards.enabled():
+        posts = shards.feed(user["id"], before, before_id, page_size + 1)
+    else:
+        posts = sqlite.iterate(get_posts, user["id"], before, before_id, page_size + 1)
+    # The last pages continue with the posts moved to the archive files, see app/archive.py
+    posts = archive.with_archived(posts, user["id"], before, before_id, page_size + 1)
+
+    # The extra row only tells us if there is an older page, it is not shown
+    page = PageRows(posts, page_size, lambda last: {"before": last["creation_time"], "before_id": last["id"]})
+    return render_page(
+        "stream.html.j2",
+        title="Stream",
+        username=username,
+        form=post_form,
+        cards=render_post_cards(page),
+        page=page,
+        paginated=paginated,
+        events_url=events_url,
+    )
 
 
-@app.route("/comments/<string:username>/<int:post_id>", methods=["GET", "POST"])
+@bp.route("/comments/<string:username>/<int:post_id>", methods=["GET", "POST"])
 @login_required
 def comments(username: str, post_id: int):
     """Provides the comments page for the application.
@@ -183,25 +276,37 @@ def comments(username: str, post_id: int):
     """
     # Check if we are logged in as a valid user (authenticaed)
     if not flask_login.current_user.is_authenticated:
-        return redirect(url_for("logout"))
+        return redirect(url_for("social.logout"))
     # Check if we are logged in as the correct user (authorized)
     if flask_login.current_user.username != username:
         return 'Access denied'
     
     comments_form = CommentsForm()
-    get_user = f"""
-        SELECT *
-        FROM Users
-        WHERE username = ?;
-        """
-    user = sqlite.query(get_user, True, username)
+    # The logged-in user's row is already loaded and cached by the user_loader
+    user = flask_login.current_user.row
 
+    if request.method != "POST":
+        cached = not_modified(*comments_stamp(post_id))
+        if cached is not None:
+            return cached
+
+    # Archived posts are read-only, see app/archive.py
+    archived = archive.period_of(post_id) is not None
     if comments_form.validate_on_submit():
         insert_comment = f"""
             INSERT INTO Comments (p_id, u_id, comment, creation_time)
             VALUES (?, ?, ?, CURRENT_TIMESTAMP);
             """
-        sqlite.query(insert_comment, False, post_id, user["id"], comments_form.comment.data)
+        if archived:
+            flash("This post is archived and can no longer be commented on.", category="warning")
+        elif shards.enabled():
+            shards.insert_comment(post_id, user["id"], comments_form.comment.data)
+            invalidate_post(post_id)
+        else:
+            comment_id = sqlite.write_batched(insert_comment, post_id, user["id"], comments_form.comment.data)
+            invalidate_post(post_id)
+            if current_app.config["EVENTS_ENABLED"]:
+                hub.publish("comment", post_id, comment_id)
 
     get_post = f"""
         SELECT *
@@ -214,14 +319,130 @@ def comments(username: str, post_id: int):
         WHERE c.p_id=?
         ORDER BY c.creation_time DESC;
         """
-    post = sqlite.query(get_post, False, post_id)
-    comments = sqlite.query(get_comments, False, post_id)
-    return render_template(
-        "comments.html.j2", title="Comments", username=username, form=comments_form, post=post, comments=comments
+    events_url = None
+    if current_app.config["EVENTS_ENABLED"]:
+        events_url = url_for("social.events", username=username, post_id=post_id, after=last_event_id())
+    if shards.enabled():
+        post = shards.get_post(post_id)
+        comments = shards.get_comments(post_id)
+    else:
+        post = sqlite.read(get_post, post_id, one=True)
+        comments = sqlite.iterate(get_comments, post_id)
+    if archived:
+        post = archive.get_post(post_id)
+        comments = archive.get_comments(post_id)
+    return render_page(
+        "comments.html.j2",
+        title="Comments",
+        username=username,
+        form=comments_form,
+        post=post,
+        comments=comments,
+        archived=archived,
+        events_url=events_url,
+    )
+
+
+@bp.route("/post/<int:post_id>")
+@login_required
+def post(post_id: int):
+    """Redirects to the comments page of a post for the logged-in user.
+
+    The cached post cards link here, as they are shared by all viewers, see app/fragments.py.
+    """
+    return redirect(url_for("social.comments", username=flask_login.current_user.username, post_id=post_id))
+
+
+def stream_stamp(user_id: int, before: str, before_id: int, limit: int) -> tuple:
+    """Returns the values a page of the stream depends on, for its ETag.
+
+    These are the posts of the page in the timeline of the user and the newest comment on them,
+    so only the posts and comments the user can see change the page.
+    """
+    get_stamp = """
+        WITH page AS (
+            SELECT p_id
+            FROM Timelines
+            WHERE u_id = ? AND (creation_time, p_id) < (?, ?)
+            ORDER BY creation_time DESC, p_id DESC
+            LIMIT ?
+        )
+        SELECT
+            (SELECT json_group_array(p_id) FROM page) AS posts,
+            (SELECT MAX(c.id) FROM Comments AS c WHERE c.p_id IN (SELECT p_id FROM page)) AS last_comment,
+            (SELECT total(posts) FROM Archives) AS archived;
+        """
+    if shards.enabled():
+        # The timelines do not cover the shard files, use the counters of the shards the page is read from.
+        # The counters of the main database change when the posts are resharded
+        authors = {user_id, *friend_graph.mutual_friends(user_id)}
+        return versions.get("friends"), versions.get("posts"), shards.shard_versions(authors)
+    row = sqlite.read(get_stamp, user_id, before, before_id, limit, one=True)
+    stamp = (row["posts"], row["last_comment"], row["archived"])
+    if len(json.loads(row["posts"])) < limit:
+        # A short page continues with the archived posts of the mutual friends, see app/archive.py
+        stamp += (sorted(friend_graph.mutual_friends(user_id)),)
+    return stamp
+
+
+def comments_stamp(post_id: int) -> tuple:
+    """Returns the values the comments page of a post depends on, for its ETag."""
+    get_stamp = """
+        SELECT
+            (SELECT comment_count FROM Posts WHERE id = ?1) AS comment_count,
+            (SELECT MAX(id) FROM Comments WHERE p_id = ?1) AS last_comment,
+            (SELECT period FROM ArchivedPosts WHERE id = ?1) AS period;
+        """
+    if shards.enabled():
+        return versions.get("posts"), shards.post_stamp(post_id)
+    row = sqlite.read(get_stamp, post_id, one=True)
+    return row["comment_count"], row["last_comment"], row["period"]
+
+
+@bp.route("/events/<string:username>")
+@login_required
+def events(username: str):
+    """Provides the Server-Sent Events of the stream page, or of the comments page with a post_id argument.
+
+    The stream page receives the cards of the new posts the user may see, a comments page
+    the cards of the new comments on its post. Events after the 'after' argument, or after the Last-Event-ID
+    the browser sends when it reconnects, that were published before the stream was opened are sent first.
+    """
+    # Check if we are logged in as a valid user (authenticaed)
+    if not flask_login.current_user.is_authenticated:
+        return redirect(url_for("social.logout"))
+    # Check if we are logged in as the correct user (authorized)
+    if flask_login.current_user.username != username:
+        abort(403)
+    if not current_app.config["EVENTS_ENABLED"]:
+        abort(404)
+
+    user = flask_login.current_user.row
+    post_id = request.args.get("post_id", type=int)
+    after = request.headers.get("Last-Event-ID", type=int) or request.args.get("after", 0, type=int)
+    try:
+        subscriber = hub.subscribe(user["id"], post_id)
+    except TooManySubscribers:
+        abort(503)
+    try:
+        missed = replay(user["id"], post_id, after, current_app.config["EVENTS_MAX_QUEUED"] + 1)
+    except BaseException:
+        hub.unsubscribe(subscriber)
+        raise
+    # The stream may stay open for minutes, it must not hold one of the pooled database connections meanwhile
+    sqlite.release()
+
+    response = current_app.response_class(
+        stream_with_context(event_stream(subscriber, after, missed)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+    # A stream closed before it started never runs the cleanup of its generator
+    response.call_on_close(lambda: hub.unsubscribe(subscriber))
+    return response
 
 
-@app.route("/friends/<string:username>", methods=["GET", "POST"])
+@bp.route("/friends/<string:username>", methods=["GET", "POST"])
 @login_required
 def friends(username: str):
     """Provides the friends page for the application.
@@ -232,82 +453,159 @@ def friends(username: str):
     """
     # Check if we are logged in as a valid user (authenticaed)
     if not flask_login.current_user.is_authenticated:
-        return redirect(url_for("logout"))
+        return redirect(url_for("social.logout"))
     # Check if we are logged in as the correct user (authorized)
     if flask_login.current_user.username != username:
         return 'Access denied'
     
     friends_form = FriendsForm()
-    get_user = f"""
-        SELECT *
-        FROM Users
-        WHERE username = ?;
-        """
-    user = sqlite.query(get_user, True, username)
+    # The logged-in user's row is already loaded and cached by the user_loader
+    user = flask_login.current_user.row
 
     if friends_form.validate_on_submit():
-        # Get the user info of the friend we want to add
-        get_friend = f"""
-            SELECT *
-            FROM Users
-            WHERE username = ?;
-            """
-        friend = sqlite.query(get_friend, True, friends_form.username.data)
-        # Get our current friends
-        get_friends = f"""
-            SELECT f_id
-            FROM Friends
-            WHERE u_id = ?;
-            """
-        friends = sqlite.query(get_friends, False, user["id"])
-        # Get the current friends of the friend we want to add
-        friend_friends = None
-        if friend:
-            get_friend_friends = f"""
-                SELECT f_id
-                FROM Friends
-                WHERE u_id = ?;
+        # Check and add the friendship in one transaction so concurrent requests cannot interleave
+        friend_added = False
+        with sqlite.transaction():
+            # Get the user info of the friend we want to add
+            get_friend = f"""
+                SELECT *
+                FROM Users
+                WHERE username = ?;
                 """
-            friend_friends = sqlite.query(get_friend_friends, False, friend["id"])
+            friend = sqlite.read(get_friend, friends_form.username.data, one=True)
 
-        # When this is true the friend-request-sent message will be shown to the user
-        friend_request_sent_msg = False
+            # When this is true the friend-request-sent message will be shown to the user
+            friend_request_sent_msg = False
         
-        if friend is None:
-            # Don't show that this user doesn't exist
-            friend_request_sent_msg = True
-        elif friend["id"] == user["id"]:
-            flash("You cannot be friends with yourself!", category="warning")
-        elif friend["id"] in [friend["f_id"] for friend in friends]:
-            if user["id"] in [friend["f_id"] for friend in friend_friends]:
-                # Only show this message if the friendship is mutual to avoid revealing the existence of users
-                flash("You are already friends with this user!", category="warning")
+            if friend is None:
+                # Don't show that this user doesn't exist
+                friend_request_sent_msg = True
+            elif friend["id"] == user["id"]:
+                flash("You cannot be friends with yourself!", category="warning")
+            elif friend_graph.follows(user["id"], friend["id"]):
+                if friend_graph.follows(friend["id"], user["id"]):
+                    # Only show this message if the friendship is mutual to avoid revealing the existence of users
+                    flash("You are already friends with this user!", category="warning")
+                else:
+                    # Don't show that this user exists because the friendship isn’t mutual
+                    friend_request_sent_msg = True
             else:
-                # Don't show that this user exists because the friendship isn’t mutual
+                insert_friend = f"""
+                    INSERT INTO Friends (u_id, f_id)
+                    VALUES (?, ?);
+                    """
+                sqlite.write(insert_friend, user["id"], friend["id"])
+                friend_added = True
                 friend_request_sent_msg = True
-        else:
-            insert_friend = f"""
-                INSERT INTO Friends (u_id, f_id)
-                VALUES (?, ?);
-                """
-            sqlite.query(insert_friend, False, user["id"], friend["id"])
-            friend_request_sent_msg = True
-        
+        if friend_added:
+            friend_graph.add(user["id"], friend["id"])
+            if current_app.config["SUGGESTIONS_REFRESH_ON_CHANGE"]:
+                schedule_refresh()
+
         # Show this message regardless if the user exists or not to avoid exposing the existence of users
         if friend_request_sent_msg == True:
             flash("Friend request sent.", category="success")
 
     # Only select friends that have a mutual friendship with the user
+    friend_ids = sorted(friend_graph.mutual_friends(user["id"]))
     get_friends = f"""
         SELECT *
-        FROM Friends AS f JOIN Users as u ON f.f_id = u.id
-        WHERE f.u_id = ? AND f.f_id != ? AND f.f_id IN (SELECT f.u_id FROM Friends AS f WHERE f.f_id = ?);
+        FROM Users
+        WHERE id IN ({", ".join("?" * len(friend_ids))})
+        ORDER BY username;
         """
-    friends = sqlite.query(get_friends, False, user["id"], user["id"], user["id"])
-    return render_template("friends.html.j2", title="Friends", username=username, friends=friends, form=friends_form)
+    friends = sqlite.read(get_friends, *friend_ids)
+    # People you may know, computed in the background from the mutual friendships, see app/suggestions.py
+    suggestions = get_suggestions(user["id"])
+    return render_template(
+        "friends.html.j2",
+        title="Friends",
+        username=username,
+        friends=friends,
+        suggestions=suggestions,
+        form=friends_form,
+    )
 
 
-@app.route("/profile/<string:username>", methods=["GET", "POST"])
+@bp.route("/search/<string:username>")
+@login_required
+def search(username: str):
+    """Provides the search page for the application.
+
+    It searches the posts and comments the user may see, which are those on the user's timeline,
+    and shows the matching posts ranked by relevance (bm25), best first.
+    """
+    if flask_login.current_user.username != username:
+        return 'Access denied'
+    if not current_app.config["SEARCH_ENABLED"]:
+        abort(404)
+
+    search_form = SearchForm(formdata=request.args)
+    user = flask_login.current_user.row
+    expression = match_expression(search_form.q.data or "")
+    if expression is None:
+        return render_template("search.html.j2", title="Search", username=username, form=search_form, cards=[])
+
+    cached = not_modified(versions.get("friends"), versions.get("posts"), versions.get("comments"))
+    if cached is not None:
+        return cached
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    page_size = current_app.config["SEARCH_PAGE_SIZE"]
+    max_matches = current_app.config["SEARCH_MAX_MATCHES"]
+    # Only the newest matches of each index are ranked, which FTS5 finds without scoring every match,
+    # so a search for a common word costs no more than for a rare one as the number of posts grows.
+    # A match only counts if its post is on the user's timeline, so the matches of other users never
+    # take the place of the ones the user may see
+    get_posts = f"""
+        WITH Matches (p_id, rank) AS (
+            SELECT * FROM (
+                SELECT PostsSearch.rowid, PostsSearch.rank
+                FROM PostsSearch
+                JOIN Posts AS p ON p.id = PostsSearch.rowid
+                JOIN Timelines AS t ON t.u_id = ?2 AND t.creation_time = p.creation_time AND t.p_id = p.id
+                WHERE PostsSearch MATCH ?1
+                ORDER BY PostsSearch.rowid DESC LIMIT ?3
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT c.p_id, CommentsSearch.rank
+                FROM CommentsSearch
+                JOIN Comments AS c ON c.id = CommentsSearch.rowid
+                JOIN Posts AS p ON p.id = c.p_id
+                JOIN Timelines AS t ON t.u_id = ?2 AND t.creation_time = p.creation_time AND t.p_id = p.id
+                WHERE CommentsSearch MATCH ?1
+                ORDER BY CommentsSearch.rowid DESC LIMIT ?3
+            )
+        )
+        SELECT p.*, u.*, MIN(m.rank) AS search_rank
+        FROM Matches AS m
+        JOIN Posts AS p ON p.id = m.p_id
+        JOIN Users AS u ON u.id = p.u_id
+        GROUP BY p.id
+        ORDER BY search_rank, p.id DESC
+        LIMIT ?4 OFFSET ?5;
+        """
+    posts = sqlite.read(get_posts, expression, user["id"], max_matches, page_size + 1, (page - 1) * page_size)
+
+    # The extra row only tells us if there is a next page, it is not shown
+    next_page = None
+    if len(posts) > page_size:
+        posts = posts[:page_size]
+        next_page = page + 1
+    return render_template(
+        "search.html.j2",
+        title="Search",
+        username=username,
+        form=search_form,
+        query=search_form.q.data,
+        cards=render_post_cards(posts),
+        page=page,
+        next_page=next_page,
+    )
+
+
+@bp.route("/profile/<string:username>", methods=["GET", "POST"])
 @login_required
 def profile(username: str):
     """Provides the profile page for the application.
@@ -317,31 +615,20 @@ def profile(username: str):
     Otherwise, it reads the username from the URL and displays the user's profile.
     """
     profile_form = ProfileForm()
-    get_user = f"""
-        SELECT *
-        FROM Users
-        WHERE username = ?;
-        """
-    user = sqlite.query(get_user, True, username)
+    user = get_user_row(username=username)
     
     # Check if the user exists
     if user is None:
-        return redirect(url_for("profile", username=flask_login.current_user.username))
+        return redirect(url_for("social.profile", username=flask_login.current_user.username))
     
     if username != flask_login.current_user.username:
         # Check if the logged in user are a mutual friend with this user (two-way friendship)
-        get_mutual_friends = f"""
-            SELECT * FROM 
-                (SELECT ua.username, fa.u_id, fa.f_id FROM Users AS ua 
-                 JOIN Friends AS fa ON ua.id = fa.u_id WHERE ua.username = ?) AS a 
-            JOIN 
-                (SELECT ub.username, fb.u_id, fb.f_id FROM Users AS ub 
-                 JOIN Friends AS fb ON ub.id = fb.u_id WHERE ub.username = ?) AS b 
-            ON a.u_id = b.f_id AND b.u_id = a.f_id
-        """
-        mutual_friends = sqlite.query(get_mutual_friends, True, username, flask_login.current_user.username)
-        if mutual_friends is None:
-            return redirect(url_for("profile", username=flask_login.current_user.username, message="You are not authorized to view this profile."))
+        if not friend_graph.are_mutual(user["id"], int(flask_login.current_user.id)):
+            return redirect(url_for("social.profile", username=flask_login.current_user.username, message="You are not authorized to view this profile."))
+
+    cached = not_modified(versions.get("users"))
+    if cached is not None:
+        return cached
 
     if profile_form.validate_on_submit():
         # Check if we are logged as the correct user (authorized)
@@ -354,40 +641,100 @@ def profile(username: str):
             SET education=?, employment=?, music=?, movie=?, nationality=?, birthday=? 
             WHERE username=?;
             """
-        sqlite.query(update_profile, False, profile_form.education.data, profile_form.employment.data, profile_form.music.data,  profile_form.movie.data, profile_form.nationality.data, profile_form.birthday.data, username)
-        return redirect(url_for("profile", username=username))
+        sqlite.write(update_profile, profile_form.education.data, profile_form.employment.data, profile_form.music.data,  profile_form.movie.data, profile_form.nationality.data, profile_form.birthday.data, username)
+        invalidate_user(user)
+        return redirect(url_for("social.profile", username=username))
 
     return render_template("profile.html.j2", title="Profile", username=username, user=user, form=profile_form)
 
 
-@app.route("/uploads/<string:filename>")
+@bp.route("/uploads/<string:filename>")
 @login_required
 def uploads(filename):
-    """Provides an endpoint for serving uploaded files."""
-    user_authorized = False
-    # Get the owner of the file
-    get_owner = f"""
-        SELECT u.username FROM Users AS u 
-        WHERE u.id IN (SELECT p.u_id FROM Posts AS p WHERE p.image = ?)
+    """Provides an endpoint for serving uploaded files.
+
+    Whether the user may see a file is cached briefly per user and file.
+    Files are served with a strong ETag, which is the content hash for files in the content-addressed store,
+    and an If-None-Match request is answered with 304 Not Modified before the file is opened.
+    Range requests are supported, and with UPLOADS_SENDFILE a front proxy can send the bytes instead of Flask.
     """
-    owner = sqlite.query(get_owner, True, filename)
-    if owner:
-        # Do the user own the file?
-        if flask_login.current_user.username == owner["username"]:
-            user_authorized = True
-        else:
-            # Is the user a mutual friend with the owner of the file?
-            get_mutual_friends = f"""
-                SELECT * FROM 
-                    (SELECT ua.username, fa.u_id, fa.f_id FROM Users AS ua 
-                        JOIN Friends AS fa ON ua.id = fa.u_id WHERE ua.username = ?) AS a 
-                JOIN 
-                    (SELECT ub.username, fb.u_id, fb.f_id FROM Users AS ub 
-                        JOIN Friends AS fb ON ub.id = fb.u_id WHERE ub.username = ?) AS b 
-                ON a.u_id = b.f_id AND b.u_id = a.f_id
-            """
-            user_authorized = sqlite.query(get_mutual_friends, True, owner["username"], flask_login.current_user.username)
-    if user_authorized:
-        return send_from_directory(Path(app.instance_path) / app.config["UPLOADS_FOLDER_PATH"], filename)
-    else:
+    viewer_id = int(flask_login.current_user.id)
+    # The friends version makes a changed friendship take effect right away, instead of after the TTL
+    cache_key = (viewer_id, filename, versions.get("friends"))
+    upload_auth_cache = current_app.extensions["upload_auth_cache"]
+    user_authorized = upload_auth_cache.get(cache_key)
+    if user_authorized is None:
+        user_authorized = False
+        # Get the owners of the file, identical images posted by several users are stored once
+        get_owners = f"""
+            SELECT p.u_id FROM Posts AS p
+            WHERE p.image = ?
+            UNION
+            SELECT a.u_id FROM ArchivedPosts AS a
+            WHERE a.image = ?
+        """
+        owners = shards.image_owners(filename) if shards.enabled() else set()
+        owners.update(owner["u_id"] for owner in sqlite.read(get_owners, filename, filename))
+        for owner_id in owners:
+            # Do the user own the file, or is the user a mutual friend with the owner of the file?
+            if owner_id == viewer_id or friend_graph.are_mutual(owner_id, viewer_id):
+                user_authorized = True
+                break
+        upload_auth_cache.set(cache_key, user_authorized)
+    if not user_authorized:
         return 'Access denied'
+
+    # Serve the requested size variant, or the original until the variant has been created
+    variant = request.args.get("variant")
+    path = images.resolve_variant(filename, variant)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        abort(404)
+    if storage.is_key(filename):
+        etag = path.name
+    else:
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    elif current_app.config["UPLOADS_SENDFILE"] == "x-accel-redirect":
+        response = current_app.response_class(mimetype=mimetypes.guess_type(path.name)[0])
+        relative_path = path.relative_to(storage.upload_folder()).as_posix()
+        response.headers["X-Accel-Redirect"] = current_app.config["UPLOADS_ACCEL_PREFIX"].rstrip("/") + "/" + relative_path
+    elif current_app.config["UPLOADS_SENDFILE"] == "x-sendfile":
+        response = current_app.response_class(mimetype=mimetypes.guess_type(path.name)[0])
+        response.headers["X-Sendfile"] = str(path)
+    else:
+        response = send_file(path, conditional=True, etag=etag, last_modified=stat.st_mtime)
+
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+    response.cache_control.private = True
+    if storage.is_key(filename) and (variant is None or path.name != storage.resolve(filename).name):
+        # The content of a stored file never changes, unless the original is served in place of a missing variant
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@bp.route("/debug/sql", methods=["GET", "DELETE"])
+@csrf.exempt
+def debug_sql():
+    """Provides the SQL statement statistics of each route handled by this worker process, and of its writer.
+
+    The endpoint only exists when SQLITE3_STATS_TOKEN is set, and the token must be sent as a bearer token.
+    A DELETE request clears the statistics.
+    """
+    token = current_app.config["SQLITE3_STATS_TOKEN"]
+    if not token:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        abort(403)
+    if request.method == "DELETE":
+        sqlite.stats.clear()
+        sqlite.writer_stats.clear()
+        return "", 204
+    return jsonify(pid=os.getpid(), routes=sqlite.stats.snapshot(), writer=sqlite.writer_stats.snapshot(sqlite.queue_depth))
@@ -0,0 +1,53 @@
+"""Provides full-text search over posts and comments for the Social Insecurity application.
+
+The FTS5 tables PostsSearch and CommentsSearch index the texts of Posts and Comments, and are kept up to date by
+the triggers in app/migrations/0003_search.sql. This module turns what a user typed into an FTS5 query,
+and contains the commands for rebuilding the indexes.
+
+Example:
+    $ flask search rebuild
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Optional
+
+import click
+from flask.cli import AppGroup
+
+from app import shards, sqlite
+
+# Only the first terms of a search are used, each term makes the query slower
+MAX_TERMS = 10
+
+search_cli = AppGroup("search", help="Manage the full-text search indexes.")
+
+_TERM_PATTERN = re.compile(r"\w+")
+
+
+def match_expression(text: str) -> Optional[str]:
+    """Returns an FTS5 query that matches texts containing all words of the search, or None if it has no words.
+
+    Every word is quoted, so FTS5 operators and syntax typed by the user are searched for as plain words.
+    """
+    terms = _TERM_PATTERN.findall(text)[:MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def rebuild() -> None:
+    """Rebuilds the search indexes from the Posts and Comments tables and merges their segments."""
+    with sqlite.transaction() as conn:
+        for table in ("PostsSearch", "CommentsSearch"):
+            conn.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild');")
+            conn.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize');")
+
+
+@search_cli.command("rebuild")
+def rebuild_command() -> None:
+    """Rebuild the search indexes of all posts and comments."""
+    shards.require_unsharded()
+    rebuild()
+    click.echo("Rebuilt the search indexes.")
@@ -0,0 +1,370 @@
+"""Provides the posts and comments of the Social Insecurity application when they are spread over shard files.
+
+With SQLITE3_SHARDS above 1, the posts of a user and the comments on those posts are stored in the shard file that
+the id of the user hashes to, see SQLite3.shard_of(), while the users, friendships and everything else stay in the
+main database. The ids of posts and comments are allocated by the PostKeys and CommentKeys tables of the main
+database, which also record the author of each post, so a post is found without asking every shard.
+The stream is read by scatter-gather: the user and their mutual friends are grouped by shard, each shard returns
+its newest posts of those authors in parallel, and the pages are merged by (creation_time, id).
+A new post or comment takes a single write to the main database, which allocates its id. Each shard file has
+its own Versions table, bumped in the same transaction as the post or comment, and the pages read from the shards
+are stamped with those counters, see shard_versions().
+
+The timelines, the search indexes, live updates, 'flask db import', 'flask db archive' and the comment count
+commands only cover the posts in the main database. init_app() refuses to start with SEARCH_ENABLED or
+EVENTS_ENABLED while the posts are sharded, and those commands refuse to run, see require_unsharded().
+After changing SQLITE3_SHARDS, stop the app and run 'flask db reshard' to move the posts to their new shards,
+SQLITE3_SHARDS = 1 moves them all back into the main database.
+
+Example:
+    $ flask db reshard
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import sqlite3
+from collections.abc import Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import click
+from flask import Flask
+
+from app import friend_graph, sqlite
+
+# Features that only cover the posts in the main database, which must be off while the posts are sharded
+MAIN_DATABASE_FEATURES = ("EVENTS_ENABLED", "SEARCH_ENABLED")
+
+
+def init_app(app: Flask) -> None:
+    """Checks that the features that only cover the main database are off when the posts are sharded.
+
+    raises: RuntimeError if SQLITE3_SHARDS is above 1 while one of MAIN_DATABASE_FEATURES is enabled.
+
+    """
+    enabled = [name for name in MAIN_DATABASE_FEATURES if app.config[name]]
+    if app.config["SQLITE3_SHARDS"] > 1 and enabled:
+        raise RuntimeError(
+            f"SQLITE3_SHARDS is {app.config['SQLITE3_SHARDS']}, but {' and '.join(enabled)} only cover the posts "
+            "in the main database, set them to False"
+        )
+
+
+def enabled() -> bool:
+    """Returns whether the posts and comments are stored in shard files."""
+    return sqlite.shards > 1
+
+
+def require_unsharded() -> None:
+    """Stops a command that only covers the posts in the main database when the posts are sharded.
+
+    raises: click.UsageError if SQLITE3_SHARDS is above 1.
+
+    """
+    if enabled():
+        raise click.UsageError(
+            "This command only covers the posts in the main database, set SQLITE3_SHARDS to 1 and run "
+            "'flask db reshard' first."
+        )
+
+
+def post_author(post_id: int) -> Optional[int]:
+    """Returns the id of the author of a post, whose shard holds the post, or None if the post does not exist."""
+    row = sqlite.read("SELECT u_id FROM PostKeys WHERE id = ?;", post_id, one=True)
+    return row["u_id"] if row is not None else None
+
+
+def insert_post(user_id: int, content: str, image: Optional[str]) -> int:
+    """Inserts a post into the shard of its author.
+
+    returns: The id of the post.
+
+    """
+    insert_post = """
+        INSERT INTO Posts (id, u_id, content, image, creation_time)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP);
+        """
+    post_id = sqlite.write_batched("INSERT INTO PostKeys (u_id) VALUES (?);", user_id)
+    # The triggers of the shard bump its own version counters in the same transaction, see shard_versions()
+    try:
+        with sqlite.shard_transaction(sqlite.shard_of(user_id)) as conn:
+            conn.execute(insert_post, (post_id, user_id, content, image))
+    except BaseException:
+        sqlite.write("DELETE FROM PostKeys WHERE id = ?;", post_id)
+        raise
+    return post_id
+
+
+def insert_comment(post_id: int, user_id: int, comment: str) -> Optional[int]:
+    """Inserts a comment into the shard of the post it comments on.
+
+    returns: The id of the comment, or None if the post does not exist.
+
+    """
+    insert_comment = """
+        INSERT INTO Comments (id, p_id, u_id, comment, creation_time)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP);
+        """
+    author = post_author(post_id)
+    if author is None:
+        return None
+    comment_id = sqlite.write_batched("INSERT INTO CommentKeys (p_id) VALUES (?);", post_id)
+    try:
+        with sqlite.shard_transaction(sqlite.shard_of(author)) as conn:
+            conn.execute(insert_comment, (comment_id, post_id, user_id, comment))
+    except BaseException:
+        sqlite.write("DELETE FROM CommentKeys WHERE id = ?;", comment_id)
+        raise
+    return comment_id
+
+
+def shard_versions(user_ids: Iterable[int]) -> list[tuple[int, int, int]]:
+    """Returns the (shard, posts version, comments version) of the shards holding the posts of some users.
+
+    The counters are bumped by the triggers of each shard file, see app/migrations/shards/0002_versions.sql.
+    """
+    get_versions = """
+        SELECT
+            (SELECT value FROM Versions WHERE name = 'posts') AS posts,
+            (SELECT value FROM Versions WHERE name = 'comments') AS comments;
+        """
+    indexes = sorted({sqlite.shard_of(user_id) for user_id in user_ids})
+    rows = sqlite.scatter({index: (get_versions, ()) for index in indexes})
+    return [(index, rows[index][0]["posts"], rows[index][0]["comments"]) for index in indexes]
+
+
+def post_stamp(post_id: int) -> tuple:
+    """Returns the comment count of a post and the id of its newest comment, read from the shard holding it."""
+    get_stamp = """
+        SELECT
+            (SELECT comment_count FROM Posts WHERE id = ?1) AS comment_count,
+            (SELECT MAX(id) FROM Comments WHERE p_id = ?1) AS last_comment;
+        """
+    author = post_author(post_id)
+    if author is None:
+        return None, None
+    row = sqlite.read_shard(sqlite.shard_of(author), get_stamp, post_id, one=True)
+    return row["comment_count"], row["last_comment"]
+
+
+def get_post(post_id: int) -> Optional[dict[str, Any]]:
+    """Returns a post joined with the row of its author, or None if it does not exist."""
+    author = post_author(post_id)
+    if author is None:
+        return None
+    post = sqlite.read_shard(sqlite.shard_of(author), "SELECT * FROM Posts WHERE id = ?;", post_id, one=True)
+    posts = with_authors([post]) if post is not None else []
+    return posts[0] if posts else None
+
+
+def get_comments(post_id: int) -> list[dict[str, Any]]:
+    """Returns the comments of a post joined with the rows of their authors, newest first."""
+    get_comments = """
+        SELECT *
+        FROM Comments
+        WHERE p_id = ?
+        ORDER BY creation_time DESC;
+        """
+    author = post_author(post_id)
+    if author is None:
+        return []
+    return with_authors(sqlite.read_shard(sqlite.shard_of(author), get_comments, post_id))
+
+
+def feed(user_id: int, before: str, before_id: int, limit: int) -> list[dict[str, Any]]:
+    """Returns the posts of a user and their mutual friends older than a cursor, newest first.
+
+    params:
+        user_id: The id of the user whose stream is read.
+        before: The creation time of the cursor, only older posts are returned.
+        before_id: The post id of the cursor, breaks ties between posts created at the same time.
+        limit: The maximum number of posts returned.
+
+    returns: The posts joined with the rows of their authors.
+
+    """
+    get_posts = """
+        SELECT *
+        FROM Posts
+        WHERE u_id IN (SELECT value FROM json_each(?)) AND (creation_time, id) < (?, ?)
+        ORDER BY creation_time DESC, id DESC
+        LIMIT ?;
+        """
+    authors: dict[int, list[int]] = {}
+    for author in sorted({user_id, *friend_graph.mutual_friends(user_id)}):
+        authors.setdefault(sqlite.shard_of(author), []).append(author)
+    # The authors are passed as one JSON array, so the statement is the same for any number of friends
+    pages = sqlite.scatter(
+        {index: (get_posts, (json.dumps(ids), before, before_id, limit)) for index, ids in authors.items()}
+    )
+    # Every shard returns its page newest first, so the newest posts overall are at the head of the merge
+    merged = heapq.merge(*pages.values(), key=lambda post: (post["creation_time"], post["id"]), reverse=True)
+    return with_authors(itertools.islice(merged, limit))
+
+
+def image_owners(filename: str) -> set[int]:
+    """Returns the ids of the users that posted an uploaded file, which may be stored in any shard."""
+    get_owners = """
+        SELECT DISTINCT u_id
+        FROM Posts
+        WHERE image = ?;
+        """
+    rows = sqlite.scatter({index: (get_owners, (filename,)) for index in range(sqlite.shards)})
+    return {row["u_id"] for shard_rows in rows.values() for row in shard_rows}
+
+
+def with_authors(rows: Iterable[Mapping[str, Any]]) -> list[dict[str, Any]]:
+    """Returns the rows of a shard joined with the rows of their authors from the main database.
+
+    The columns of a row take precedence over the ones of its author, like the first of two columns
+    with the same name in a query.
+    """
+    get_users = """
+        SELECT *
+        FROM Users
+        WHERE id IN (SELECT value FROM json_each(?));
+        """
+    rows = list(rows)
+    if not rows:
+        return []
+    user_ids = sorted({row["u_id"] for row in rows})
+    users = {user["id"]: user for user in sqlite.read(get_users, json.dumps(user_ids))}
+    return [{**dict(users[row["u_id"]]), **dict(row)} for row in rows if row["u_id"] in users]
+
+
+def reshard(shards: int, batch_size: int = 1000, echo: Callable[[str], Any] = print) -> int:
+    """Moves every post and its comments to the shard file of its author for a number of shards.
+
+    The posts are read from the main database and every existing shard file, and moved batch by batch.
+    A batch is copied to its target file in one transaction, checked, and deleted from its source file in another,
+    since a transaction over two files in WAL mode is not atomic. An interrupted run can be started again,
+    the rows that were already copied are skipped.
+    Shard files that are no longer used are removed once they are empty. Stop the app before resharding.
+
+    params:
+        shards: The new number of shards, 1 moves every post into the main database.
+        batch_size (optional): The number of posts moved per transaction.
+        echo (optional): Called with a line of progress for every pair of files.
+
+    returns: The number of posts moved.
+
+    """
+    main = sqlite.path
+    sources = [main, *sorted(sqlite.existing_shards().values())]
+    targets = {index: sqlite.shard_path(index) for index in range(shards)} if shards > 1 else {0: main}
+    for path in targets.values():
+        if path != main:
+            sqlite.migrate_shard(path)
+
+    if shards > 1:
+        # Posts that were written to the main database get their keys, so they can be found in a shard
+        fill_keys = [
+            "INSERT OR REPLACE INTO PostKeys (id, u_id) SELECT id, u_id FROM Posts;",
+            "INSERT OR REPLACE INTO CommentKeys (id, p_id) SELECT id, p_id FROM Comments;",
+        ]
+        with sqlite.transaction() as conn:
+            for statement in fill_keys:
+                conn.execute(statement)
+
+    get_authors = """
+        SELECT DISTINCT u_id
+        FROM Posts
+        WHERE u_id IS NOT NULL;
+        """
+    get_post_ids = """
+        SELECT id
+        FROM Posts
+        WHERE u_id IN (SELECT value FROM json_each(?))
+        ORDER BY id;
+        """
+    # The comment counts are recounted by the triggers of the target as the comments are inserted
+    copy_rows = [
+        """
+        INSERT OR IGNORE INTO target.Posts (id, u_id, content, image, creation_time, comment_count)
+        SELECT id, u_id, content, image, creation_time, 0 FROM main.Posts WHERE id IN (SELECT value FROM json_each(?));
+        """,
+        """
+        INSERT OR IGNORE INTO target.Comments (id, p_id, u_id, comment, creation_time)
+        SELECT id, p_id, u_id, comment, creation_time FROM main.Comments WHERE p_id IN (SELECT value FROM json_each(?));
+        """,
+    ]
+    count_missing = """
+        SELECT
+            (SELECT COUNT(*) FROM main.Posts AS p WHERE p.id IN (SELECT value FROM json_each(?1))
+             AND NOT EXISTS (SELECT 1 FROM target.Posts AS t WHERE t.id = p.id))
+          + (SELECT COUNT(*) FROM main.Comments AS c WHERE c.p_id IN (SELECT value FROM json_each(?1))
+             AND NOT EXISTS (SELECT 1 FROM target.Comments AS t WHERE t.id = c.id));
+        """
+    delete_rows = [
+        "DELETE FROM main.Comments WHERE p_id IN (SELECT value FROM json_each(?));",
+        "DELETE FROM main.Posts WHERE id IN (SELECT value FROM json_each(?));",
+    ]
+    moved = 0
+    for source in sources:
+        with _connect(source) as conn:
+            authors: dict[Path, list[int]] = {}
+            for row in conn.execute(get_authors):
+                target = targets[sqlite.shard_of(row["u_id"], shards) if shards > 1 else 0]
+                if target != source:
+                    authors.setdefault(target, []).append(row["u_id"])
+            for target, user_ids in authors.items():
+                post_ids = [row["id"] for row in conn.execute(get_post_ids, (json.dumps(user_ids),))]
+                conn.execute("ATTACH DATABASE ? AS target;", (str(target),))
+                try:
+                    for start in range(0, len(post_ids), batch_size):
+                        batch = json.dumps(post_ids[start : start + batch_size])
+                        # A transaction over two WAL files is only atomic per file, so the rows are copied and
+                        # committed first, and only deleted from the source once the copy is verified
+                        _run_transaction(conn, copy_rows, (batch,))
+                        missing = conn.execute(count_missing, (batch,)).fetchone()[0]
+                        if missing:
+                            raise RuntimeError(f"{missing} rows were not copied from {source.name} to {target.name}")
+                        _run_transaction(conn, delete_rows, (batch,))
+                finally:
+                    conn.execute("DETACH DATABASE target;")
+                moved += len(post_ids)
+                echo(f"Moved {len(post_ids)} posts from {source.name} to {target.name}.")
+
+    sqlite.close_shards()
+    for index, path in sqlite.existing_shards().items():
+        if targets.get(index) == path:
+            continue
+        with _connect(path) as conn:
+            remaining = conn.execute("SELECT COUNT(*) FROM Posts;").fetchone()[0]
+        if remaining:
+            echo(f"Kept {path.name}, it still holds {remaining} posts.")
+            continue
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{path}{suffix}").unlink(missing_ok=True)
+        echo(f"Removed {path.name}.")
+    # Invalidate the caches of all workers at once, as the version triggers of the shard files do not exist
+    sqlite.write("UPDATE Versions SET value = value + 1;")
+    return moved
+
+
+def _run_transaction(conn: sqlite3.Connection, statements: list[str], params: Any) -> None:
+    """Runs statements with the same parameters in one transaction on a connection in autocommit mode."""
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        for statement in statements:
+            conn.execute(statement, params)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+@contextmanager
+def _connect(path: Path) -> Iterator[sqlite3.Connection]:
+    """Opens a connection to a database file for resharding, closed at the end of the with block."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout = 10000;")
+    try:
+        yield conn
+    finally:
+        conn.close()
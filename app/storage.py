@@ -0,0 +1,150 @@
+"""Provides content-addressed storage of uploaded files for the Social Insecurity application.
+
+Uploads are written to a temporary file in the uploads folder while the request is parsed,
+hashing the bytes as they arrive. The finished file is then atomically renamed to a path derived from its
+SHA-256 hash, sharded into two levels of subfolders, so identical files are stored only once
+and finding a free filename never needs a loop of existence checks.
+The key of a stored file, '<sha256>.<extension>', is what Posts.image holds.
+
+Example:
+    from app import storage
+
+    key = storage.store(request.files["image"], "png")
+    path = storage.resolve(key)  # <instance>/uploads/ab/cd/abcd....png
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import IO, Any, Optional
+
+from flask import Request, current_app
+from werkzeug.datastructures import FileStorage
+
+# Size of the chunks read when copying an upload that was not hashed while parsing the request
+CHUNK_SIZE = 64 * 1024
+
+_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload is larger than MAX_CONTENT_LENGTH."""
+
+
+class HashingFile:
+    """Provides a temporary file in the uploads folder that hashes everything written to it.
+
+    The file is removed when it is closed, unless it was moved into the store with store().
+    """
+
+    def __init__(self, directory: Path) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix="upload-", delete=False)
+        self._hash = hashlib.sha256()
+        self.path = Path(self._file.name)
+        self.size = 0
+        self.stored = False
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self) -> None:
+        self._file.close()
+        if not self.stored:
+            self.path.unlink(missing_ok=True)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Provides a request that streams uploaded files straight into the uploads folder while hashing them."""
+
+    def _get_file_stream(
+        self,
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str] = None,
+        content_length: Optional[int] = None,
+    ) -> IO[bytes]:
+        return HashingFile(_temporary_folder())
+
+
+def store(upload: FileStorage, extension: str) -> str:
+    """Moves an uploaded file into the store, unless a file with the same content is already stored.
+
+    params:
+        upload: The uploaded file.
+        extension: The file extension, without the leading dot.
+
+    raises: UploadTooLarge if the upload is larger than MAX_CONTENT_LENGTH.
+
+    returns: The key of the stored file.
+
+    """
+    stream = upload.stream
+    if not isinstance(stream, HashingFile):
+        stream = _copy_to_hashing_file(stream)
+
+    stream.flush()
+    os.fsync(stream.fileno())
+    key = f"{stream.hexdigest()}.{extension.lower()}"
+    path = resolve(key)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(stream.path, path)
+        stream.stored = True
+    stream.close()
+    return key
+
+
+def is_key(filename: str) -> bool:
+    """Returns whether the filename is the key of a file in the content-addressed store."""
+    return _KEY_PATTERN.match(filename) is not None
+
+
+def resolve(filename: str) -> Path:
+    """Returns the path of a stored file.
+
+    Keys are resolved to their sharded path, other names to the flat uploads folder used before the store existed.
+    """
+    if is_key(filename):
+        return upload_folder() / filename[:2] / filename[2:4] / filename
+    return upload_folder() / filename
+
+
+def upload_folder() -> Path:
+    """Returns the absolute path of the uploads folder."""
+    return Path(current_app.instance_path) / current_app.config["UPLOADS_FOLDER_PATH"]
+
+
+def _temporary_folder() -> Path:
+    """Returns the folder for uploads in progress, on the same file system as the store so renames are atomic."""
+    return upload_folder() / ".tmp"
+
+
+def _copy_to_hashing_file(source: IO[bytes]) -> HashingFile:
+    """Copies a stream into a hashing temporary file in chunks, enforcing MAX_CONTENT_LENGTH as it goes."""
+    limit = current_app.config.get("MAX_CONTENT_LENGTH")
+    target = HashingFile(_temporary_folder())
+    try:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            target.write(chunk)
+            if limit is not None and target.size > limit:
+                raise UploadTooLarge(f"Uploads may not be larger than {limit} bytes")
+    except BaseException:
+        target.close()
+        raise
+    return target
@@ -0,0 +1,208 @@
+"""Provides the "people you may know" suggestions of the Social Insecurity application.
+
+A suggestion for a user is someone who is a mutual friend of one or more of the user's mutual friends,
+ranked by the number of those friends. Counting them with self-joins of the Friends table on every page view
+is too slow for users with many friends, so the suggestions are computed in batch into the Suggestions table.
+
+The computation copies the friendships from the graph every worker already holds in memory, see app/graph.py,
+into a compressed sparse row (CSR) adjacency of the mutual friendships: one array with the neighbours of every user
+back to back, and one with the offset where each user's neighbours start.
+The friends-of-friends of a user are then counted in a dense array of counters, one per user.
+
+Friendship changes queue the two users in SuggestionsDirty, see app/migrations/0004_suggestions.sql.
+After a friend is added the queue is processed on a background thread, and 'flask suggestions refresh' processes it
+from the command line, e.g. from cron. Only the queued users and their mutual friends are recomputed,
+from the friendships within two hops of them.
+
+Example:
+    $ flask suggestions refresh
+    $ flask suggestions refresh --all
+"""
+
+from __future__ import annotations
+
+import heapq
+import logging
+from array import array
+from collections.abc import Iterable
+from typing import Optional
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+
+from app import friend_graph, sqlite, versions
+from app.workers import BoundedExecutor, ExecutorSaturated
+
+logger = logging.getLogger(__name__)
+
+# One refresh running and one waiting, the waiting one covers every change queued after the running one started
+suggestions_executor = BoundedExecutor("suggestions", max_workers=1, max_pending=2)
+
+suggestions_cli = AppGroup("suggestions", help="Manage the people you may know suggestions.")
+
+
+class MutualGraph:
+    """Provides the mutual friendships as a compressed sparse row adjacency.
+
+    Users are numbered 0 to n - 1 in order of their id. The neighbours of user i are
+    indices[indptr[i]:indptr[i + 1]], and requested[i] holds the ids of the users that i has added as friends
+    without being added back, which are not suggested either.
+    """
+
+    def __init__(self, edges: Iterable[tuple[int, int, bool]]) -> None:
+        """Builds the adjacency.
+
+        params:
+            edges: The (u_id, f_id, mutual) rows of the Friends table, ordered by u_id.
+
+        """
+        rows = [(u_id, f_id, mutual) for u_id, f_id, mutual in edges if u_id != f_id]
+        self.ids = array("q", sorted({u_id for u_id, _, _ in rows} | {f_id for _, f_id, _ in rows}))
+        self.index = {user_id: number for number, user_id in enumerate(self.ids)}
+        self.indptr = array("q", [0]) * (len(self.ids) + 1)
+        self.indices = array("q")
+        self.requested: dict[int, set[int]] = {}
+        for u_id, f_id, mutual in rows:
+            if mutual:
+                self.indices.append(self.index[f_id])
+                self.indptr[self.index[u_id] + 1] += 1
+            else:
+                self.requested.setdefault(u_id, set()).add(f_id)
+        for number in range(len(self.ids)):
+            self.indptr[number + 1] += self.indptr[number]
+        self._counts = array("q", [0]) * len(self.ids)
+
+    def neighbours(self, number: int) -> array:
+        """Returns the indices of the mutual friends of user number."""
+        return self.indices[self.indptr[number] : self.indptr[number + 1]]
+
+    def suggest(self, user_id: int, limit: int) -> list[tuple[int, int]]:
+        """Returns the (id, mutual friend count) of the best suggestions for a user, most mutual friends first."""
+        number = self.index.get(user_id)
+        if number is None:
+            return []
+        counts = self._counts
+        touched = []
+        for friend in self.neighbours(number):
+            for candidate in self.neighbours(friend):
+                if counts[candidate] == 0:
+                    touched.append(candidate)
+                counts[candidate] += 1
+
+        excluded = set(self.neighbours(number))
+        excluded.add(number)
+        requested = self.requested.get(user_id, ())
+        candidates = []
+        for candidate in touched:
+            if candidate not in excluded and self.ids[candidate] not in requested:
+                candidates.append((counts[candidate], -self.ids[candidate]))
+            counts[candidate] = 0
+        return [(-negative_id, count) for count, negative_id in heapq.nlargest(limit, candidates)]
+
+
+def load_graph(user_ids: Optional[Iterable[int]] = None) -> MutualGraph:
+    """Builds a MutualGraph from the friendship graph the worker holds in memory, see app/graph.py.
+
+    params:
+        user_ids (optional): The users whose friendships are included, all users if None.
+
+    """
+    return MutualGraph(friend_graph.edges(user_ids))
+
+
+def refresh(all_users: bool = False) -> int:
+    """Recomputes the suggestions of the queued users and their mutual friends, or of all users.
+
+    The friendship graph is brought up to date after the queue is read, so it includes every change
+    that queued a processed row. Only the friendships within two hops of the recomputed users are
+    copied into the MutualGraph, as suggest() does not look further.
+    Rows queued while the suggestions are computed are kept for the next refresh.
+
+    params:
+        all_users (optional): Whether to recompute the suggestions of every user.
+
+    returns: The number of users whose suggestions were recomputed.
+
+    """
+    get_dirty = """
+        SELECT id, u_id
+        FROM SuggestionsDirty;
+        """
+    dirty = sqlite.read(get_dirty)
+    last_processed = max((row["id"] for row in dirty), default=0)
+    versions.refresh()
+
+    if all_users:
+        users = {row["id"] for row in sqlite.read("SELECT id FROM Users;")}
+        graph = load_graph()
+    else:
+        users = {row["u_id"] for row in dirty}
+        # The friends-of-friends of their mutual friends changed as well
+        users.update(*[friend_graph.mutual_friends(user_id) for user_id in users])
+        graph = load_graph(users.union(*[friend_graph.mutual_friends(user_id) for user_id in users]))
+    limit = current_app.config["SUGGESTIONS_PER_USER"]
+    rows = [(user_id, s_id, count) for user_id in users for s_id, count in graph.suggest(user_id, limit)]
+
+    delete_suggestions = """
+        DELETE FROM Suggestions
+        WHERE u_id = ?;
+        """
+    insert_suggestions = """
+        INSERT INTO Suggestions (u_id, s_id, mutual_count)
+        VALUES (?, ?, ?);
+        """
+    delete_dirty = """
+        DELETE FROM SuggestionsDirty
+        WHERE id <= ?;
+        """
+    with sqlite.transaction() as conn:
+        if all_users:
+            conn.execute("DELETE FROM Suggestions;")
+        else:
+            conn.executemany(delete_suggestions, [(user_id,) for user_id in users])
+        conn.executemany(insert_suggestions, rows)
+        conn.execute(delete_dirty, (last_processed,))
+    return len(users)
+
+
+def schedule_refresh() -> None:
+    """Queues a refresh of the changed suggestions on the background executor.
+
+    If a refresh is already waiting it covers the new changes as well, so the new one is skipped.
+    """
+    try:
+        suggestions_executor.submit(_refresh_in_background, current_app._get_current_object())
+    except ExecutorSaturated:
+        pass
+
+
+def get_suggestions(user_id: int, limit: Optional[int] = None) -> list:
+    """Returns the suggested users for a user, with their username and mutual friend count, best first.
+
+    Users the user has added as a friend since the suggestions were computed are left out.
+    """
+    get_suggested = """
+        SELECT u.id, u.username, s.mutual_count
+        FROM Suggestions AS s JOIN Users AS u ON u.id = s.s_id
+        WHERE s.u_id = ? AND NOT EXISTS (SELECT 1 FROM Friends AS f WHERE f.u_id = s.u_id AND f.f_id = s.s_id)
+        ORDER BY s.mutual_count DESC, s.s_id
+        LIMIT ?;
+        """
+    return sqlite.read(get_suggested, user_id, limit or current_app.config["SUGGESTIONS_PER_USER"])
+
+
+def _refresh_in_background(app: Flask) -> None:
+    with app.app_context():
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Could not refresh the friend suggestions")
+
+
+@suggestions_cli.command("refresh")
+@click.option("--all", "all_users", is_flag=True, help="Recompute the suggestions of every user.")
+def refresh_command(all_users: bool) -> None:
+    """Recompute the suggestions of users whose friendships changed."""
+    count = refresh(all_users)
+    click.echo(f"Refreshed the suggestions of {count} users.")
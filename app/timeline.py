@@ -0,0 +1,50 @@
+"""Provides the precomputed timelines for the Social Insecurity application.
+
+Each user has a timeline in the Timelines table holding the ids of the posts shown on their stream,
+which are their own posts and the posts of their mutual friends.
+The timelines are kept up to date by the triggers in app/migrations/ when posts and friendships are added or removed,
+this module only contains the command for rebuilding them from scratch.
+
+Example:
+    $ flask timeline rebuild
+"""
+
+import click
+from flask.cli import AppGroup
+
+from app import shards, sqlite
+
+timeline_cli = AppGroup("timeline", help="Manage the precomputed stream timelines.")
+
+
+def rebuild() -> int:
+    """Rebuilds the timelines of all users from the Posts and Friends tables.
+
+    returns: The number of timeline entries written.
+
+    """
+    delete_timelines = """
+        DELETE FROM Timelines;
+        """
+    insert_timelines = """
+        INSERT OR IGNORE INTO Timelines (u_id, p_id, creation_time)
+        SELECT p.u_id, p.id, p.creation_time
+        FROM Posts AS p
+        UNION ALL
+        SELECT f.u_id, p.id, p.creation_time
+        FROM Friends AS f
+        JOIN Friends AS r ON r.u_id = f.f_id AND r.f_id = f.u_id
+        JOIN Posts AS p ON p.u_id = f.f_id
+        WHERE f.u_id != f.f_id;
+        """
+    with sqlite.transaction() as conn:
+        conn.execute(delete_timelines)
+        return conn.execute(insert_timelines).rowcount
+
+
+@timeline_cli.command("rebuild")
+def rebuild_command() -> None:
+    """Rebuild the timelines of all users from existing posts and friendships."""
+    shards.require_unsharded()
+    count = rebuild()
+    click.echo(f"Rebuilt timelines with {count} entries.")
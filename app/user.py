@@ -1,28 +1,83 @@
 """Provides user login management for the Social Insecurity application.
+
+Rows of the Users table are cached in memory by id and by username, so an authenticated request
+does not need to query the Users table to load the logged-in user.
+With USER_CACHE_SHARED enabled the cached rows are validated against the 'users' version counter,
+which the triggers in app/migrations/ bump on every change, so updates made by other workers are seen immediately.
 """
+from __future__ import annotations
+
+from typing import Any, Optional
+
 import flask_login
+from flask import Flask, current_app
 from flask_login import LoginManager
-from app import app, sqlite
+from app import sqlite, versions
+from app.cache import LRUCache
+
+login_manager = LoginManager()
+
+def init_app(app: Flask) -> None:
+    """Initializes the login manager and creates the user cache of the app, sized from its configuration."""
+    login_manager.init_app(app)
+    app.extensions["user_cache"] = LRUCache(maxsize=app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"])
 
-login_manager = LoginManager(app)
 
 class User(flask_login.UserMixin):
     pass
 
+
+def get_user_row(*, user_id: Optional[int | str] = None, username: Optional[str] = None) -> Optional[dict[str, Any]]:
+    """Returns the Users row with the given id or username, from the cache when possible.
+
+    params:
+        user_id (optional): The id of the user.
+        username (optional): The username of the user, used if no id is given.
+
+    returns: The row as a dictionary, or None if there is no such user.
+
+    """
+    key = ("id", int(user_id)) if user_id is not None else ("username", username)
+    version = versions.get("users") if current_app.config["USER_CACHE_SHARED"] else None
+    user_cache = current_app.extensions["user_cache"]
+    cached = user_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    get_user = f"""
+        SELECT *
+        FROM Users
+        WHERE {"id" if key[0] == "id" else "username"} = ?;
+        """
+    db_user = sqlite.read(get_user, key[1], one=True)
+    if db_user is None:
+        return None
+
+    row = dict(db_user)
+    user_cache.set(("id", row["id"]), (version, row))
+    user_cache.set(("username", row["username"]), (version, row))
+    return row
+
+
+def invalidate_user(row: dict[str, Any]) -> None:
+    """Removes a user from the cache of this worker after their row was changed."""
+    user_cache = current_app.extensions["user_cache"]
+    user_cache.discard(("id", row["id"]))
+    user_cache.discard(("username", row["username"]))
+
+
 """ The user_loader callback is used to reload the user object from the user ID stored in the session.
  It should take the str ID of a user, and return the corresponding user object.
- It should return None (not raise an exception) if the ID is not valid. (In that case, 
+ It should return None (not raise an exception) if the ID is not valid. (In that case,
  the ID will manually be removed from the session and processing will continue.)
 """
 @login_manager.user_loader
 def user_loader(user_id):
     """Check if user is logged-in on every page load."""
-    get_user = f"""
-        SELECT *
-        FROM Users
-        WHERE id = '{user_id}';
-        """
-    db_user = sqlite.query(get_user, one=True)
+    try:
+        db_user = get_user_row(user_id=user_id)
+    except ValueError:
+        return None
 
     if db_user is not None and str(db_user["id"]) == str(user_id):
         user = User()
@@ -31,6 +86,8 @@ def user_loader(user_id):
         user.first_name = str(db_user["first_name"])
         user.last_name = str(db_user["last_name"])
         user.full_name = str(db_user["first_name"]) + " " + str(db_user["last_name"])
+        # The full row, so routes do not have to query the logged-in user again
+        user.row = db_user
         return user
     else:
         return None
@@ -0,0 +1,42 @@
+"""Provides access to the version counters of the Social Insecurity application.
+
+The Versions table holds one counter per kind of data, which the triggers in app/migrations/ bump on every change.
+Caches held in memory by the app workers compare these counters to decide if they are stale,
+which keeps them consistent across all gunicorn workers without any extra infrastructure.
+
+Example:
+    from app import versions
+
+    if versions.get("friends") != cached_version:
+        reload_cache()
+"""
+
+from flask import current_app, g
+
+
+def get(name: str) -> int:
+    """Returns the current value of the named version counter.
+
+    All counters are read with a single query the first time one is needed in a request,
+    later calls in the same request reuse that snapshot.
+
+    params:
+        name: The name of the counter, e.g. 'friends'.
+
+    returns: The value of the counter, or 0 if it does not exist.
+
+    """
+    snapshot = getattr(g, "versions", None)
+    if snapshot is None:
+        get_versions = """
+            SELECT name, value
+            FROM Versions;
+            """
+        rows = current_app.extensions["sqlite3"].read(get_versions)
+        snapshot = g.versions = {row["name"]: row["value"] for row in rows}
+    return snapshot.get(name, 0)
+
+
+def refresh() -> None:
+    """Discards the snapshot of the current request, so the next call to get() reads the counters again."""
+    g.pop("versions", None)
@@ -0,0 +1,87 @@
+"""Provides bounded background executors for the Social Insecurity application.
+
+Work that is slow or CPU heavy, like password hashing, runs on a small dedicated thread pool per worker process.
+Each pool limits how much work may be waiting, so a burst of requests is rejected quickly
+instead of piling up behind the pool and starving every other route.
+
+Example:
+    from app.workers import BoundedExecutor, ExecutorSaturated
+
+    executor = BoundedExecutor("example", max_workers=2, max_pending=8)
+    try:
+        result = executor.submit(pow, 2, 10).result(timeout=5)
+    except ExecutorSaturated:
+        result = None
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class ExecutorSaturated(RuntimeError):
+    """Raised when a task is submitted to an executor that already has the maximum number of pending tasks."""
+
+
+class BoundedExecutor:
+    """Provides a thread pool that rejects new tasks when too many are pending.
+
+    The pool is created lazily and belongs to the process that created it,
+    so a forked gunicorn worker starts its own threads instead of inheriting dead ones.
+    """
+
+    def __init__(self, name: str, *, max_workers: int = 2, max_pending: Optional[int] = None) -> None:
+        """Initializes the executor.
+
+        params:
+            name: The name of the executor, used to name its threads.
+            max_workers (optional): The number of threads running tasks.
+            max_pending (optional): The maximum number of tasks running or queued, defaults to 4 per thread.
+
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending if max_pending is not None else max_workers * 4
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Returns the number of tasks that are running or queued."""
+        return self._pending
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Schedules fn(*args, **kwargs) to run on the pool.
+
+        raises: ExecutorSaturated if the maximum number of tasks are already pending.
+
+        returns: A future for the result of the task.
+
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self._pid = os.getpid()
+                self._pending = 0
+            if self._pending >= self.max_pending:
+                raise ExecutorSaturated(f"The {self.name} executor has {self._pending} pending tasks")
+            self._pending += 1
+            future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the threads of the pool, it is recreated on the next submit()."""
+        with self._lock:
+            executor, self._executor, self._pid = self._executor, None, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _task_done(self, future: Future) -> None:
+        with self._lock:
+            self._pending = max(self._pending - 1, 0)
@@ -0,0 +1,4 @@
+"""Provides benchmarks for the Social Insecurity application.
+
+The benchmarks are plain scripts run with 'pdm run python -m benchmarks.<name>', they are not part of the test suite.
+"""
@@ -0,0 +1,52 @@
+"""Measures how many logins per second can be verified at each bcrypt cost.
+
+Each login is one bcrypt check, run on a pool of threads like the password hashing executor of the app.
+Use the results to choose BCRYPT_LOG_ROUNDS and PASSWORD_HASH_WORKERS in app/config.py.
+
+Example:
+    $ pdm run python -m benchmarks.bcrypt_cost --rounds 10 11 12 13 --threads 2 --duration 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+def logins_per_second(rounds: int, threads: int, duration: float) -> float:
+    """Returns the number of password checks per second at the given cost, using the given number of threads."""
+    password = b"correct horse battery staple"
+    pw_hash = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+    def check_until(deadline: float) -> int:
+        checks = 0
+        while time.perf_counter() < deadline:
+            bcrypt.checkpw(password, pw_hash)
+            checks += 1
+        return checks
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(check_until, start + duration) for _ in range(threads)]
+        checks = sum(future.result() for future in futures)
+    return checks / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 11, 12, 13, 14], help="bcrypt costs to measure")
+    parser.add_argument("--threads", type=int, default=2, help="threads checking passwords at the same time")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds to measure each cost")
+    args = parser.parse_args()
+
+    print(f"{'rounds':>6}  {'logins/s':>10}  {'ms/login':>9}")
+    for rounds in args.rounds:
+        rate = logins_per_second(rounds, args.threads, args.duration)
+        print(f"{rounds:>6}  {rate:>10.1f}  {1000 * args.threads / rate:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Generates synthetic social networks for the benchmarks of the Social Insecurity application.
+
+The database is created by the migrations of the app, so the triggers fill the timelines, comment counts and version
+counters exactly as they would for real users. Every user gets the password PASSWORD, hashed with a low bcrypt cost
+to keep generation fast; the app upgrades a hash to BCRYPT_LOG_ROUNDS on the first login of its user.
+
+This module does not import the app package, so it can create a database before the app is started on it.
+
+Example:
+    $ pdm run python -m benchmarks.dataset instance/benchmark.db --users 2000 --friend-degree 30 --distribution powerlaw
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import string
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+import bcrypt
+from PIL import Image
+
+PASSWORD = "benchmark-password"
+ROOT = Path(__file__).resolve().parent.parent
+# Rows inserted per executemany call
+BATCH_SIZE = 5000
+
+
+def generate(
+    database: Path,
+    uploads: Optional[Path] = None,
+    *,
+    users: int = 1000,
+    posts_per_user: int = 10,
+    friend_degree: int = 20,
+    distribution: str = "powerlaw",
+    mutual_ratio: float = 0.9,
+    comments_per_post: float = 3.0,
+    images: int = 20,
+    image_ratio: float = 0.2,
+    bcrypt_rounds: int = 4,
+    seed: int = 0,
+) -> dict[str, int]:
+    """Replaces the contents of a database with a synthetic social network.
+
+    params:
+        database: The path of the SQLite3 database, it is deleted and created again by the migrations of the app.
+        uploads: The uploads folder to store the images in, or None to create posts without images.
+        users: The number of users.
+        posts_per_user: The average number of posts of a user.
+        friend_degree: The average number of users each user adds as a friend.
+        distribution: How the friend degree varies between users, 'uniform' or 'powerlaw' (a few very popular users).
+        mutual_ratio: The share of friendships that are added back, which makes them mutual.
+        comments_per_post: The average number of comments on a post.
+        images: The number of distinct images.
+        image_ratio: The share of posts that have an image.
+        bcrypt_rounds: The bcrypt cost of the password hashes.
+        seed: The seed of the random generator, the same arguments and seed give the same network.
+
+    returns: The number of rows created in each table, and of images stored.
+
+    """
+    rng = random.Random(seed)
+    counts = {}
+    create_database(database)
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE;")
+        counts["users"] = _insert_users(conn, rng, users, bcrypt_rounds)
+        counts["friends"], friends = _insert_friends(conn, rng, users, friend_degree, distribution, mutual_ratio)
+        keys = _store_images(uploads, rng, images) if uploads is not None else []
+        counts["images"] = len(keys)
+        counts["posts"], authors = _insert_posts(conn, rng, users, posts_per_user, keys, image_ratio)
+        counts["comments"] = _insert_comments(conn, rng, authors, friends, comments_per_post)
+        conn.execute("COMMIT;")
+        conn.execute("ANALYZE;")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        raise
+    finally:
+        conn.close()
+    return counts
+
+
+def create_database(database: Path) -> None:
+    """Replaces a database with an empty one, created by running 'flask db migrate' on it."""
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{database}{suffix}").unlink(missing_ok=True)
+    environment = dict(os.environ, SQLITE3_DATABASE_PATH=str(Path(database).resolve()))
+    command = [sys.executable, "-m", "flask", "--app", "app", "db", "migrate"]
+    subprocess.run(command, cwd=ROOT, env=environment, check=True, stdout=subprocess.DEVNULL)
+
+
+def username(user_id: int) -> str:
+    """Returns the username of a generated user."""
+    return f"user{user_id}"
+
+
+def _insert_users(conn: sqlite3.Connection, rng: random.Random, users: int, bcrypt_rounds: int) -> int:
+    """Inserts the users with ids 1 to users."""
+    salt_alphabet = string.ascii_letters + string.digits
+    rows = []
+    for user_id in range(1, users + 1):
+        name = username(user_id)
+        hash_salt = "".join(rng.choice(salt_alphabet) for _ in range(8))
+        pw_hash = bcrypt.hashpw((hash_salt + PASSWORD + name).encode(), bcrypt.gensalt(bcrypt_rounds))
+        rows.append((user_id, name, "First", f"Last{user_id}", pw_hash.decode(), hash_salt))
+    insert_users = """
+        INSERT INTO Users (id, username, first_name, last_name, password, hash_salt)
+        VALUES (?, ?, ?, ?, ?, ?);
+        """
+    return _insert(conn, insert_users, rows)
+
+
+def _insert_friends(
+    conn: sqlite3.Connection,
+    rng: random.Random,
+    users: int,
+    friend_degree: int,
+    distribution: str,
+    mutual_ratio: float,
+) -> tuple[int, dict[int, list[int]]]:
+    """Inserts the friendships, returns their number and the mutual friends of each user."""
+    edges = set()
+    for user_id in range(1, users + 1):
+        for friend_id in rng.sample(range(1, users + 1), _degree(rng, users, friend_degree, distribution)):
+            if friend_id == user_id:
+                continue
+            edges.add((user_id, friend_id))
+            if rng.random() < mutual_ratio:
+                edges.add((friend_id, user_id))
+    friends = {user_id: [] for user_id in range(1, users + 1)}
+    for user_id, friend_id in edges:
+        if (friend_id, user_id) in edges:
+            friends[user_id].append(friend_id)
+
+    insert_friends = """
+        INSERT INTO Friends (u_id, f_id)
+        VALUES (?, ?);
+        """
+    return _insert(conn, insert_friends, sorted(edges)), friends
+
+
+def _degree(rng: random.Random, users: int, friend_degree: int, distribution: str) -> int:
+    """Returns the number of friends a user adds, drawn from the distribution with mean friend_degree."""
+    if distribution == "uniform":
+        degree = rng.randint(0, 2 * friend_degree)
+    elif distribution == "powerlaw":
+        # A Pareto distribution with shape 2 has mean 2, so half the degree is its minimum
+        degree = int(friend_degree / 2 * rng.paretovariate(2.0))
+    else:
+        raise ValueError(f"Unknown friend degree distribution: {distribution}")
+    return min(degree, users - 1)
+
+
+def _store_images(uploads: Path, rng: random.Random, images: int) -> list[str]:
+    """Stores distinct PNG images in the content-addressed layout of app/storage.py, returns their keys."""
+    keys = []
+    for _ in range(images):
+        image = Image.new("RGB", (1600, 1200), tuple(rng.randrange(256) for _ in range(3)))
+        image.paste(tuple(rng.randrange(256) for _ in range(3)), (0, 0, rng.randrange(1, 1600), rng.randrange(1, 1200)))
+        data = BytesIO()
+        image.save(data, format="PNG")
+        key = f"{hashlib.sha256(data.getvalue()).hexdigest()}.png"
+        path = uploads / key[:2] / key[2:4] / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data.getvalue())
+        keys.append(key)
+    return keys
+
+
+def _insert_posts(
+    conn: sqlite3.Connection,
+    rng: random.Random,
+    users: int,
+    posts_per_user: int,
+    keys: list[str],
+    image_ratio: float,
+) -> tuple[int, dict[int, tuple[int, datetime]]]:
+    """Inserts the posts, spread over the last year, returns their number and the author and time of each post."""
+    now = datetime.now().replace(microsecond=0)
+    posts = {}
+    rows = []
+    for post_id in range(1, users * posts_per_user + 1):
+        author = rng.randint(1, users)
+        creation_time = now - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        image = rng.choice(keys) if keys and rng.random() < image_ratio else None
+        posts[post_id] = (author, creation_time)
+        rows.append((post_id, author, f"Post {post_id} by {username(author)}", image, _format(creation_time)))
+    insert_posts = """
+        INSERT INTO Posts (id, u_id, content, image, creation_time)
+        VALUES (?, ?, ?, ?, ?);
+        """
+    return _insert(conn, insert_posts, rows), posts
+
+
+def _insert_comments(
+    conn: sqlite3.Connection,
+    rng: random.Random,
+    posts: dict[int, tuple[int, datetime]],
+    friends: dict[int, list[int]],
+    comments_per_post: float,
+) -> int:
+    """Inserts the comments, made by the author of the post or one of their mutual friends."""
+    rows = []
+    for post_id, (author, creation_time) in posts.items():
+        count = round(rng.expovariate(1 / comments_per_post)) if comments_per_post > 0 else 0
+        for _ in range(count):
+            commenter = rng.choice(friends[author] or [author])
+            commented = creation_time + timedelta(seconds=rng.randrange(7 * 24 * 3600))
+            rows.append((post_id, commenter, f"Comment on post {post_id}", _format(commented)))
+    insert_comments = """
+        INSERT INTO Comments (p_id, u_id, comment, creation_time)
+        VALUES (?, ?, ?, ?);
+        """
+    return _insert(conn, insert_comments, rows)
+
+
+def _insert(conn: sqlite3.Connection, query: str, rows: list[tuple]) -> int:
+    """Inserts the rows in batches, returns their number."""
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.executemany(query, rows[start : start + BATCH_SIZE])
+    return len(rows)
+
+
+def _format(moment: datetime) -> str:
+    """Returns a time in the format stored by the app."""
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database", type=Path, help="SQLite3 database to replace with the network")
+    parser.add_argument("--uploads", type=Path, help="uploads folder for the images, posts have no images without it")
+    parser.add_argument("--users", type=int, default=1000, help="number of users")
+    parser.add_argument("--posts-per-user", type=int, default=10, help="average number of posts of a user")
+    parser.add_argument("--friend-degree", type=int, default=20, help="average number of friends a user adds")
+    parser.add_argument("--distribution", choices=["uniform", "powerlaw"], default="powerlaw", help="friend degrees")
+    parser.add_argument("--mutual-ratio", type=float, default=0.9, help="share of friendships that are mutual")
+    parser.add_argument("--comments-per-post", type=float, default=3.0, help="average number of comments on a post")
+    parser.add_argument("--images", type=int, default=20, help="number of distinct images")
+    parser.add_argument("--image-ratio", type=float, default=0.2, help="share of posts with an image")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate(
+        args.database,
+        args.uploads,
+        users=args.users,
+        posts_per_user=args.posts_per_user,
+        friend_degree=args.friend_degree,
+        distribution=args.distribution,
+        mutual_ratio=args.mutual_ratio,
+        comments_per_post=args.comments_per_post,
+        images=args.images,
+        image_ratio=args.image_ratio,
+        seed=args.seed,
+    )
+    summary = ", ".join(f"{count} {table}" for table, count in counts.items())
+    print(f"Created {summary} in {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""Measures the latency and throughput of the hot routes of the Social Insecurity application.
+
+A synthetic network is generated with benchmarks/dataset.py into a separate database in the instance folder,
+then the routes are requested one route at a time by a set of logged-in users, either in-process through
+the Flask test client or over HTTP against a multi-process gunicorn server. For each route the p50, p95 and p99
+latency and the requests per second are reported. Results can be saved as a baseline and later runs compared to it,
+the comparison exits with status 1 when a route got slower than the tolerance allows.
+
+Example:
+    $ pdm run python -m benchmarks.load --mode client --users 2000 --save-baseline baseline.json
+    $ pdm run python -m benchmarks.load --mode gunicorn --workers 4 --concurrency 8 --compare baseline.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import Cookie, CookieJar
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from benchmarks import dataset
+
+ROOT = Path(__file__).resolve().parent.parent
+ROUTES = ("stream", "comments", "friends", "profile", "uploads", "index")
+# The status each route answers a successful request with, a login redirects to the stream
+EXPECTED_STATUS = {"index": 302}
+
+_CSRF_TOKEN_PATTERN = re.compile(rb'name="csrf_token" value="([^"]+)"')
+
+
+class ClientSession:
+    """Provides a browser session that requests pages through the Flask test client."""
+
+    def __init__(self, app: Any) -> None:
+        self._client = app.test_client()
+
+    def request(self, method: str, path: str, data: Optional[dict] = None) -> tuple[int, bytes]:
+        response = self._client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+
+class HttpSession:
+    """Provides a browser session that requests pages from a server over HTTP, keeping its cookies."""
+
+    def __init__(self, base_url: str, cookies: Iterable[Cookie] = ()) -> None:
+        self._base_url = base_url
+        self._cookies = CookieJar()
+        for cookie in cookies:
+            self._cookies.set_cookie(cookie)
+        self._opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self._cookies), _NoRedirect())
+
+    def cookies(self) -> list[Cookie]:
+        """Returns the cookies of the session, to continue it in another process."""
+        return list(self._cookies)
+
+    def request(self, method: str, path: str, data: Optional[dict] = None) -> tuple[int, bytes]:
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self._opener.open(urllib.request.Request(self._base_url + path, data=body, method=method)) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Returns redirects as responses, so a login is measured without the stream page it redirects to."""
+
+    def redirect_request(self, *args: Any) -> None:
+        return None
+
+
+def login(session: ClientSession | HttpSession, username: str) -> int:
+    """Logs a generated user in, returns the status of the login request."""
+    status, _ = session.request("POST", "/", login_form(session, username))
+    return status
+
+
+def login_form(session: ClientSession | HttpSession, username: str) -> dict[str, str]:
+    """Opens the index page and returns the filled-in login form, including its CSRF token."""
+    _, page = session.request("GET", "/")
+    match = _CSRF_TOKEN_PATTERN.search(page)
+    return {
+        "login-username": username,
+        "login-password": dataset.PASSWORD,
+        "login-submit": "Sign In",
+        "csrf_token": match.group(1).decode() if match else "",
+    }
+
+
+def plan(database: Path, route: str, users: list[str], count: int, rng: random.Random) -> list[tuple[str, str]]:
+    """Returns the (username, path) of each request to make to a route, picking pages each user may see."""
+    conn = sqlite3.connect(database)
+    try:
+        requests = []
+        for _ in range(count):
+            username = rng.choice(users)
+            user_id = int(username.removeprefix("user"))
+            if route == "comments":
+                get_posts = "SELECT p_id FROM Timelines WHERE u_id = ? ORDER BY creation_time DESC LIMIT 50;"
+                posts = [row[0] for row in conn.execute(get_posts, (user_id,))]
+                path = f"/comments/{username}/{rng.choice(posts)}" if posts else f"/stream/{username}"
+            elif route == "profile":
+                get_friends = """
+                    SELECT f.f_id
+                    FROM Friends AS f JOIN Friends AS r ON r.u_id = f.f_id AND r.f_id = f.u_id
+                    WHERE f.u_id = ?
+                    LIMIT 50;
+                    """
+                friends = [row[0] for row in conn.execute(get_friends, (user_id,))]
+                path = f"/profile/{dataset.username(rng.choice(friends))}" if friends else f"/profile/{username}"
+            elif route == "uploads":
+                get_images = """
+                    SELECT p.image
+                    FROM Timelines AS t JOIN Posts AS p ON p.id = t.p_id
+                    WHERE t.u_id = ? AND p.image IS NOT NULL
+                    LIMIT 50;
+                    """
+                images = [row[0] for row in conn.execute(get_images, (user_id,))]
+                if not images:
+                    continue
+                path = f"/uploads/{rng.choice(images)}?variant=feed"
+            elif route == "index":
+                path = "/"
+            else:
+                path = f"/{route}/{username}"
+            requests.append((username, path))
+        return requests
+    finally:
+        conn.close()
+
+
+def run_requests(route: str, requests: list[tuple[str, str]], sessions: dict[str, Any], new_session) -> dict:
+    """Makes the requests one after another and returns their latencies in seconds and the number of errors.
+
+    Sessions are logged in before their first request, outside the measurement. For the index route
+    every request is the login of a new session, only posting the login form is measured.
+    """
+    latencies = []
+    errors = 0
+    for username, path in requests:
+        if route == "index":
+            session = new_session()
+            form = login_form(session, username)
+            start = time.perf_counter()
+            status, _ = session.request("POST", path, form)
+        else:
+            session = sessions.get(username)
+            if session is None:
+                session = sessions[username] = new_session()
+                login(session, username)
+            start = time.perf_counter()
+            status, _ = session.request("GET", path)
+        latencies.append(time.perf_counter() - start)
+        if status != EXPECTED_STATUS.get(route, 200):
+            errors += 1
+    return {"latencies": latencies, "errors": errors}
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict[str, float]:
+    """Returns the request count, errors, requests per second and latency percentiles in milliseconds."""
+    ordered = sorted(latencies)
+    summary = {"requests": len(ordered), "errors": errors, "rps": len(ordered) / elapsed if elapsed else 0.0}
+    for percentile in (50, 95, 99):
+        rank = max(0, math.ceil(percentile / 100 * len(ordered)) - 1)
+        summary[f"p{percentile}"] = 1000 * ordered[rank] if ordered else 0.0
+    return summary
+
+
+def benchmark_client(args: argparse.Namespace) -> dict[str, dict]:
+    """Runs the benchmark in this process through the Flask test client."""
+    _generate(args)
+    os.environ["SQLITE3_DATABASE_PATH"] = args.database
+    os.environ["UPLOADS_FOLDER_PATH"] = args.uploads
+    from app import create_app  # Imported here, so the app opens the benchmark database
+
+    app = create_app()
+
+    users, plans = _plans(args)
+    sessions = {}
+    _warm_up(users, sessions, lambda: ClientSession(app))
+    results = {}
+    for route, requests in plans.items():
+        start = time.perf_counter()
+        outcome = run_requests(route, requests, sessions, lambda: ClientSession(app))
+        results[route] = summarize(outcome["latencies"], outcome["errors"], time.perf_counter() - start)
+    return results
+
+
+def benchmark_gunicorn(args: argparse.Namespace) -> dict[str, dict]:
+    """Runs the benchmark against a gunicorn server, with one client process per concurrent request."""
+    address = f"127.0.0.1:{args.port}"
+    base_url = f"http://{address}"
+    environment = dict(os.environ, SQLITE3_DATABASE_PATH=args.database, UPLOADS_FOLDER_PATH=args.uploads)
+    _generate(args)
+    command = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", address, "socialinsecurity:app"]
+    server = subprocess.Popen(command, cwd=ROOT, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_until_ready(base_url, server)
+        users, plans = _plans(args)
+        sessions = {}
+        _warm_up(users, sessions, lambda: HttpSession(base_url))
+        # The client processes continue the logged-in sessions, so no login slows down the measured requests
+        cookies = {username: session.cookies() for username, session in sessions.items()}
+        results = {}
+        with multiprocessing.Pool(args.concurrency, _init_client_process, (base_url, cookies)) as pool:
+            for route, requests in plans.items():
+                chunks = [(route, requests[number :: args.concurrency]) for number in range(args.concurrency)]
+                start = time.perf_counter()
+                outcomes = pool.map(_run_chunk, chunks, chunksize=1)
+                elapsed = time.perf_counter() - start
+                latencies = [latency for outcome in outcomes for latency in outcome["latencies"]]
+                results[route] = summarize(latencies, sum(outcome["errors"] for outcome in outcomes), elapsed)
+        return results
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+_client_process = {}
+
+
+def _init_client_process(base_url: str, cookies: dict[str, list[Cookie]]) -> None:
+    """Sets up a client process with the sessions of the active users, they are kept for all the routes it requests."""
+    _client_process["base_url"] = base_url
+    _client_process["sessions"] = {username: HttpSession(base_url, jar) for username, jar in cookies.items()}
+
+
+def _run_chunk(chunk: tuple[str, list[tuple[str, str]]]) -> dict:
+    route, requests = chunk
+    base_url = _client_process["base_url"]
+    return run_requests(route, requests, _client_process["sessions"], lambda: HttpSession(base_url))
+
+
+def _wait_until_ready(base_url: str, server: subprocess.Popen, timeout: float = 30.0) -> None:
+    """Waits until the server answers requests."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            with urllib.request.urlopen(base_url + "/", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"gunicorn did not answer within {timeout} seconds")
+
+
+def _generate(args: argparse.Namespace) -> None:
+    instance = ROOT / "instance"
+    counts = dataset.generate(
+        instance / args.database,
+        instance / args.uploads,
+        users=args.users,
+        posts_per_user=args.posts_per_user,
+        friend_degree=args.friend_degree,
+        distribution=args.distribution,
+        comments_per_post=args.comments_per_post,
+        seed=args.seed,
+    )
+    print("Dataset: " + ", ".join(f"{count} {table}" for table, count in counts.items()), file=sys.stderr)
+
+
+def _plans(args: argparse.Namespace) -> tuple[list[str], dict[str, list[tuple[str, str]]]]:
+    """Returns the active users and the requests to make to each route."""
+    rng = random.Random(args.seed)
+    users = [dataset.username(user_id) for user_id in rng.sample(range(1, args.users + 1), args.active_users)]
+    database = ROOT / "instance" / args.database
+    return users, {route: plan(database, route, users, args.requests, rng) for route in args.routes}
+
+
+def _warm_up(users: list[str], sessions: dict[str, Any], new_session) -> None:
+    """Logs every active user in once.
+
+    The first login of a generated user upgrades its password hash to BCRYPT_LOG_ROUNDS,
+    so afterwards the index route measures logins at the configured cost.
+    """
+    for username in users:
+        sessions[username] = new_session()
+        login(sessions[username], username)
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """Prints the change of each route since the baseline, returns the routes that got slower than tolerated."""
+    regressions = []
+    print(f"\n{'route':<10} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8}   (change since the baseline)")
+    for route, summary in results.items():
+        before = baseline.get(route)
+        if before is None:
+            continue
+        changes = {key: _change(summary[key], before[key]) for key in ("p50", "p95", "p99", "rps")}
+        print(f"{route:<10} " + " ".join(f"{change:>+7.1%}" for change in changes.values()))
+        if changes["p95"] > tolerance or changes["rps"] < -tolerance:
+            regressions.append(route)
+    return regressions
+
+
+def _change(value: float, before: float) -> float:
+    return (value - before) / before if before else 0.0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["client", "gunicorn"], default="client", help="how requests are made")
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=list(ROUTES), help="routes to measure")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--active-users", type=int, default=50, help="number of users making the requests")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests in gunicorn mode")
+    parser.add_argument("--port", type=int, default=8765, help="port of the gunicorn server")
+    parser.add_argument("--database", default="benchmark.db", help="database, relative to the instance folder")
+    parser.add_argument("--uploads", default="benchmark-uploads", help="uploads folder, relative to the instance folder")
+    parser.add_argument("--users", type=int, default=1000, help="number of users in the dataset")
+    parser.add_argument("--posts-per-user", type=int, default=10, help="average number of posts of a user")
+    parser.add_argument("--friend-degree", type=int, default=20, help="average number of friends a user adds")
+    parser.add_argument("--distribution", choices=["uniform", "powerlaw"], default="powerlaw", help="friend degrees")
+    parser.add_argument("--comments-per-post", type=float, default=3.0, help="average number of comments on a post")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the dataset and the requests")
+    parser.add_argument("--save-baseline", type=Path, help="save the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="compare the results to a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown of p95 and req/s, e.g. 0.2")
+    args = parser.parse_args()
+    args.active_users = min(args.active_users, args.users)
+
+    results = benchmark_gunicorn(args) if args.mode == "gunicorn" else benchmark_client(args)
+
+    print(f"{'route':<10} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+    for route, summary in results.items():
+        print(
+            f"{route:<10} {summary['requests']:>8} {summary['errors']:>6} {summary['p50']:>8.2f} "
+            f"{summary['p95']:>8.2f} {summary['p99']:>8.2f} {summary['rps']:>8.1f}"
+        )
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps({"mode": args.mode, "routes": results}, indent=2))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare(results, baseline["routes"], args.tolerance)
+        if regressions:
+            print(f"\nSlower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Provides the gunicorn configuration of the Social Insecurity application.
+
+gunicorn reads this file from the working directory, see run.sh. The app is created once in the master process,
+so its migrations, compiled templates and friendship graph are shared with every worker copy-on-write,
+and each worker only opens its own database connections after it has been forked.
+Code changes are not picked up by 'kill -HUP' with a preloaded app, restart gunicorn instead.
+"""
+
+from gunicorn.workers.gthread import ThreadWorker
+from gunicorn.workers.sync import SyncWorker
+
+from app import init_worker
+
+# Create the app in the master, before the workers are forked
+preload_app = True
+
+# Every open event stream occupies a thread of its worker, so a worker needs more threads than
+# EVENTS_MAX_SUBSCRIBERS to keep serving other requests, see app/events.py.
+# The password hashing executor and the group commit of the writer also expect concurrent requests in a worker
+worker_class = "gthread"
+threads = 64
+
+
+def post_fork(server, worker):
+    """Creates the per-worker resources of a worker that was just forked from the master."""
+    if isinstance(worker, ThreadWorker):
+        concurrency = worker.cfg.threads
+    elif isinstance(worker, SyncWorker):
+        concurrency = 1
+    else:
+        # The asynchronous workers serve up to worker_connections requests at once
+        concurrency = worker.cfg.worker_connections
+    init_worker(server.app.wsgi(), concurrency)
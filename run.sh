@@ -1,5 +1,5 @@
 #!/bin/bash
 
-#pdm run gunicorn -b 0.0.0.0 --access-logfile=- --error-logfile=- --reload -w 10 'app:app'
-pdm run gunicorn -b 0.0.0.0 --access-logfile=- --error-logfile=- 'app:app'
+#pdm run gunicorn -b 0.0.0.0 --access-logfile=- --error-logfile=- --reload -w 10 'socialinsecurity:app'
+pdm run gunicorn -b 0.0.0.0 --access-logfile=- --error-logfile=- 'socialinsecurity:app'
 
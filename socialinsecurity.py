@@ -5,9 +5,12 @@
 To start the application enter 'pdm run flask --debug run' in a terminal.
 
 As an alternative, this file can also be run directly with 'pdm run python socialinsecurity.py'.
+In production it is served by gunicorn, see run.sh and gunicorn.conf.py.
 """
 
-from app import app
+from app import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,12 @@
+from __future__ import annotations
+
+import atexit
+import os
+import shutil
+import tempfile
+
+# The app opens its database when it is imported, so point it at a temporary one before any test imports it
+_instance = tempfile.mkdtemp(prefix="socialinsecurity-tests-")
+atexit.register(shutil.rmtree, _instance, ignore_errors=True)
+os.environ["SQLITE3_DATABASE_PATH"] = os.path.join(_instance, "sqlite3.db")
+os.environ["UPLOADS_FOLDER_PATH"] = os.path.join(_instance, "uploads")
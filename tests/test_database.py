@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+
+import pytest
+from flask import Flask, g
+
+from app.database import ConnectionPool, SQLite3
+
+
+@pytest.fixture()
+def db(tmp_path: Path) -> SQLite3:
+    app = Flask(__name__, instance_path=str(tmp_path))
+    db = SQLite3(app)
+    with app.app_context():
+        db.write("CREATE TABLE Items (id INTEGER PRIMARY KEY, name VARCHAR);")
+        yield db
+
+
+def test_pool_reuses_configured_connections(tmp_path: Path):
+    pool = ConnectionPool(tmp_path / "pool.db", size=1, timeout=0.01, pragmas={"journal_mode": "WAL"})
+    conn = pool.acquire()
+    assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+    pool.release(conn)
+    assert pool.acquire() is conn
+    pool.release(conn)
+    pool.close()
+
+
+def test_pool_replaces_broken_connections(tmp_path: Path):
+    pool = ConnectionPool(tmp_path / "pool.db", size=1)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.close()
+
+    replacement = pool.acquire()
+    assert replacement is not conn
+    assert replacement.execute("SELECT 1;").fetchone()[0] == 1
+    pool.release(replacement)
+
+
+def test_transaction_commits_or_rolls_back(db: SQLite3):
+    with db.transaction():
+        assert db.write_many("INSERT INTO Items (name) VALUES (?);", [("a",), ("b",)]) == 2
+
+    with pytest.raises(ZeroDivisionError):
+        with db.transaction():
+            db.write("INSERT INTO Items (name) VALUES (?);", "c")
+            1 / 0
+
+    assert [row["name"] for row in db.read("SELECT name FROM Items ORDER BY id;")] == ["a", "b"]
+    assert db.read("SELECT COUNT(*) AS n FROM Items;", one=True)["n"] == 2
+    assert not db.connection.in_transaction
+
+
+def test_reads_are_read_only_and_writes_share_the_writer(db: SQLite3):
+    with pytest.raises(sqlite3.OperationalError):
+        db.connection.execute("INSERT INTO Items (name) VALUES ('sneaky');")
+    with db.writer() as conn:
+        assert db.connection is conn
+        with db.transaction() as inner:
+            assert inner is conn
+            db.write("INSERT INTO Items (name) VALUES ('a');")
+            assert db.read("SELECT COUNT(*) FROM Items;", one=True)[0] == 1
+    assert db.connection is not conn
+    stats = db.writer_stats.snapshot(db.queue_depth)
+    assert stats["commit"]["count"] >= 1 and stats["lock_wait"]["count"] >= 1
+
+
+def test_batched_writes_share_a_commit(tmp_path: Path):
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config.update(SQLITE3_GROUP_COMMIT=True, SQLITE3_GROUP_COMMIT_WINDOW=0.05)
+    db = SQLite3(app)
+    with app.app_context():
+        db.write("CREATE TABLE Items (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE);")
+    rowids = []
+
+    def insert(name: str) -> None:
+        with app.app_context():
+            rowids.append(db.write_batched("INSERT INTO Items (name) VALUES (?);", name))
+
+    threads = [threading.Thread(target=insert, args=(f"item {number}",)) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        assert sorted(rowids) == [row["id"] for row in db.read("SELECT id FROM Items ORDER BY id;")]
+        # A failing statement fails alone, not the batch it was committed with
+        with pytest.raises(sqlite3.IntegrityError):
+            db.write_batched("INSERT INTO Items (name) VALUES (?);", "item 0")
+        assert db.write_batched("INSERT INTO Items (name) VALUES (?);", "item 8") == 9
+        # Errors other than sqlite3.Error fail their statement without stopping the group commit thread
+        with pytest.raises(OverflowError):
+            db.write_batched("INSERT INTO Items (id, name) VALUES (?, ?);", 2**64, "too large")
+        assert db.write_batched("INSERT INTO Items (name) VALUES (?);", "item 9") == 10
+        stats = db.writer_stats.snapshot(db.queue_depth)
+    assert stats["batched_write"]["count"] == 12 and stats["batches"] < 12 and stats["queue_depth"] == 0
+
+
+def test_migrations_are_applied_once(tmp_path: Path):
+    migrations = tmp_path / "migrations"
+    migrations.mkdir()
+    (migrations / "0001_items.sql").write_text(
+        "CREATE TABLE IF NOT EXISTS Items (id INTEGER PRIMARY KEY, name VARCHAR, count INTEGER DEFAULT 0);\n"
+        "CREATE TRIGGER IF NOT EXISTS ItemsCount AFTER INSERT ON Items\n"
+        "BEGIN\n"
+        "  UPDATE Items SET count = count + 1 WHERE id = NEW.id;\n"
+        "END;\n"
+    )
+    app = Flask(__name__, instance_path=str(tmp_path), root_path=str(tmp_path))
+    db = SQLite3(app, migrations="migrations")
+    with app.app_context():
+        assert db.schema_version() == 1
+        db.write("INSERT INTO Items (name) VALUES ('kept');")
+
+        (migrations / "0002_items_by_name.sql").write_text("CREATE INDEX ItemsByName ON Items(name);\n")
+        assert db.migrate() == ["0002_items_by_name.sql"]
+        assert db.migrate() == []
+        assert db.schema_version() == 2
+        assert [row["name"] for row in db.read("SELECT name FROM Migrations ORDER BY version;")] == [
+            "0001_items.sql",
+            "0002_items_by_name.sql",
+        ]
+        assert db.read("SELECT name, count FROM Items;", one=True)[:] == ("kept", 1)
+
+
+def test_failed_migration_is_rolled_back(tmp_path: Path):
+    migrations = tmp_path / "migrations"
+    migrations.mkdir()
+    (migrations / "0001_broken.sql").write_text("CREATE TABLE Items (id INTEGER PRIMARY KEY);\nSELECT * FROM Missing;\n")
+    app = Flask(__name__, instance_path=str(tmp_path), root_path=str(tmp_path))
+    app.config["SQLITE3_MIGRATE_ON_START"] = False
+    db = SQLite3(app, migrations="migrations")
+    with app.app_context():
+        with pytest.raises(sqlite3.OperationalError):
+            db.migrate()
+        assert db.schema_version() == 0
+        assert db.read("SELECT name FROM sqlite_master WHERE name = 'Items';") == []
+
+
+def test_database_made_by_schema_sql_is_adopted(tmp_path: Path):
+    # The tables of the former schema.sql, with a few rows from before the migrations
+    conn = sqlite3.connect(tmp_path / "sqlite3.db")
+    conn.executescript(
+        """
+        CREATE TABLE Users (id INTEGER PRIMARY KEY, username VARCHAR, first_name VARCHAR, last_name VARCHAR,
+          password VARCHAR, education VARCHAR, employment VARCHAR, music VARCHAR, movie VARCHAR,
+          nationality VARCHAR, birthday DATE, hash_salt VARCHAR);
+        CREATE TABLE Posts (id INTEGER PRIMARY KEY, u_id INTEGER, content INTEGER, image VARCHAR,
+          creation_time DATETIME);
+        CREATE TABLE Friends (u_id INTEGER NOT NULL, f_id INTEGER NOT NULL, PRIMARY KEY(u_id, f_id));
+        CREATE TABLE Comments (id INTEGER PRIMARY KEY, p_id INTEGER, u_id INTEGER, comment VARCHAR,
+          creation_time DATETIME);
+        INSERT INTO Users (id, username) VALUES (1, 'u1'), (2, 'u2'), (3, 'u3');
+        INSERT INTO Friends (u_id, f_id) VALUES (1, 2), (2, 1), (1, 3);
+        INSERT INTO Posts (id, u_id, content, creation_time) VALUES (1, 1, 'old post', '2020-01-01 00:00:00');
+        INSERT INTO Comments (id, p_id, u_id, comment, creation_time) VALUES (1, 1, 2, 'old', '2020-01-02 00:00:00');
+        """
+    )
+    conn.close()
+
+    app = Flask(__name__, instance_path=str(tmp_path), root_path=str(Path(__file__).parent.parent / "app"))
+    db = SQLite3(app, migrations="migrations")
+    with app.app_context():
+        assert db.schema_version() == db.migrations()[-1][0]
+        assert db.read("SELECT comment_count FROM Posts WHERE id = 1;", one=True)[0] == 1
+        # User 3 has not added user 1 back, so the post is only on the timelines of users 1 and 2
+        assert [row[0] for row in db.read("SELECT u_id FROM Timelines WHERE p_id = 1 ORDER BY u_id;")] == [1, 2]
+        db.write("INSERT INTO Comments (p_id, u_id, comment, creation_time) VALUES (1, 1, 'new', CURRENT_TIMESTAMP);")
+        assert db.read("SELECT comment_count FROM Posts WHERE id = 1;", one=True)[0] == 2
+
+
+def test_shards_are_migrated_and_read_in_parallel(tmp_path: Path):
+    migrations = tmp_path / "migrations"
+    (migrations / "shards").mkdir(parents=True)
+    (migrations / "0001_users.sql").write_text("CREATE TABLE IF NOT EXISTS Users (id INTEGER PRIMARY KEY);\n")
+    (migrations / "shards" / "0001_posts.sql").write_text(
+        "CREATE TABLE IF NOT EXISTS Posts (id INTEGER PRIMARY KEY, u_id INTEGER);\n"
+    )
+    app = Flask(__name__, instance_path=str(tmp_path), root_path=str(tmp_path))
+    app.config.update(SQLITE3_SHARDS=3, SQLITE3_SHARD_WORKERS=2)
+    db = SQLite3(app, migrations="migrations")
+    with app.app_context():
+        assert sorted(db.existing_shards()) == [0, 1, 2]
+        assert db.migrate() == []
+        # The shard of a user does not depend on the process, unlike hash()
+        assert [db.shard_of(user_id) for user_id in range(1, 7)] == [
+            zlib.crc32(user_id.to_bytes(8, "little")) % 3 for user_id in range(1, 7)
+        ]
+        for user_id in range(1, 7):
+            with db.shard_transaction(db.shard_of(user_id)) as conn:
+                conn.execute("INSERT INTO Posts (id, u_id) VALUES (?, ?);", (10 * user_id, user_id))
+        rows = db.scatter({index: ("SELECT u_id FROM Posts ORDER BY id;", ()) for index in range(3)})
+        assert sorted(row["u_id"] for shard_rows in rows.values() for row in shard_rows) == list(range(1, 7))
+        for index, shard_rows in rows.items():
+            assert all(db.shard_of(row["u_id"]) == index for row in shard_rows)
+        assert db.read("SELECT name FROM sqlite_master WHERE name = 'Posts';") == []
+
+    # The plans of slow shard statements are made on the shard they ran on, the main database has no Posts table
+    app.config.update(SQLITE3_SLOW_STATEMENT_MS=0.0)
+    with app.test_request_context():
+        g.sqlite3_statements = []
+        db.read_shard(0, "SELECT u_id FROM Posts WHERE id = ?;", 10)
+        db.scatter({1: ("SELECT u_id FROM Posts WHERE id = ?;", (20,))})
+        plans = [statement["plan"] for statement in g.sqlite3_statements]
+        assert len(plans) == 2 and all(plan and "Posts" in plan[0] for plan in plans)
+
+
+def test_sharded_posts_are_merged_and_resharded(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    from app import shards
+    from app.graph import FriendGraph
+
+    app = Flask(__name__, instance_path=str(tmp_path), root_path=str(Path(shards.__file__).parent))
+    app.config.update(SQLITE3_SHARDS=3)
+    db = SQLite3(app, migrations="migrations")
+    monkeypatch.setattr(shards, "sqlite", db)
+    monkeypatch.setattr(shards, "friend_graph", FriendGraph(app))
+    with app.app_context():
+        users = [(user_id, f"u{user_id}") for user_id in range(1, 7)]
+        db.write_many("INSERT INTO Users (id, username) VALUES (?, ?);", users)
+        db.write_many("INSERT INTO Friends (u_id, f_id) VALUES (?, ?);", [(1, 2), (2, 1), (1, 3), (3, 1), (1, 4)])
+        post_ids = [shards.insert_post(user_id, f"post {user_id}", None) for user_id in (1, 2, 3, 4, 5, 6, 2, 3)]
+        versions = {index: (posts, comments) for index, posts, comments in shards.shard_versions(range(1, 7))}
+        comment_id = shards.insert_comment(post_ids[1], 1, "first")
+        # Only the counters of the shard holding the post change, the main database is only written to for the id
+        shard = db.shard_of(2)
+        changed = {index: (posts, comments) for index, posts, comments in shards.shard_versions(range(1, 7))}
+        assert changed[shard] == (versions[shard][0] + 1, versions[shard][1] + 1)
+        assert all(changed[index] == versions[index] for index in versions if index != shard)
+        assert db.read("SELECT SUM(value) FROM Versions WHERE name IN ('posts', 'comments');", one=True)[0] == 0
+        assert shards.post_stamp(post_ids[1]) == (1, comment_id)
+
+        # User 4 has not added user 1 back, so only 1, 2 and 3 are on the stream, newest first
+        feed = shards.feed(1, "9999-12-31 23:59:59", 2**62, 10)
+        assert [post["id"] for post in feed] == [post_ids[7], post_ids[6], post_ids[2], post_ids[1], post_ids[0]]
+        assert feed[0]["username"] == "u3"
+        assert [post["id"] for post in shards.feed(1, feed[1]["creation_time"], feed[1]["id"], 2)] == post_ids[2:0:-1]
+        assert shards.get_post(post_ids[1])["comment_count"] == 1
+        assert [comment["id"] for comment in shards.get_comments(post_ids[1])] == [comment_id]
+
+        assert shards.reshard(1, batch_size=2, echo=lambda line: None) == 8
+        assert db.existing_shards() == {}
+        assert db.read("SELECT COUNT(*) FROM Posts;", one=True)[0] == 8
+        assert db.read("SELECT comment_count FROM Posts WHERE id = ?;", post_ids[1], one=True)[0] == 1
+        # The timeline triggers of the main database fan the moved posts out again
+        assert db.read("SELECT COUNT(*) FROM Timelines WHERE u_id = 1;", one=True)[0] == 5
+
+        shards.reshard(3, echo=lambda line: None)
+        assert db.read("SELECT COUNT(*) FROM Posts;", one=True)[0] == 0
+        resharded = shards.feed(1, "9999-12-31 23:59:59", 2**62, 10)
+        assert [post["id"] for post in resharded] == [post["id"] for post in feed]
+
+
+def test_sharding_refuses_features_that_only_cover_the_main_database(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    import click
+
+    from app import shards
+
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config.update(SQLITE3_SHARDS=3, EVENTS_ENABLED=True, SEARCH_ENABLED=False)
+    with pytest.raises(RuntimeError, match="EVENTS_ENABLED"):
+        shards.init_app(app)
+    app.config.update(EVENTS_ENABLED=False)
+    shards.init_app(app)
+
+    monkeypatch.setattr(shards, "enabled", lambda: True)
+    with pytest.raises(click.UsageError):
+        shards.require_unsharded()
+
+
+def test_ids_of_archived_posts_are_not_reused(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    from app import archive
+
+    app = Flask(__name__, instance_path=str(tmp_path), root_path=str(Path(archive.__file__).parent))
+    app.config.update(ARCHIVE_PERIOD="%Y", ARCHIVE_PATH="archive/posts-{period}.db")
+    db = SQLite3(app, migrations="migrations")
+    monkeypatch.setattr(archive, "sqlite", db)
+    with app.app_context():
+        db.write("INSERT INTO Users (id, username) VALUES (1, 'archivist');")
+        for number in range(3):
+            db.write("INSERT INTO Posts (u_id, content, creation_time) VALUES (1, ?, '2001-06-01');", f"old {number}")
+        db.write("INSERT INTO Comments (p_id, u_id, comment, creation_time) VALUES (3, 1, 'old', '2001-06-02');")
+        assert archive.archive(365, echo=lambda line: None) == 3
+
+        # The newest posts were archived, a new post must not take the id of one of them
+        post_id = db.write("INSERT INTO Posts (u_id, content, creation_time) VALUES (1, 'new', CURRENT_TIMESTAMP);")
+        assert post_id == 4 and archive.period_of(post_id) is None
+        comment_id = db.write("INSERT INTO Comments (p_id, u_id, comment) VALUES (?, 1, 'new');", post_id)
+        assert comment_id == 2
@@ -1,11 +1,19 @@
 from __future__ import annotations
 
+import datetime
+import secrets
+import sqlite3
+import threading
+import time
 from collections.abc import Iterator
+from io import BytesIO
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import pytest
+from PIL import Image
 
-from app import app
+from app import archive, create_app, events, passwords, sqlite, storage, suggestions
 
 if TYPE_CHECKING:
     from flask import Flask
@@ -14,14 +22,14 @@ if TYPE_CHECKING:
 
 @pytest.fixture(scope="session")
 def test_app() -> Iterator[Flask]:
-    app.config.update(
+    yield create_app(
         {
             "SQLITE3_DATABASE": "file::memory:?cache=shared",
             "TESTING": True,
             "WTF_CSRF_ENABLED": False,
+            "BCRYPT_LOG_ROUNDS": 4,
         }
     )
-    yield app
 
 
 @pytest.fixture()
@@ -32,3 +40,536 @@ def client(test_app: Flask) -> FlaskClient:
 def test_request_index(client: FlaskClient):
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_apps_keep_their_own_state(test_app: Flask, tmp_path: Path):
+    other = create_app(
+        {
+            "SQLITE3_DATABASE_PATH": str(tmp_path / "other.db"),
+            "UPLOADS_FOLDER_PATH": str(tmp_path / "uploads"),
+            "TESTING": True,
+            "FRAGMENT_CACHE_SIZE": 1,
+        }
+    )
+    for name in ("sqlite3_state", "friend_graph_state", "post_cards", "user_cache", "upload_auth_cache"):
+        assert other.extensions[name] is not test_app.extensions[name]
+    assert other.extensions["post_cards"].stats()["maxsize"] != test_app.extensions["post_cards"].stats()["maxsize"]
+    with other.app_context():
+        assert sqlite.path == tmp_path / "other.db"
+        assert sqlite.read("SELECT COUNT(*) FROM Users;", one=True)[0] == 0
+        sqlite.close()
+    # The first app still reads its own database
+    with test_app.app_context():
+        assert sqlite.path != tmp_path / "other.db"
+
+
+def register_and_login(client: FlaskClient, username: str, password: str = "password123") -> None:
+    client.post(
+        "/",
+        data={
+            "register-first_name": "Test",
+            "register-last_name": "User",
+            "register-username": username,
+            "register-password": password,
+            "register-confirm_password": password,
+            "register-submit": "Sign Up",
+        },
+    )
+    client.post(
+        "/",
+        data={"login-username": username, "login-password": password, "login-submit": "Sign In"},
+    )
+
+
+def test_stream_pagination(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(client.application.config, "STREAM_PAGE_SIZE", 2)
+    register_and_login(client, "paginator")
+    for number in range(3):
+        client.post("/stream/paginator", data={"content": f"post number {number}", "image": (BytesIO(), "")})
+
+    first_page = client.get("/stream/paginator").get_data(as_text=True)
+    assert "post number 2" in first_page and "post number 1" in first_page
+    assert "post number 0" not in first_page
+    assert "Older posts" in first_page
+
+    older_link = first_page.split('Older posts')[0].rsplit('href="', 1)[1].split('"')[0]
+    second_page = client.get(older_link.replace("&amp;", "&")).get_data(as_text=True)
+    assert "post number 0" in second_page and "post number 1" not in second_page
+    assert "Older posts" not in second_page
+    assert "Newest posts" in second_page
+
+
+def test_stream_shows_mutual_friends_posts(test_app: Flask):
+    alice, bob = test_app.test_client(), test_app.test_client()
+    register_and_login(alice, "timeline_alice")
+    register_and_login(bob, "timeline_bob")
+    bob.post("/stream/timeline_bob", data={"content": "hello from bob", "image": (BytesIO(), "")})
+
+    alice.post("/friends/timeline_alice", data={"username": "timeline_bob"})
+    assert "hello from bob" not in alice.get("/stream/timeline_alice").get_data(as_text=True)
+
+    bob.post("/friends/timeline_bob", data={"username": "timeline_alice"})
+    assert "hello from bob" in alice.get("/stream/timeline_alice").get_data(as_text=True)
+
+    result = test_app.test_cli_runner().invoke(args=["timeline", "rebuild"])
+    assert "Rebuilt timelines" in result.output
+    assert "hello from bob" in alice.get("/stream/timeline_alice").get_data(as_text=True)
+
+
+def test_profile_requires_mutual_friendship(test_app: Flask):
+    alice, bob = test_app.test_client(), test_app.test_client()
+    register_and_login(alice, "graph_alice")
+    register_and_login(bob, "graph_bob")
+
+    alice.post("/friends/graph_alice", data={"username": "graph_bob"})
+    assert alice.get("/profile/graph_bob").status_code == 302
+
+    bob.post("/friends/graph_bob", data={"username": "graph_alice"})
+    assert alice.get("/profile/graph_bob").status_code == 200
+    assert "graph_bob" in alice.get("/friends/graph_alice").get_data(as_text=True)
+
+    # A change made by another process must be picked up through the version counter
+    with sqlite3.connect(Path(test_app.instance_path) / test_app.config["SQLITE3_DATABASE_PATH"]) as conn:
+        conn.execute("DELETE FROM Friends WHERE u_id = (SELECT id FROM Users WHERE username = 'graph_bob');")
+    assert alice.get("/profile/graph_bob").status_code == 302
+
+
+def test_profile_update_invalidates_cached_user(client: FlaskClient):
+    register_and_login(client, "cached_user")
+    assert "Unknown" in client.get("/profile/cached_user").get_data(as_text=True)
+
+    client.post("/profile/cached_user", data={"education": "Cache University", "birthday": "2000-01-01"})
+    assert "Cache University" in client.get("/profile/cached_user").get_data(as_text=True)
+
+
+def test_login_rehashes_outdated_password_hash(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    register_and_login(client, "rehash_user")
+    client.get("/logout")
+    get_hash = "SELECT password FROM Users WHERE username = 'rehash_user';"
+    with client.application.app_context():
+        assert passwords.needs_rehash(sqlite.read(get_hash, one=True)["password"]) is False
+
+    monkeypatch.setitem(client.application.config, "BCRYPT_LOG_ROUNDS", 5)
+    register_and_login(client, "rehash_user")
+    with client.application.app_context():
+        pw_hash = sqlite.read(get_hash, one=True)["password"]
+    assert pw_hash.startswith(b"$2b$05$")
+
+
+def test_login_rejected_when_hashing_is_saturated(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    register_and_login(client, "saturated_user")
+    client.get("/logout")
+
+    monkeypatch.setattr(client.application.extensions["hash_executor"], "max_pending", 0)
+    response = client.post(
+        "/",
+        data={"login-username": "saturated_user", "login-password": "password123", "login-submit": "Sign In"},
+    )
+    assert response.status_code == 503
+
+
+def test_login_rejected_when_hashing_times_out(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    client = test_app.test_client()
+    register_and_login(client, "slow_hash_user")
+    client.get("/logout")
+
+    monkeypatch.setitem(test_app.config, "PASSWORD_HASH_TIMEOUT", 0.0)
+    monkeypatch.setattr(passwords.flask_bcrypt, "check_password_hash", lambda pw_hash, password: time.sleep(0.2))
+    response = client.post(
+        "/",
+        data={"login-username": "slow_hash_user", "login-password": "password123", "login-submit": "Sign In"},
+    )
+    assert response.status_code == 503
+
+
+def test_comment_count_is_maintained(test_app: Flask):
+    client = test_app.test_client()
+    register_and_login(client, "comment_counter")
+    client.post("/stream/comment_counter", data={"content": "count my comments", "image": (BytesIO(), "")})
+    with test_app.app_context():
+        post_id = sqlite.read("SELECT id FROM Posts WHERE content = 'count my comments';", one=True)["id"]
+
+    client.post(f"/comments/comment_counter/{post_id}", data={"comment": "first"})
+    client.post(f"/comments/comment_counter/{post_id}", data={"comment": "second"})
+    assert "Comments (2)" in client.get("/stream/comment_counter").get_data(as_text=True)
+
+    with test_app.app_context():
+        sqlite.write("UPDATE Posts SET comment_count = 0 WHERE id = ?;", post_id)
+    runner = test_app.test_cli_runner()
+    assert runner.invoke(args=["db", "check-comment-counts"]).exit_code == 1
+    assert runner.invoke(args=["db", "check-comment-counts", "--fix"]).exit_code == 0
+    assert runner.invoke(args=["db", "check-comment-counts"]).exit_code == 0
+
+
+def test_bulk_import(test_app: Flask, tmp_path: Path):
+    with test_app.app_context():
+        pw_hash = passwords.hash_password("saltimported123importer_a").decode()
+    (tmp_path / "users.csv").write_text(
+        "username,first_name,last_name,password,hash_salt\n"
+        f"importer_a,Imported,User,{pw_hash},salt\n"
+        "importer_b,Imported,Friend,,\n"
+    )
+    runner = test_app.test_cli_runner()
+    result = runner.invoke(args=["db", "import", "--users", str(tmp_path / "users.csv")])
+    assert result.exit_code == 0, result.output
+
+    with test_app.app_context():
+        ids = {row["username"]: row["id"] for row in sqlite.read("SELECT id, username FROM Users;")}
+    alice, bob = ids["importer_a"], ids["importer_b"]
+    (tmp_path / "friends.jsonl").write_text(f'{{"u_id": {alice}, "f_id": {bob}}}\n{{"u_id": {bob}, "f_id": {alice}}}\n')
+    (tmp_path / "posts.jsonl").write_text(
+        f'{{"id": 900001, "u_id": {bob}, "content": "imported post", "creation_time": "2020-01-01 12:00:00"}}\n'
+    )
+    (tmp_path / "comments.csv").write_text(f"p_id,u_id,comment\n900001,{alice},first\n900001,{bob},second\n")
+    result = runner.invoke(
+        args=[
+            "db",
+            "import",
+            "--friends",
+            str(tmp_path / "friends.jsonl"),
+            "--posts",
+            str(tmp_path / "posts.jsonl"),
+            "--comments",
+            str(tmp_path / "comments.csv"),
+            "--batch-size",
+            "1",
+        ]
+    )
+    assert result.exit_code == 0, result.output
+
+    with test_app.app_context():
+        indexes = {row["name"] for row in sqlite.read("SELECT name FROM sqlite_master WHERE type = 'index';")}
+        assert {"PostsByTime", "CommentsByPost", "TimelinesByPost"} <= indexes
+        assert sqlite.read("SELECT comment_count FROM Posts WHERE id = 900001;", one=True)["comment_count"] == 2
+        assert sqlite.read("PRAGMA synchronous;", one=True)[0] == 1  # NORMAL, as configured
+
+    # The imported hash is used as-is and the post was added to the timeline of the mutual friend
+    client = test_app.test_client()
+    client.post("/", data={"login-username": "importer_a", "login-password": "imported123", "login-submit": "Sign In"})
+    page = client.get("/stream/importer_a").get_data(as_text=True)
+    assert "imported post" in page and "Comments (2)" in page
+    assert runner.invoke(args=["db", "import", "--posts", str(tmp_path / "users.csv")]).exit_code != 0
+
+
+def test_uploads_are_content_addressed(test_app: Flask):
+    owner, stranger = test_app.test_client(), test_app.test_client()
+    register_and_login(owner, "upload_owner")
+    register_and_login(stranger, "upload_stranger")
+    image = b"\x89PNG\r\n\x1a\n" + secrets.token_bytes(64)
+    for number in range(2):
+        owner.post("/stream/upload_owner", data={"content": f"image {number}", "image": (BytesIO(image), "image.png")})
+
+    with test_app.app_context():
+        keys = [row["image"] for row in sqlite.read("SELECT image FROM Posts WHERE content LIKE 'image %';")]
+        assert len(keys) == 2 and keys[0] == keys[1]
+        assert storage.is_key(keys[0])
+        assert storage.resolve(keys[0]).read_bytes() == image
+        assert not any((storage.upload_folder() / ".tmp").iterdir())
+
+    assert owner.get(f"/uploads/{keys[0]}").data == image
+    assert stranger.get(f"/uploads/{keys[0]}").data == b"Access denied"
+
+
+def test_image_variants_are_served_when_ready(client: FlaskClient):
+    register_and_login(client, "variant_user")
+    image = BytesIO()
+    Image.new("RGB", (1600, 1200), "teal").save(image, format="PNG")
+    client.post("/stream/variant_user", data={"content": "big image", "image": (BytesIO(image.getvalue()), "big.png")})
+    client.application.extensions["image_executor"].shutdown(wait=True)
+
+    with client.application.app_context():
+        key = sqlite.read("SELECT image FROM Posts WHERE content = 'big image';", one=True)["image"]
+    with Image.open(BytesIO(client.get(f"/uploads/{key}?variant=feed").data)) as feed:
+        assert feed.size == (640, 480)
+    with Image.open(BytesIO(client.get(f"/uploads/{key}").data)) as original:
+        assert original.size == (1600, 1200)
+
+
+def test_uploads_support_conditional_and_range_requests(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    register_and_login(client, "conditional_user")
+    image = secrets.token_bytes(1024)
+    client.post("/stream/conditional_user", data={"content": "conditional", "image": (BytesIO(image), "small.gif")})
+    with client.application.app_context():
+        key = sqlite.read("SELECT image FROM Posts WHERE content = 'conditional';", one=True)["image"]
+
+    response = client.get(f"/uploads/{key}")
+    assert response.get_etag() == (key, False)
+    assert "immutable" in response.headers["Cache-Control"]
+    assert client.get(f"/uploads/{key}", headers={"If-None-Match": f'"{key}"'}).status_code == 304
+
+    partial = client.get(f"/uploads/{key}", headers={"Range": "bytes=0-99"})
+    assert partial.status_code == 206 and partial.data == image[:100]
+
+    monkeypatch.setitem(client.application.config, "UPLOADS_SENDFILE", "x-accel-redirect")
+    offloaded = client.get(f"/uploads/{key}")
+    assert offloaded.data == b""
+    assert offloaded.headers["X-Accel-Redirect"] == f"/protected-uploads/{key[:2]}/{key[2:4]}/{key}"
+
+
+def test_stream_answers_unchanged_refresh_with_not_modified(client: FlaskClient):
+    register_and_login(client, "etag_user")
+    client.get("/stream/etag_user")  # Consumes the flash message of the registration
+    etag = client.get("/stream/etag_user").get_etag()[0]
+    assert client.get("/stream/etag_user", headers={"If-None-Match": f'"{etag}"'}).status_code == 304
+
+    client.post("/stream/etag_user", data={"content": "something new", "image": (BytesIO(), "")})
+    refreshed = client.get("/stream/etag_user", headers={"If-None-Match": f'"{etag}"'})
+    assert refreshed.status_code == 200 and "something new" in refreshed.get_data(as_text=True)
+
+    # Posts the user cannot see leave the page unchanged, comments on the posts of the page do not
+    etag = refreshed.get_etag()[0]
+    stranger = client.application.test_client()
+    register_and_login(stranger, "etag_stranger")
+    stranger.post("/stream/etag_stranger", data={"content": "not for etag_user", "image": (BytesIO(), "")})
+    assert client.get("/stream/etag_user", headers={"If-None-Match": f'"{etag}"'}).status_code == 304
+
+    with client.application.app_context():
+        post_id = sqlite.read("SELECT id FROM Posts WHERE content = 'something new';", one=True)["id"]
+    client.post(f"/comments/etag_user/{post_id}", data={"comment": "changes the count"})
+    assert client.get("/stream/etag_user", headers={"If-None-Match": f'"{etag}"'}).status_code == 200
+
+
+def test_post_cards_are_cached_until_commented(client: FlaskClient):
+    register_and_login(client, "fragment_user")
+    client.post("/stream/fragment_user", data={"content": "cache my card", "image": (BytesIO(), "")})
+    with client.application.app_context():
+        post_id = sqlite.read("SELECT id FROM Posts WHERE content = 'cache my card';", one=True)["id"]
+
+    client.get("/stream/fragment_user").get_data()  # A streamed page is rendered while its body is read
+    hits = client.application.extensions["post_cards"].hits
+    assert "Comments (0)" in client.get("/stream/fragment_user").get_data(as_text=True)
+    assert client.application.extensions["post_cards"].hits > hits
+
+    client.post(f"/comments/fragment_user/{post_id}", data={"comment": "new comment"})
+    assert "Comments (1)" in client.get("/stream/fragment_user").get_data(as_text=True)
+
+    # The card is shared with every viewer, its link leads each of them to their own comments page
+    other = client.application.test_client()
+    register_and_login(other, "fragment_other")
+    response = other.get(f"/post/{post_id}")
+    assert response.status_code == 302 and response.location == f"/comments/fragment_other/{post_id}"
+
+
+def test_sql_instrumentation(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(client.application.config, "SQLITE3_SLOW_STATEMENT_MS", 0.0)
+    monkeypatch.setitem(client.application.config, "SQLITE3_STATS_TOKEN", None)
+    register_and_login(client, "instrumented")
+    response = client.get("/profile/instrumented")
+    assert response.headers["Server-Timing"].startswith("sql;dur=")
+    assert client.get("/debug/sql").status_code == 404
+
+    monkeypatch.setitem(client.application.config, "SQLITE3_STATS_TOKEN", "secret-token")
+    assert client.get("/debug/sql", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    stats = client.get("/debug/sql", headers={"Authorization": "Bearer secret-token"}).get_json()
+    profile = stats["routes"]["GET social.profile"]
+    assert profile["requests"] >= 1
+    assert any(query["plan"] for query in profile["queries"])
+
+
+def test_search_only_finds_visible_posts(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(test_app.config, "SEARCH_PAGE_SIZE", 1)
+    alice, bob, eve = test_app.test_client(), test_app.test_client(), test_app.test_client()
+    register_and_login(alice, "search_alice")
+    register_and_login(bob, "search_bob")
+    register_and_login(eve, "search_eve")
+    alice.post("/friends/search_alice", data={"username": "search_bob"})
+    bob.post("/friends/search_bob", data={"username": "search_alice"})
+
+    bob.post("/stream/search_bob", data={"content": "Crème brûlée recipe", "image": (BytesIO(), "")})
+    eve.post("/stream/search_eve", data={"content": "secret creme brulee", "image": (BytesIO(), "")})
+    alice.post("/stream/search_alice", data={"content": "dinner plans", "image": (BytesIO(), "")})
+    with test_app.app_context():
+        post_id = sqlite.read("SELECT id FROM Posts WHERE content = 'dinner plans';", one=True)["id"]
+    bob.post(f"/comments/search_bob/{post_id}", data={"comment": "bring creme brulee"})
+
+    first_page = alice.get("/search/search_alice?q=creme+brulee").get_data(as_text=True)
+    assert "More matches" in first_page
+    older_link = first_page.split("More matches")[0].rsplit('href="', 1)[1].split('"')[0]
+    second_page = alice.get(older_link.replace("&amp;", "&")).get_data(as_text=True)
+    found = first_page + second_page
+    assert "Crème brûlée recipe" in found and "dinner plans" in found
+    assert "secret creme brulee" not in found
+    assert "More matches" not in second_page
+
+    # Newer matches the user may not see do not use up the matches that are ranked
+    monkeypatch.setitem(test_app.config, "SEARCH_MAX_MATCHES", 1)
+    monkeypatch.setitem(test_app.config, "SEARCH_PAGE_SIZE", 10)
+    assert "Crème brûlée recipe" in alice.get("/search/search_alice?q=creme").get_data(as_text=True)
+
+    # FTS5 syntax is searched for as plain words instead of failing
+    assert alice.get('/search/search_alice?q="creme" OR NEAR(').status_code == 200
+    assert alice.get("/search/search_bob?q=creme").get_data(as_text=True) == "Access denied"
+
+    get_matches = "SELECT rowid FROM PostsSearch WHERE PostsSearch MATCH ?;"
+    with test_app.app_context():
+        sqlite.write("UPDATE Posts SET content = 'apple pie' WHERE id = ?;", post_id)
+        assert sqlite.read(get_matches, "pie", one=True)["rowid"] == post_id
+        assert sqlite.read(get_matches, "dinner") == []
+    result = test_app.test_cli_runner().invoke(args=["search", "rebuild"])
+    assert "Rebuilt the search indexes" in result.output
+    with test_app.app_context():
+        assert sqlite.read(get_matches, "apple", one=True)["rowid"] == post_id
+
+
+def test_friend_suggestions(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(test_app.config, "SUGGESTIONS_REFRESH_ON_CHANGE", False)
+    clients = {name: test_app.test_client() for name in ("hub", "left", "right", "outsider")}
+    for name, client in clients.items():
+        register_and_login(client, f"suggest_{name}")
+
+    def befriend(a: str, b: str) -> None:
+        clients[a].post(f"/friends/suggest_{a}", data={"username": f"suggest_{b}"})
+        clients[b].post(f"/friends/suggest_{b}", data={"username": f"suggest_{a}"})
+
+    befriend("hub", "left")
+    befriend("hub", "right")
+    befriend("right", "outsider")
+    runner = test_app.test_cli_runner()
+    assert "Refreshed the suggestions" in runner.invoke(args=["suggestions", "refresh"]).output
+
+    page = clients["left"].get("/friends/suggest_left").get_data(as_text=True)
+    assert "People you may know" in page
+    assert "suggest_right" in page and "1 mutual friend" in page
+    assert "suggest_outsider" not in page
+
+    # Adding a suggested friend removes the suggestion right away, and the queued refresh recomputes it
+    clients["left"].post("/friends/suggest_left", data={"username": "suggest_right"})
+    assert "mutual friend" not in clients["left"].get("/friends/suggest_left").get_data(as_text=True)
+    clients["right"].post("/friends/suggest_right", data={"username": "suggest_left"})
+    runner.invoke(args=["suggestions", "refresh"])
+    page = clients["left"].get("/friends/suggest_left").get_data(as_text=True)
+    assert "suggest_outsider" in page
+    with test_app.app_context():
+        assert sqlite.read("SELECT COUNT(*) FROM SuggestionsDirty;", one=True)[0] == 0
+
+
+def test_mutual_graph_counts_friends_of_friends():
+    edges = [(1, 2, True), (1, 3, True), (1, 5, False), (2, 1, True), (2, 4, True), (2, 5, True)]
+    edges += [(3, 1, True), (3, 4, True), (4, 2, True), (4, 3, True), (5, 2, True)]
+    graph = suggestions.MutualGraph(sorted(edges))
+    # 4 is a mutual friend of both 2 and 3, 5 was already added by 1
+    assert graph.suggest(1, limit=10) == [(4, 2)]
+    assert graph.suggest(4, limit=10) == [(1, 2), (5, 1)]
+    assert graph.suggest(4, limit=1) == [(1, 2)]
+    assert graph.suggest(99, limit=10) == []
+
+
+def test_streamed_pages(client: FlaskClient, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(client.application.config, "STREAM_PAGE_SIZE", 2)
+    register_and_login(client, "streamed_user")
+    for number in range(3):
+        client.post("/stream/streamed_user", data={"content": f"streamed post {number}", "image": (BytesIO(), "")})
+    with client.application.app_context():
+        post_id = sqlite.read("SELECT id FROM Posts WHERE content = 'streamed post 0';", one=True)["id"]
+    for number in range(3):
+        client.post(f"/comments/streamed_user/{post_id}", data={"comment": f"streamed comment {number}"})
+
+    response = client.get("/stream/streamed_user")
+    assert response.content_length is None  # Sent before its length is known
+    page = response.get_data(as_text=True)
+    assert "streamed post 2" in page and "streamed post 1" in page and "streamed post 0" not in page
+    assert "Older posts" in page
+    page = client.get(f"/comments/streamed_user/{post_id}").get_data(as_text=True)
+    assert all(f"streamed comment {number}" in page for number in range(3))
+
+    # Flashed messages are consumed and the CSRF token is stored before the page is streamed
+    client.post("/stream/streamed_user", data={"content": "not an image", "image": (BytesIO(b"text"), "notes.txt")})
+    assert "Image type must be one of" in client.get("/stream/streamed_user").get_data(as_text=True)
+    assert "Image type must be one of" not in client.get("/stream/streamed_user").get_data(as_text=True)
+
+    monkeypatch.setitem(client.application.config, "STREAMED_RENDERING", False)
+    response = client.get("/stream/streamed_user")
+    assert response.content_length is not None and "Older posts" in response.get_data(as_text=True)
+
+
+def test_old_posts_fall_through_to_the_archive(
+    client: FlaskClient, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    monkeypatch.setitem(client.application.config, "STREAM_PAGE_SIZE", 2)
+    monkeypatch.setitem(client.application.config, "ARCHIVE_PATH", str(tmp_path / "posts-{period}.db"))
+    register_and_login(client, "archivist")
+    for number in range(4):
+        client.post("/stream/archivist", data={"content": f"archivist post {number}", "image": (BytesIO(), "")})
+    with client.application.app_context():
+        rows = sqlite.read("SELECT id FROM Posts WHERE content LIKE 'archivist post _' ORDER BY id;")
+        old_ids = [row["id"] for row in rows][:3]
+        client.post(f"/comments/archivist/{old_ids[0]}", data={"comment": "archived comment"})
+        for number, post_id in enumerate(old_ids):
+            sqlite.write("UPDATE Posts SET creation_time = ? WHERE id = ?;", f"200{number}-06-01 12:00:00", post_id)
+        # Only the backdated posts are old enough, the other tests share the database
+        days = (datetime.date.today() - datetime.date(2010, 1, 1)).days
+        assert archive.archive(days, batch_size=2, echo=lambda line: None) == 3
+        assert sqlite.read("SELECT COUNT(*) FROM Posts WHERE id IN (?, ?, ?);", *old_ids, one=True)[0] == 0
+        assert archive.periods() == ["2002", "2001", "2000"]
+        # Running again moves nothing and keeps the counts of the archive files
+        assert archive.archive(days, echo=lambda line: None) == 0
+        assert [row["posts"] for row in sqlite.read("SELECT posts FROM Archives ORDER BY period;")] == [1, 1, 1]
+
+    # The page holding the last recent post continues with the archived ones, and so does the next page
+    page = client.get("/stream/archivist").get_data(as_text=True)
+    assert "archivist post 3" in page and "archivist post 2" in page and "archivist post 1" not in page
+    page = client.get(f"/stream/archivist?before=2002-06-01 12:00:00&before_id={old_ids[2]}").get_data(as_text=True)
+    assert "archivist post 1" in page and "archivist post 0" in page and "Older posts" not in page
+
+    # Permalinks of archived posts still work, but they cannot be commented on
+    page = client.get(f"/comments/archivist/{old_ids[0]}").get_data(as_text=True)
+    assert "archivist post 0" in page and "archived comment" in page and "can no longer be commented on" in page
+    client.post(f"/comments/archivist/{old_ids[0]}", data={"comment": "too late"})
+    assert "too late" not in client.get(f"/comments/archivist/{old_ids[0]}").get_data(as_text=True)
+    with client.application.app_context():
+        sqlite.write("DELETE FROM Archives;")
+        sqlite.write("DELETE FROM ArchivedPosts;")
+
+
+def test_events_push_new_posts_and_comments(test_app: Flask, monkeypatch: pytest.MonkeyPatch):
+    for name, value in {"EVENTS_MAX_AGE": 1.0, "EVENTS_HEARTBEAT": 0.05, "EVENTS_POLL_INTERVAL": 0.05}.items():
+        monkeypatch.setitem(test_app.config, name, value)
+    alice, bob, eve = test_app.test_client(), test_app.test_client(), test_app.test_client()
+    for client, name in ((alice, "events_alice"), (bob, "events_bob"), (eve, "events_eve")):
+        register_and_login(client, name)
+    alice.post("/friends/events_alice", data={"username": "events_bob"})
+    bob.post("/friends/events_bob", data={"username": "events_alice"})
+    assert "/events/events_alice?after=" in alice.get("/stream/events_alice").get_data(as_text=True)
+
+    # A stream that is open receives the new posts of mutual friends only
+    stream = alice.get("/events/events_alice", buffered=False)
+    assert stream.mimetype == "text/event-stream"
+    assert events.hub.subscribers == 1
+
+    def post() -> None:
+        eve.post("/stream/events_eve", data={"content": "pushed by eve", "image": (BytesIO(), "")})
+        bob.post("/stream/events_bob", data={"content": "pushed by bob", "image": (BytesIO(), "")})
+
+    # Post from another thread, like another request would, since the streamed response keeps its context pushed
+    poster = threading.Thread(target=post)
+    poster.start()
+    received = stream.get_data(as_text=True)
+    poster.join()
+    assert received.startswith("retry:") and ": heartbeat" in received
+    assert "event: post" in received and "pushed by bob" in received and "pushed by eve" not in received
+    assert events.hub.subscribers == 0
+
+    # A reconnecting browser is sent the events it missed, the comments page only gets comments on its post
+    with test_app.app_context():
+        post_id = sqlite.read("SELECT id FROM Posts WHERE content = 'pushed by bob';", one=True)["id"]
+        after = events.last_event_id()
+    bob.post(f"/comments/events_bob/{post_id}", data={"comment": "pushed comment"})
+    # The URL is written as a JavaScript string, where an HTML escaped &amp; would not be decoded
+    page = alice.get(f"/comments/events_alice/{post_id}").get_data(as_text=True)
+    assert f'new EventSource("/events/events_alice?post_id={post_id}\\u0026after=' in page
+    monkeypatch.setitem(test_app.config, "EVENTS_MAX_AGE", 0.0)
+    missed = alice.get(f"/events/events_alice?post_id={post_id}", headers={"Last-Event-ID": str(after)})
+    assert "event: comment" in missed.get_data(as_text=True) and "pushed comment" in missed.get_data(as_text=True)
+    assert "pushed comment" not in alice.get(f"/events/events_alice?after={after}").get_data(as_text=True)
+    assert eve.get(f"/events/events_alice?post_id={post_id}").status_code == 403
+
+    monkeypatch.setitem(test_app.config, "EVENTS_MAX_SUBSCRIBERS", 0)
+    assert alice.get("/events/events_alice").status_code == 503
+
+
+def test_event_subscriber_overflows_instead_of_growing():
+    subscriber = events.Subscriber(user_id=1, post_id=None, max_queued=2)
+    for event_id in range(3):
+        subscriber.deliver((event_id, "post", None))
+    assert subscriber.overflowed
+    assert subscriber.queue.get_nowait() is None and subscriber.queue.empty()